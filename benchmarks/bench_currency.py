@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Compares the vectorized currency conversion of price histories (as done by
+the currency_aware decorator) with the previous per-date currex loop.
+"""
+
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+from pathlib import Path
+from timeit import timeit
+
+# benchmark the ppserve of this checkout, without touching ~/.ppserve
+sys.path.insert(0, str(Path(__file__).parent.parent))
+os.environ['HOME'] = tempfile.mkdtemp(prefix='ppserve-bench-')
+# ppserve parses the command line when it is imported
+sys.argv = [sys.argv[0], '--offline', '--log-level', 'WARNING']
+
+from ppserve.securities import Security
+from ppserve.securities.util import currex
+
+def per_date_loop(sec, target_currency):
+    return {d: v * currex(sec.currency, target_currency, date_=d) for (d,v) in sec._price_history.items()}
+
+def main():
+    sec = Security('BENCH', read_quotes=False)
+    sec.currency = 'USD'
+    start = date(2000, 1, 3)
+    sec._price_history = {start + timedelta(days=i): 100 + (i % 50)/7 for i in range(20*365)}
+
+    # warm up the rate arrays before timing
+    assert sec.price_history('EUR') == per_date_loop(sec, 'EUR')
+
+    n = 10
+    loop = timeit(lambda: per_date_loop(sec, 'EUR'), number=n)/n
+    vectorized = timeit(lambda: sec.price_history('EUR'), number=n)/n
+
+    print('{} quotes USD -> EUR'.format(len(sec._price_history)))
+    print('per-date loop: {:8.2f} ms'.format(loop*1000))
+    print('vectorized:    {:8.2f} ms ({:.1f}x)'.format(vectorized*1000, loop/vectorized))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Records the Ariva pages of a security as benchmark fixtures: its snapshot
+page and one month of historische_kurse, saved to fixtures/ariva/NAME.
+The stand-in server serves them for all symbols starting with NAME.
+"""
+
+import argparse
+import calendar
+import sys
+from datetime import date
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+from standin import fixtures_path
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('name', help="Name of the fixture, e.g. 'anleihe'.")
+    parser.add_argument('symbol', help='WKN or ISIN of the security on Ariva.')
+    parser.add_argument('--month', default='2019-03', help='Month of historic quotes to record (YYYY-MM).')
+    options = parser.parse_args()
+
+    # ppserve parses the command line when it is imported
+    sys.argv = [sys.argv[0]]
+    from ppserve.price_sources import ArivaPriceSource
+
+    year, month = map(int, options.month.split('-'))
+    month_end = date(year, month, calendar.monthrange(year, month)[1])
+
+    source = ArivaPriceSource(options.symbol)
+    pages = {
+        'snapshot': source.fetch_page(),
+        'historische_kurse': source.connection_pool.get(
+            source._historic_month_url(month_end), headers=source.headers
+        ).decode('utf-8')
+    }
+
+    directory = fixtures_path/options.name.lower()
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, html in pages.items():
+        (directory/(name + '.html')).write_text(html, encoding='utf-8')
+        print('Recorded {}'.format(directory/(name + '.html')))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite. Runs ppserve against a local stand-in for Ariva
+(see standin.py) and times scraping, the quote store, bond and currency
+computations and the HTTP server under a simulated Portfolio Performance
+polling load. Results are written as JSON, so runs of different versions
+can be compared with --compare.
+
+Everything happens in a temporary home directory; ~/.ppserve is not touched.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import urllib.request
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from time import perf_counter, sleep
+
+# benchmark the ppserve of this checkout, not an installed one
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+from standin import StandInServer
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('-o', '--output', help='Write the results to this JSON file instead of standard output.')
+    parser.add_argument('--compare', metavar='BASELINE', help='Compare the results with those of an earlier run.')
+    parser.add_argument('--max-regression', type=float, metavar='FRACTION',
+        help='With --compare: exit with status 1 if any median got slower by more than FRACTION (e.g. 0.2).')
+    parser.add_argument('--only', metavar='NAME', action='append', default=[],
+        help='Only run benchmarks whose name starts with NAME (may be repeated).')
+    parser.add_argument('--repeat', type=int, default=20, help='Repetitions of each micro benchmark.')
+    parser.add_argument('--latency', type=float, default=20, help='Simulated round trip time to Ariva in milliseconds.')
+    parser.add_argument('--years', type=int, default=10, help='Years of daily quotes used for the history benchmarks.')
+    parser.add_argument('--clients', type=int, default=4, help='Number of simulated Portfolio Performance clients.')
+    parser.add_argument('--securities', type=int, default=20, help='Number of securities each client polls.')
+    parser.add_argument('--rounds', type=int, default=5, help='Number of times each client polls all of its securities.')
+    parser.add_argument('--server', choices=['paste', 'async'], default='paste', help='Server used for the load test.')
+    return parser.parse_args()
+
+def summarize(samples, unit='s'):
+    samples = sorted(samples)
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p/100*len(samples)))]
+    return {
+        'unit': unit,
+        'n': len(samples),
+        'min': samples[0],
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': samples[-1]
+    }
+
+def timed(fn, repeat, setup=None):
+    samples = []
+    for i in range(repeat):
+        arg = setup(i) if setup is not None else None
+        started = perf_counter()
+        fn(arg)
+        samples.append(perf_counter() - started)
+    return summarize(samples)
+
+def daily_quotes(years, price=100.0):
+    quotes = {}
+    d = date.today() - timedelta(days=365*years)
+    while d < date.today():
+        if d.weekday() < 5:
+            quotes[d] = round(price, 3)
+            price *= 1 + random.uniform(-0.01, 0.01)
+        d += timedelta(days=1)
+    return quotes
+
+class Suite:
+
+    def __init__(self, options, standin):
+        self.options = options
+        self.standin = standin
+        self.results = {}
+
+        # imported here, since ppserve parses its command line on import
+        from ppserve import ppserve
+        from ppserve.price_sources import ArivaPriceSource
+        from ppserve.securities import Security, Bond
+        from ppserve.securities.util import currency_rates, currex
+        self.ppserve = ppserve
+        self.ArivaPriceSource = ArivaPriceSource
+        self.Security = Security
+        self.Bond = Bond
+        self.currency_rates = currency_rates
+        self.currex = currex
+
+    def wanted(self, name):
+        return not self.options.only or any(name.startswith(prefix) for prefix in self.options.only)
+
+    def record(self, name, result):
+        self.results[name] = result
+        print('{:32} median {:10.3f} ms   p90 {:10.3f} ms   (n={})'.format(
+            name, result['median']*1000, result['p90']*1000, result['n']), file=sys.stderr)
+
+    def run(self):
+        repeat = self.options.repeat
+        self.ArivaPriceSource.base_url = self.standin.url
+
+        # load the exchange rates up front, they are not what we are measuring
+        self.currency_rates.load()
+
+        if self.wanted('fetch_info'):
+            self.record('fetch_info.cold', timed(
+                lambda source: source.fetch_info(), repeat,
+                setup=lambda i: self.ArivaPriceSource('ANLEIHE-INFO{}'.format(i))
+            ))
+            # resolved before, so only the snapshot page is fetched
+            self.record('fetch_info.warm', timed(
+                lambda source: source.fetch_info(), repeat,
+                setup=lambda i: self.ArivaPriceSource('ANLEIHE-INFO{}'.format(i))
+            ))
+            self.record('fetch_info.parse', timed(
+                lambda html: self.ArivaPriceSource('ANLEIHE-INFO0')._parse_info(html), repeat,
+                setup=lambda i: self.standin.pages('ANLEIHE')['snapshot']
+            ))
+
+        if self.wanted('fetch_historic_quotes'):
+            end = date.today()
+            start = end - timedelta(days=365)
+            source = self.ArivaPriceSource('AKTIE-HIST')
+            source.url
+            self.record('fetch_historic_quotes.year', timed(
+                lambda _: source.fetch_historic_quotes(start, end), max(1, repeat//4)
+            ))
+            self.record('fetch_historic_quotes.year_serial', timed(
+                lambda _: source.fetch_historic_quotes(start, end, workers=1), max(1, repeat//4)
+            ))
+            self.record('fetch_historic_quotes.parse', timed(
+                lambda html: source._parse_historic_month(html, date.min, date.max), repeat,
+                setup=lambda i: self.standin.pages('AKTIE')['historische_kurse']
+            ))
+
+        history = daily_quotes(self.options.years)
+
+        if self.wanted('quotes'):
+            def write(sec):
+                sec._price_history = dict(history)
+                sec.write_quotes()
+            self.record('quotes.write', timed(
+                write, repeat,
+                setup=lambda i: self.Security('STORE{}'.format(i), read_quotes=False)
+            ))
+            self.record('quotes.read', timed(
+                lambda sec: sec.read_quotes(), repeat,
+                setup=lambda i: self.Security('STORE{}'.format(i), read_quotes=False)
+            ))
+
+        if self.wanted('dirty_price_history'):
+            bond = self.ArivaPriceSource('ANLEIHE-DIRTY').security()
+            bond._price_history = dict(history)
+            bond.dirty_price_history()
+            self.record('dirty_price_history', timed(
+                lambda _: bond.dirty_price_history(), repeat
+            ))
+            self.record('dirty_price_history.cold_schedule', timed(
+                lambda _: bond.dirty_price_history(), repeat,
+                setup=lambda i: setattr(bond, 'maturity', bond.maturity)
+            ))
+
+        if self.wanted('convert'):
+            sec = self.Security('CONVERT', read_quotes=False)
+            sec.currency = 'USD'
+            sec._price_history = dict(history)
+            self.record('convert.history', timed(
+                lambda _: sec.price_history('EUR'), repeat
+            ))
+            # the per-date conversion the history conversion replaced, for reference
+            self.record('convert.per_date', timed(
+                lambda _: {d: v*self.currex(sec.currency, 'EUR', date_=d) for d, v in sec._price_history.items()}, max(1, repeat//4)
+            ))
+
+        if self.wanted('serve'):
+            self.serve()
+
+    def serve(self):
+        """
+        Simulates Portfolio Performance clients polling the quotes and the
+        historic prices of their securities, each over its own connection.
+        """
+        options = self.options
+        ppserve = self.ppserve
+
+        symbols = []
+        for i in range(options.securities):
+            symbol = '{}-SERVE{}'.format('ANLEIHE' if i % 2 == 0 else 'AKTIE', i)
+            # pretend the updater already fetched the price history
+            sec = self.Security(symbol, read_quotes=False)
+            sec._price_history = daily_quotes(options.years)
+            sec.write_quotes()
+            symbols.append(symbol)
+
+        base_url = start_server(options.server, ppserve)
+
+        latencies = {'serve.quote.cold': [], 'serve.quote': [], 'serve.historic': []}
+        lock = threading.Lock()
+
+        def get(name, path):
+            started = perf_counter()
+            with urllib.request.urlopen(base_url + path) as response:
+                response.read()
+            with lock:
+                latencies[name].append(perf_counter() - started)
+
+        def client(n):
+            mine = list(symbols)
+            random.Random(n).shuffle(mine)
+            for _ in range(options.rounds):
+                for symbol in mine:
+                    get('serve.quote', '/quote/{}/clean/EUR'.format(symbol))
+                    get('serve.historic', '/historic/{}/clean/EUR'.format(symbol))
+
+        # the route prints every security it serves
+        with contextlib.redirect_stdout(io.StringIO()):
+            # the first request of each symbol scrapes its quote
+            for symbol in symbols:
+                get('serve.quote.cold', '/quote/{}/clean/EUR'.format(symbol))
+            clients = [threading.Thread(target=client, args=(n,)) for n in range(options.clients)]
+            load_started = perf_counter()
+            for t in clients:
+                t.start()
+            for t in clients:
+                t.join()
+            load_duration = perf_counter() - load_started
+
+        for name, samples in latencies.items():
+            self.record(name, summarize(samples))
+        requests = len(latencies['serve.quote']) + len(latencies['serve.historic'])
+        self.results['serve.throughput'] = {'unit': 'requests/s', 'n': requests, 'value': requests/load_duration}
+        print('{:32} {:10.1f} requests/s'.format('serve.throughput', requests/load_duration), file=sys.stderr)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(name, ppserve):
+    """
+    Runs ppserve's bottle app in the background with the given server, and
+    returns its URL once it accepts connections.
+    """
+    app = ppserve.default_app()
+    if name == 'async':
+        from ppserve.async_server import AsyncServer
+        port = free_port()
+        server = AsyncServer(host='127.0.0.1', port=port, prepare=ppserve.prepare_request)
+        threading.Thread(target=server.run, args=(app,), name='ppserve', daemon=True).start()
+    else:
+        from paste import httpserver
+        from paste.translogger import TransLogger
+        # like bottle's paste adapter, but with daemon threads, so the server
+        # doesn't keep the benchmark from exiting
+        server = httpserver.serve(TransLogger(app, setup_console_handler=False), host='127.0.0.1', port=0, start_loop=False, daemon_threads=True)
+        port = server.server_address[1]
+        threading.Thread(target=server.serve_forever, name='ppserve', daemon=True).start()
+
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except ConnectionRefusedError:
+            sleep(0.05)
+    return 'http://127.0.0.1:{}'.format(port)
+
+def git_describe():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=Path(__file__).parent,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path, max_regression):
+    """
+    Prints how the medians changed relative to the baseline. Returns False if
+    any of them got slower by more than max_regression.
+    """
+    baseline = json.loads(Path(baseline_path).read_text())
+    print('\ncompared with {} ({}):'.format(baseline_path, baseline.get('version')), file=sys.stderr)
+
+    ok = True
+    for name, result in results['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        key = 'value' if 'value' in result else 'median'
+        # throughput is better when higher, all other results when lower
+        change = result[key]/old[key] - 1
+        slower = -change if key == 'value' else change
+        flag = ''
+        if max_regression is not None and slower > max_regression:
+            flag = '  REGRESSION'
+            ok = False
+        print('{:32} {:+8.1%}{}'.format(name, change, flag), file=sys.stderr)
+    return ok
+
+def main():
+    options = parse_args()
+
+    home = tempfile.mkdtemp(prefix='ppserve-bench-')
+    os.environ['HOME'] = home
+    # ppserve parses the command line when it is imported
+    sys.argv = [sys.argv[0], '--offline', '--log-level', 'WARNING']
+
+    random.seed(1)
+    standin = StandInServer(latency=options.latency/1000).start()
+
+    suite = Suite(options, standin)
+    started = datetime.now()
+    try:
+        suite.run()
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    results = {
+        'version': git_describe(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': started.isoformat(timespec='seconds'),
+        'options': {k: v for k, v in vars(options).items() if k not in ('output', 'compare', 'max_regression')},
+        'standin_requests': standin.requests,
+        'results': suite.results
+    }
+
+    output = json.dumps(results, indent=2)
+    if options.output:
+        Path(options.output).write_text(output + '\n')
+    else:
+        print(output)
+
+    if options.compare and not compare(results, options.compare, options.max_regression):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
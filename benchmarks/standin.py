@@ -0,0 +1,118 @@
+"""
+Local stand-in for Ariva, serving the recorded pages in fixtures/ariva.
+
+Symbols are mapped to fixtures by their prefix: 'ANLEIHE-3' is served the
+pages recorded in fixtures/ariva/anleihe. Like on Ariva, looking up a symbol
+redirects to the security's page, from which the snapshot and the
+historische_kurse pages are reached. The recorded month of historic quotes
+is served for every requested month, with its dates moved into that month.
+"""
+
+import calendar
+import http.server
+import re
+import threading
+import time
+import urllib.parse
+from datetime import date
+from pathlib import Path
+
+fixtures_path = Path(__file__).parent/'fixtures'/'ariva'
+
+quote_row = re.compile(r'(<tr class="[^"]*\barrow0\b[^"]*"[^>]*>\s*<td[^>]*>\s*)(\d\d)\.\d\d\.\d\d(.*?</tr>\s*)', re.S)
+
+def move_month(html, month_end):
+    """
+    Moves the quotes of a recorded month page into the month of month_end.
+    Rows of days that month doesn't have are dropped.
+    """
+    last_day = calendar.monthrange(month_end.year, month_end.month)[1]
+
+    def move(match):
+        day = int(match.group(2))
+        if day > last_day:
+            return ''
+        return match.group(1) + date(month_end.year, month_end.month, day).strftime('%d.%m.%y') + match.group(3)
+
+    return quote_row.sub(move, html)
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.count()
+        if server.latency:
+            time.sleep(server.latency)
+
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        query = urllib.parse.parse_qs(url.query)
+
+        if len(parts) == 1:
+            # symbol lookup
+            self.send_response(302)
+            self.send_header('Location', '/sec/{}'.format(parts[0]))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        pages = server.pages(parts[1])
+        if pages is None:
+            self.send_error(404)
+            return
+
+        if len(parts) == 3 and parts[2] == 'historische_kurse':
+            body = move_month(pages['historische_kurse'], date.fromisoformat(query['month'][0]))
+        else:
+            body = pages['snapshot']
+
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    """
+    Serves the fixtures on a free local port, answering every request after
+    latency seconds to simulate the round trip to Ariva.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, path=fixtures_path):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self.path = Path(path)
+        self.requests = 0
+
+        self._fixtures = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def pages(self, symbol):
+        fixture = symbol.split('-')[0].lower()
+        if fixture not in self._fixtures:
+            directory = self.path/fixture
+            if not directory.is_dir():
+                return None
+            self._fixtures[fixture] = {
+                page.stem: page.read_text(encoding='utf-8') for page in directory.glob('*.html')
+            }
+        return self._fixtures[fixture]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='ariva stand-in', daemon=True).start()
+        return self
@@ -0,0 +1,223 @@
+import asyncio
+import io
+import http.client
+import logging
+import sys
+import urllib.parse
+from itertools import chain
+from bottle import ServerAdapter
+
+class BadRequest(Exception):
+    """
+    A request the server refuses, with the status to answer it with.
+    """
+
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+class AsyncServer(ServerAdapter):
+    """
+    Small HTTP/1.1 server running on an asyncio event loop, usable as a bottle
+    server adapter. Every connection is a coroutine instead of a thread.
+
+    Requests are still answered by the (synchronous) WSGI application, but
+    before that the optional coroutine prepare(environ) can do any slow I/O
+    without blocking, e.g. fetch the quote the request is about and leave it
+    in the environ for the route.
+
+    Connections are closed after keep_alive_timeout idle seconds, and if a
+    request isn't read (or a response written) within read_timeout seconds.
+    Requests with too many or too large headers or too large bodies are
+    refused. All of these can be changed through the options.
+    """
+
+    keep_alive_timeout = 15
+    read_timeout = 30
+    max_request_line = 8192
+    max_header_bytes = 16384
+    max_header_lines = 100
+    max_body_bytes = 1 << 20
+
+    def run(self, handler):
+        self.logger = logging.getLogger('AsyncServer')
+        asyncio.run(self.serve(handler))
+
+    async def serve(self, handler):
+        self.handler = handler
+        self.prepare = self.options.get('prepare')
+        for name in ('keep_alive_timeout', 'read_timeout', 'max_request_line', 'max_header_bytes', 'max_header_lines', 'max_body_bytes'):
+            setattr(self, name, self.options.get(name, getattr(self, name)))
+
+        # an already listening socket, e.g. shared by several processes (see ppserve.prefork)
+        sock = self.options.get('sock')
+        if sock is None:
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+        else:
+            server = await asyncio.start_server(self.handle, sock=sock)
+        self.logger.info('Listening on http://{}:{}/'.format(self.host, self.port))
+        async with server:
+            await server.serve_forever()
+
+    def environ(self, method, target, version, headers, body, peer):
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.parse.unquote_to_bytes(path).decode('latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peer[0] if peer else '',
+            'CONTENT_TYPE': headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for name, value in headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = value
+        return environ
+
+    async def read_request(self, reader, request_line):
+        """
+        Reads the rest of the request starting with request_line. Returns the
+        method, target, version, headers and body, or raises BadRequest.
+        """
+        if len(request_line) > self.max_request_line:
+            raise BadRequest('414 URI Too Long')
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise BadRequest('400 Bad Request')
+        if not version.startswith('HTTP/1.'):
+            raise BadRequest('400 Bad Request')
+
+        raw_headers = b''
+        lines = 0
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # longer than the stream's buffer
+                raise BadRequest('431 Request Header Fields Too Large')
+            if line in (b'\r\n', b'\n', b''):
+                break
+            raw_headers += line
+            lines += 1
+            if len(raw_headers) > self.max_header_bytes or lines > self.max_header_lines:
+                raise BadRequest('431 Request Header Fields Too Large')
+        if not line:
+            raise asyncio.IncompleteReadError(raw_headers, None)
+        try:
+            headers = http.client.parse_headers(io.BytesIO(raw_headers + b'\r\n'))
+        except http.client.HTTPException:
+            raise BadRequest('431 Request Header Fields Too Large')
+
+        try:
+            length = int(headers.get('Content-Length', 0))
+        except ValueError:
+            raise BadRequest('400 Bad Request')
+        if length < 0:
+            raise BadRequest('400 Bad Request')
+        if length > self.max_body_bytes:
+            raise BadRequest('413 Payload Too Large')
+        body = await reader.readexactly(length)
+
+        return method, target, version, headers, body
+
+    async def reject(self, writer, status):
+        body = status.encode('latin-1')
+        head = 'HTTP/1.1 {}\r\nContent-Type: text/plain\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(status, len(body))
+        writer.write(head.encode('latin-1') + body)
+        await asyncio.wait_for(writer.drain(), self.read_timeout)
+        self.logger.debug('Refused request: {}'.format(status))
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+                except ValueError:
+                    await self.reject(writer, '414 URI Too Long')
+                    break
+                if not request_line.strip():
+                    break
+
+                try:
+                    method, target, version, headers, body = await asyncio.wait_for(
+                        self.read_request(reader, request_line), self.read_timeout
+                    )
+                except BadRequest as e:
+                    await self.reject(writer, e.status)
+                    break
+
+                environ = self.environ(method, target, version, headers, body, peer)
+                if self.prepare is not None:
+                    await self.prepare(environ)
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('Connection', '').lower() != 'close'
+                keep_alive = await self.respond(environ, writer, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, environ, writer, keep_alive):
+        """
+        Runs the WSGI application and streams its response. Returns whether
+        the connection can be kept open.
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+
+        result = self.handler(environ, start_response)
+        try:
+            chunks = iter(result)
+            # the status is only known once the application produced its first chunk
+            first = next(chunks, b'')
+
+            headers = list(response['headers'])
+            names = {name.lower() for name, _ in headers}
+            has_body = environ['REQUEST_METHOD'] != 'HEAD' and response['status'][:3] not in ('204', '304')
+            chunked = has_body and 'content-length' not in names
+            if chunked and environ['SERVER_PROTOCOL'] != 'HTTP/1.1':
+                chunked = False
+                keep_alive = False
+            headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+            if chunked:
+                headers.append(('Transfer-Encoding', 'chunked'))
+
+            head = 'HTTP/1.1 {}\r\n'.format(response['status'])
+            head += ''.join('{}: {}\r\n'.format(name, value) for name, value in headers)
+            writer.write((head + '\r\n').encode('latin-1'))
+
+            if has_body:
+                for chunk in chain([first], chunks):
+                    if not chunk:
+                        continue
+                    writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                    # give other connections a chance between chunks
+                    await asyncio.wait_for(writer.drain(), self.read_timeout)
+                if chunked:
+                    writer.write(b'0\r\n\r\n')
+            await asyncio.wait_for(writer.drain(), self.read_timeout)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        self.logger.debug('{} {} {}'.format(environ['REQUEST_METHOD'], environ['PATH_INFO'], response['status']))
+        return keep_alive
@@ -0,0 +1,61 @@
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import wraps
+from time import monotonic
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when the time given to answer a request has run out before an
+    upstream call could be made or finished.
+    """
+
+# absolute (monotonic) time by which the current request must be answered,
+# None outside of requests (e.g. for background updates)
+_expires = ContextVar('deadline', default=None)
+
+@contextmanager
+def deadline(seconds):
+    """
+    Gives the code run within seconds to finish. Nested deadlines can only
+    shorten the current one. Being a context variable, the deadline follows
+    the request into coroutines, but not into other threads (see carry).
+    """
+    expires = None if seconds is None else monotonic() + seconds
+    current = _expires.get()
+    if expires is None or (current is not None and current < expires):
+        expires = current
+
+    token = _expires.set(expires)
+    try:
+        yield
+    finally:
+        _expires.reset(token)
+
+def remaining(timeout=None):
+    """
+    Returns how long an upstream call may take: timeout, or less if the
+    current deadline expires earlier (None means no limit). Raises
+    DeadlineExceeded if the deadline has already passed.
+    """
+    expires = _expires.get()
+    if expires is None:
+        return timeout
+
+    left = expires - monotonic()
+    if left <= 0:
+        raise DeadlineExceeded('Deadline exceeded')
+    return left if timeout is None else min(timeout, left)
+
+def carry(fn):
+    """
+    Wraps fn to run under the deadline of the caller, e.g. in a thread pool.
+    The caller's other context variables (such as its trace, see
+    ppserve.tracing) come along as well.
+    """
+    context = copy_context()
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        # a context can only be entered once at a time, and fn may run in several threads
+        return context.copy().run(fn, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,239 @@
+import asyncio
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+from .tracing import span
+
+class Registry:
+    """
+    Collects metrics and renders them in the Prometheus text format.
+
+    Besides metrics that are updated as things happen, collectors can be
+    registered: functions called at exposition time that return
+    (name, type, help, samples) tuples, samples being (labels, value) pairs.
+    They are meant for values that are cheaper to read when asked for (sizes,
+    queue lengths) than to keep up to date.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.expose()
+        for collector in self.collectors:
+            for name, type_, help_, samples in collector():
+                lines.append('# HELP {} {}'.format(name, help_))
+                lines.append('# TYPE {} {}'.format(name, type_))
+                lines += [sample_line(name, labels, value) for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def sample_line(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels.items()) + '}'
+    return '{} {}'.format(name, format_value(value))
+
+class Metric:
+    """
+    Base class of metrics with label values given positionally, e.g.
+    scrape_seconds.labels('Ariva', 'A0B1C2', 'fetch_info').observe(0.4).
+    The children for each combination of label values are created once and
+    kept, so recording a value is a dict lookup and an addition.
+    """
+
+    type_ = None
+
+    def __init__(self, name, help_, labels=(), registry=None):
+        self.name = name
+        self.help = help_
+        self.label_names = tuple(labels)
+
+        self._children = {}
+        self._lock = Lock()
+
+        (registry or default_registry).register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _child(self):
+        raise NotImplementedError()
+
+    def _samples(self, labels, child):
+        raise NotImplementedError()
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type_)]
+        for values, child in sorted(self._children.copy().items()):
+            lines += self._samples(dict(zip(self.label_names, values)), child)
+        return lines
+
+class _Value:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class Counter(Metric):
+    type_ = 'counter'
+
+    def _child(self):
+        return _Value()
+
+    def _samples(self, labels, child):
+        return [sample_line(self.name, labels, child.value)]
+
+class Gauge(Counter):
+    type_ = 'gauge'
+
+class _Timer:
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self.started)
+
+class _Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+class Histogram(Metric):
+    type_ = 'histogram'
+
+    default_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help_, labels=(), buckets=default_buckets, registry=None):
+        self.buckets = tuple(buckets)
+        Metric.__init__(self, name, help_, labels, registry)
+
+    def _child(self):
+        return _Histogram(self.buckets)
+
+    def _samples(self, labels, child):
+        with child._lock:
+            counts, sum_ = list(child.counts), child.sum
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append(sample_line(self.name + '_bucket', dict(labels, le=format_value(float(bound))), cumulative))
+        lines.append(sample_line(self.name + '_sum', labels, sum_))
+        lines.append(sample_line(self.name + '_count', labels, cumulative))
+        return lines
+
+default_registry = Registry()
+
+# Symbols and modes come from request URLs. Only the configured securities
+# and the known modes get label values of their own, all others are counted
+# as 'other', so requests can't create any number of series.
+labelled_symbols = set()
+labelled_modes = {'', 'quote', 'historic', 'historical'}
+
+def symbol_label(symbol):
+    return symbol if symbol in labelled_symbols else 'other'
+
+def mode_label(mode):
+    return mode if mode in labelled_modes else 'other'
+
+# Metrics recorded outside of the web app
+
+source_seconds = Histogram(
+    'ppserve_source_seconds', 'Duration of price source operations (including network round trips).',
+    labels=('source', 'symbol', 'operation')
+)
+source_errors = Counter(
+    'ppserve_source_errors_total', 'Price source operations that raised an exception.',
+    labels=('source', 'operation')
+)
+parse_seconds = Histogram(
+    'ppserve_parse_seconds', 'Time spent parsing pages of price sources.',
+    labels=('source', 'page')
+)
+conversion_seconds = Histogram(
+    'ppserve_conversion_seconds', 'Time spent converting prices and price histories between currencies.',
+    labels=('kind',), buckets=(.00001, .0001, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+)
+
+def instrumented(operation):
+    """
+    Decorator for PriceSource methods (and coroutines) recording their
+    duration in source_seconds and their failures in source_errors, and as
+    a span of the current trace (see ppserve.tracing).
+    """
+    def decorator(f):
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def wrapper(self, *args, **kwargs):
+                started = perf_counter()
+                try:
+                    with span('source.' + operation, source=self.name, symbol=self.symbol):
+                        return await f(self, *args, **kwargs)
+                except Exception:
+                    source_errors.labels(self.name, operation).inc()
+                    raise
+                finally:
+                    source_seconds.labels(self.name, symbol_label(self.symbol), operation).observe(perf_counter() - started)
+        else:
+            @wraps(f)
+            def wrapper(self, *args, **kwargs):
+                started = perf_counter()
+                try:
+                    with span('source.' + operation, source=self.name, symbol=self.symbol):
+                        return f(self, *args, **kwargs)
+                except Exception:
+                    source_errors.labels(self.name, operation).inc()
+                    raise
+                finally:
+                    source_seconds.labels(self.name, symbol_label(self.symbol), operation).observe(perf_counter() - started)
+        return wrapper
+    return decorator
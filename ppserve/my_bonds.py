@@ -1,5 +1,5 @@
-from .price_sources.securities import Bond
-from .price_sources import ArivaPriceSource
+from .securities import Bond
+from .price_sources import price_source
 
 import yaml
 import logging
@@ -21,11 +21,7 @@ def load_my_bonds(path):
         logger.info('Loading {}'.format(symbol))
         bond = Bond(symbol)
         bond.update_from_dict(info)
-        ps = ArivaPriceSource(symbol)
-        bond.update_from_dict({
-            'update_hook': ps.fetch_info,
-            'update_hook_historic': ps.fetch_historic_quotes
-        })
+        price_source(symbol).hook_into(bond)
 
         my_bonds[symbol] = bond
 
@@ -18,18 +18,146 @@ parser.add_argument(
     '--log-level', dest='log_level', choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'], default='INFO',
     help='Log verbosity.'
 )
+parser.add_argument(
+    '--fetch-workers', dest='fetch_workers', type=int, default=4,
+    help='Number of month pages of historic quotes fetched concurrently per security (1 fetches them serially).'
+)
+parser.add_argument(
+    '--max-connections-per-host', dest='max_connections_per_host', type=int, default=4,
+    help='Maximum number of simultaneous connections to a single price source host.'
+)
+parser.add_argument(
+    '--quote-ttl', dest='quote_ttl', type=float, default=300,
+    help='Seconds for which a fetched quote is considered fresh. Stale quotes are served while being refreshed in the background.'
+)
+parser.add_argument(
+    '--resolution-cache-days', dest='resolution_cache_days', type=float, default=30,
+    help='Number of days for which resolved symbol URLs are cached on disk.'
+)
+parser.add_argument(
+    '--clear-resolution-cache', dest='clear_resolution_cache', action='store_true',
+    help='Forget all cached symbol resolutions on startup.'
+)
+parser.add_argument(
+    '--offline', dest='offline', action='store_true',
+    help='Do not download exchange rates; use the last cached ones.'
+)
+parser.add_argument(
+    '--server', dest='server', choices=['paste', 'async'], default='paste',
+    help='Server to use: paste (one thread per request) or async (asyncio event loop, non-blocking scraping).'
+)
+parser.add_argument(
+    '--update-interval', dest='update_interval', type=float, default=3,
+    help='Hours between background updates of the price history of each configured security.'
+)
+parser.add_argument(
+    '--updater-workers', dest='updater_workers', type=int, default=2,
+    help='Number of threads updating price histories in the background.'
+)
+parser.add_argument(
+    '--update-rate', dest='update_rate', type=float, default=0.5,
+    help='Maximum number of background updates started per second and price source host.'
+)
+parser.add_argument(
+    '--history-start', dest='history_start', default='2015-12-10',
+    help='Date (YYYY-MM-DD) from which on the price histories of the securities in my_bonds.yaml are fetched.'
+)
+parser.add_argument(
+    '--response-cache-mb', dest='response_cache_mb', type=float, default=32,
+    help='Memory in MB for caching rendered quote and historic tables (0 disables the cache).'
+)
+parser.add_argument(
+    '--sources', dest='sources', default='ariva',
+    help='Comma-separated price sources to fetch quotes from. With more than one, quotes are requested from the fastest one and, if it is slow or fails, from the next.'
+)
+parser.add_argument(
+    '--hedge-after', dest='hedge_after', type=float, default=None,
+    help='Seconds after which the next price source is asked as well (default: the 90th percentile of recent response times).'
+)
+parser.add_argument(
+    '--upstream-timeout', dest='upstream_timeout', type=float, default=10,
+    help='Seconds after which a request to a price source (or the ECB, for exchange rates) is given up.'
+)
+parser.add_argument(
+    '--request-timeout', dest='request_timeout', type=float, default=30,
+    help='Seconds within which a request is answered; price source requests made for it are given up once they are exhausted.'
+)
+parser.add_argument(
+    '--processes', dest='processes', type=int, default=0,
+    help='Number of worker processes answering requests. With 1 or more, all scraping is left to a separate updater process, which shares quotes with the workers through ~/.ppserve/shared.sqlite (0 serves from a single process).'
+)
+parser.add_argument(
+    '--trace', dest='trace', action='store_true',
+    help='Trace every request (see /traces); otherwise only requests with an X-PPServe-Trace header are traced.'
+)
+parser.add_argument(
+    '--profile-dir', dest='profile_dir', default=None,
+    help='Directory to which cProfile statistics of a sample of the requests (and of those with an X-PPServe-Profile header) are written.'
+)
+parser.add_argument(
+    '--profile-sample', dest='profile_sample', type=float, default=0.01,
+    help='Fraction of the requests profiled with --profile-dir.'
+)
+parser.add_argument(
+    '--prefetch-days', dest='prefetch_days', type=float, default=14,
+    help='Number of days requests are remembered in ~/.ppserve/access.log, to fetch frequently requested securities ahead of the requests expected next (0 disables this).'
+)
+parser.add_argument(
+    '--prefetch-lead', dest='prefetch_lead', type=float, default=120,
+    help='Seconds before an expected request that its security is fetched.'
+)
+parser.add_argument(
+    '--batch-workers', dest='batch_workers', type=int, default=8,
+    help='Number of securities fetched concurrently for a /batch/quote request.'
+)
 args = parser.parse_args()
 
-from datetime import date, timedelta
-from time import sleep
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
 from pathlib import Path
+from itertools import islice
+import hashlib
+import os
 import sys
-import collections
-from bottle import route, run, SimpleTemplate, abort, redirect, template
+from bottle import BaseRequest, Bottle, HTTPError, default_app, install, route, run, request, response, HTTPResponse, SimpleTemplate, abort, redirect, template, http_date, parse_date
+from math import ceil
 from threading import Thread
+from time import perf_counter
 
-from .price_sources import ArivaPriceSource
+from .price_sources import ArivaPriceSource, CompositePriceSource, price_source, sources, configured_sources
+from .price_sources.breaker import CircuitOpenError
 from .securities import Bond
+from .securities.util import currency_rates
+from .quote_cache import QuoteCache, SharedQuoteCache
+from .shared_store import SharedStore
+from .prefork import Prefork, ListeningPasteServer, UpdaterClient, listen
+from .response_cache import ResponseCache
+from .singleflight import SingleFlight
+from .scheduler import RefreshScheduler
+from .prefetch import AccessLog, Prefetcher
+from .metrics import Histogram, default_registry, labelled_symbols, mode_label
+from .deadline import deadline, carry
+from . import tracing
+from .tracing import Trace, Profiler, span
+
+ArivaPriceSource.historic_workers = args.fetch_workers
+ArivaPriceSource.connection_pool.max_per_host = args.max_connections_per_host
+ArivaPriceSource.connection_pool.timeout = args.upstream_timeout
+ArivaPriceSource.resolution_cache.max_age = args.resolution_cache_days*24*3600
+currency_rates.offline = args.offline
+currency_rates.timeout = args.upstream_timeout
+
+try:
+    history_start = datetime.strptime(args.history_start, '%Y-%m-%d').date()
+except ValueError:
+    parser.error('invalid --history-start {} (expected YYYY-MM-DD)'.format(args.history_start))
+
+unknown_sources = [name for name in args.sources.split(',') if name not in sources]
+if unknown_sources:
+    parser.error('unknown price source(s) {} (available: {})'.format(', '.join(unknown_sources), ', '.join(sources)))
+configured_sources[:] = args.sources.split(',')
+CompositePriceSource.hedge_after = args.hedge_after
 
 template_path = Path(__file__).parent/"templates"
 portfolio_performance_template = SimpleTemplate(
@@ -40,64 +168,335 @@ portfolio_performance_historical_template = SimpleTemplate(
 )
 
 my_bonds = {}
+# coalesces concurrent scrapes of the same symbol, keyed by ('info', symbol) and ('historic', symbol)
+scrapes = SingleFlight()
+# rendered quote and historic tables
+response_cache = ResponseCache(max_bytes=int(args.response_cache_mb*1024*1024))
+# the cached responses of securities are dropped once they change, those
+# converted between currencies once the exchange rates do
+currency_rates.on_change = response_cache.clear
+quote_cache = QuoteCache(my_bonds, ttl=args.quote_ttl, flight=scrapes, on_fetch=lambda sec: response_cache.invalidate(sec.symbol))
+# in prefork mode, where the updater process publishes securities for the workers
+shared_store = None
+# 'main' (the only process), or 'updater' or 'worker' in prefork mode
+process_role = 'main'
+# the requests seen, from which the prefetcher (run by the main or updater process) predicts the next ones
+access_log = None if args.prefetch_days <= 0 else AccessLog(Path.home()/'.ppserve'/'access.log')
+prefetcher = None
+
+request_seconds = Histogram(
+    'ppserve_request_seconds', 'Time to answer requests (for streamed tables, until streaming starts).',
+    labels=('route', 'mode', 'status')
+)
+render_seconds = Histogram(
+    'ppserve_render_seconds', 'Time spent rendering quote and historic tables.',
+    labels=('template',)
+)
+
+class RequestMetrics:
+    """
+    Bottle plugin recording the duration and status of every request in
+    request_seconds.
+    """
+
+    name = 'request_metrics'
+    api = 2
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            status = 500
+            try:
+                result = callback(*args, **kwargs)
+                status = response.status_code
+                return result
+            except HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                request_seconds.labels(route.rule, mode_label(kwargs.get('mode', '')), str(status)).observe(perf_counter() - started)
+        return wrapper
+
+install(RequestMetrics())
+
+class RequestDeadline:
+    """
+    Bottle plugin giving every request --request-timeout seconds, which all
+    price source requests made on its behalf have to keep to.
+    """
+
+    name = 'request_deadline'
+    api = 2
+
+    def apply(self, callback, route):
+        timeout = args.request_timeout
+
+        def wrapper(*args, **kwargs):
+            # in async mode, the time prepare_request took counts as well
+            started = request.environ.get('ppserve.started', perf_counter())
+            with deadline(timeout - (perf_counter() - started)):
+                return callback(*args, **kwargs)
+        return wrapper
+
+install(RequestDeadline())
+
+# samples requests for profiling, if --profile-dir is given
+profiler = None if args.profile_dir is None else Profiler(args.profile_dir, args.profile_sample)
+
+def header_set(environ, name):
+    return environ.get(name, '') not in ('', '0')
+
+def start_trace(environ):
+    """
+    Returns a new trace for the request, if it is to be traced.
+    """
+    if args.trace or header_set(environ, 'HTTP_X_PPSERVE_TRACE'):
+        return Trace('{} {}'.format(environ['REQUEST_METHOD'], environ['PATH_INFO']))
+    return None
+
+class RequestTracing:
+    """
+    Bottle plugin recording a trace of the request (see ppserve.tracing),
+    returned in the Server-Timing header and kept for /traces, and
+    profiling it if it was sampled. Untraced requests pass straight through.
+    """
+
+    name = 'request_tracing'
+    api = 2
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            environ = request.environ
+            # in async mode, prepare_request has already started the trace
+            trace = environ.get('ppserve.trace') or start_trace(environ)
+            profile = None if profiler is None else profiler.start(header_set(environ, 'HTTP_X_PPSERVE_PROFILE'))
+            if trace is None and profile is None:
+                return callback(*args, **kwargs)
+
+            name = '{} {}'.format(request.method, request.path)
+
+            def finish():
+                if profile is not None:
+                    profiler.stop(profile, name)
+                if trace is not None:
+                    tracing.record(trace)
+
+            try:
+                with tracing.activate(trace):
+                    result = callback(*args, **kwargs)
+            except BaseException:
+                finish()
+                raise
+
+            if trace is not None:
+                response.set_header('Server-Timing', trace.server_timing())
+            if hasattr(result, '__next__'):
+                # streamed tables are rendered after the route returned
+                return tracing.stream(result, trace, finish)
+            finish()
+            return result
+        return wrapper
+
+install(RequestTracing())
+
+def fetch_security(symbol):
+    """
+    Returns the security for symbol from the quote cache. If the price source
+    can't be reached, answers with 503 (with Retry-After while the circuit
+    breaker keeps it cut off) or, if it was too slow, 504.
+    """
+    try:
+        # in async mode, prepare_request has already fetched the security
+        if 'ppserve.error' in request.environ:
+            raise request.environ['ppserve.error']
+        sec = request.environ.get('ppserve.security')
+        if sec is None or sec.symbol != symbol:
+            sec = quote_cache.get(symbol, lambda: price_source(symbol).security())
+    except CircuitOpenError as e:
+        raise HTTPError(503, 'Price source unavailable: {}'.format(e), headers={'Retry-After': str(ceil(e.retry_after))})
+    except TimeoutError as e:
+        raise HTTPError(504, 'Price source did not answer in time: {}'.format(e))
+    return sec
 
 # Serve quote tables for Portfolio Performance
 @route('/<mode>/<symbol>/<clean_or_dirty>/<currency>')
 def serve_quote_table(mode, symbol, clean_or_dirty, currency):
-    if symbol in my_bonds.keys():
-        sec = my_bonds[symbol]
-        sec.update()
-    else:
-        sec = ArivaPriceSource(symbol).security()
-        my_bonds[symbol] = sec
+    with span('fetch', symbol=symbol):
+        sec = fetch_security(symbol)
+    refresh_scheduler.note_request(symbol)
+    if access_log is not None and mode in ['quote', 'historic', 'historical']:
+        access_log.record(symbol, 'quote' if mode == 'quote' else 'historic', currency)
+
+    if mode in ['quote', 'historic', 'historical']:
+        # refused before a client with a matching ETag could get a 304
+        if mode != 'quote':
+            window = historic_window()
+        if clean_or_dirty == 'dirty' and type(sec) != Bond:
+            abort(500, 'Dirty prices are only available for bonds.')
 
-    print(sec.pretty_print(target_currency=currency))
+        cache_key = (symbol, mode, clean_or_dirty, currency, request.query_string)
+        stamp, last_modified = response_stamp(sec, mode, clean_or_dirty, currency)
+        check_not_modified(cache_key + stamp, last_modified)
+
+        cached = response_cache.get(cache_key, stamp)
+        if cached is not None:
+            return cached
+
+    with span('pretty_print'):
+        print(sec.pretty_print(target_currency=currency))
 
     if mode == 'quote':
-        if clean_or_dirty == 'dirty':
-            if type(sec) is Bond:
-                # hi, lo, la = bond.dirty_high(currency), bond.dirty_low(currency), bond.dirty_last(currency)
-                # FIXME: last and low currently broken (ArivaPriceSource does not support it)
-                la = sec.dirty_last(currency)
-                hi = la
-                lo = la
-            else:
-                abort(500, 'Dirty prices are only available for bonds.')
-        else:
-            la = sec.last(currency)
-            hi = la
-            lo = la
+        # hi, lo, la = bond.dirty_high(currency), bond.dirty_low(currency), bond.dirty_last(currency)
+        # FIXME: last and low currently broken (ArivaPriceSource does not support it)
+        with span('price', currency=currency):
+            la = last_price(sec, clean_or_dirty, currency)
+        hi = la
+        lo = la
 
-        return portfolio_performance_template.render(
-            symbol = symbol,
-            name = sec.name,
-            url = sec.url,
-            date = sec.last_price_update,
-            high = hi,
-            low = lo,
-            last = la,
-            note = "All rates are {} and, if necessary, converted to {}.".format(clean_or_dirty, currency)
-        )
+        with render_seconds.labels('quote').time(), span('render', template='quote'):
+            body = portfolio_performance_template.render(
+                symbol = symbol,
+                name = sec.name,
+                url = sec.url,
+                date = sec.last_price_update,
+                high = hi,
+                low = lo,
+                last = la,
+                note = "All rates are {} and, if necessary, converted to {}.".format(clean_or_dirty, currency)
+            )
+        response_cache.put(cache_key, stamp, body)
+        return body
 
     if mode in ['historic', 'historical']:
-        if clean_or_dirty == 'dirty':
-            if type(sec) == Bond:
-                hist = collections.OrderedDict(sorted(sec.dirty_price_history(currency).items()))
+        with span('history', currency=currency):
+            if clean_or_dirty == 'dirty':
+                hist = sec.dirty_price_history(currency, **window)
             else:
-                abort(500, 'Dirty prices are only available for bonds.')
-        else:
-            hist = collections.OrderedDict(sorted(sec.price_history(currency).items()))
+                hist = sec.price_history(currency, **window)
 
-        return portfolio_performance_historical_template.render(
+        # the history is already sorted by date
+        return response_cache.tee(cache_key, stamp, render_historic_table(
+            hist,
             symbol = symbol,
             name = sec.name,
             url = sec.url,
-            price_history = hist,
             note = "All rates are {} and, if necessary, converted to {}.".format(clean_or_dirty, currency)
-        )
+        ))
 
     abort(404, "Please specify symbol, mode, and currency correctly.")
 
+def last_price(sec, clean_or_dirty, currency):
+    if clean_or_dirty == 'dirty':
+        if type(sec) is not Bond:
+            abort(500, 'Dirty prices are only available for bonds.')
+        return sec.dirty_last(currency)
+    return sec.last(currency)
+
+def response_stamp(sec, mode, clean_or_dirty, currency):
+    """
+    Returns the version stamps of all data a response about sec depends on,
+    and the time that data last changed. Neither the templates nor the
+    currency converter are touched.
+    """
+    # the version alone restarts at 0 with the process; last_modified doesn't
+    stamp = [sec.version, sec.last_modified]
+    last_modified = sec.last_modified
+
+    if mode != 'quote':
+        # the quote store outlives the process and can be changed by others
+        try:
+            store = os.stat(sec._quotes_path)
+            stamp.extend([store.st_size, store.st_mtime_ns])
+            last_modified = max(last_modified, store.st_mtime)
+        except FileNotFoundError:
+            stamp.append(None)
+    if sec.currency != currency:
+        # before reading the version, so the first conversion doesn't change it
+        currency_rates.load()
+        stamp.extend([currency_rates.version, currency_rates.updated])
+        last_modified = max(last_modified, currency_rates.updated or 0)
+    if mode == 'quote' and (clean_or_dirty == 'dirty' or sec.currency != currency):
+        # accrued interest and exchange rates are those of the current date
+        today = date.today()
+        stamp.append(today)
+        last_modified = max(last_modified, datetime.combine(today, datetime.min.time()).timestamp())
+
+    return tuple(stamp), last_modified
+
+def check_not_modified(key, last_modified):
+    """
+    Sets the ETag (derived from key) and Last-Modified headers of the
+    response and answers with 304 Not Modified if the client's copy is still
+    current.
+    """
+    headers = {
+        'ETag': '"{}"'.format(hashlib.sha1(repr(key).encode()).hexdigest()[:20]),
+        'Last-Modified': http_date(last_modified)
+    }
+
+    if_none_match = request.get_header('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        not_modified = '*' in tags or headers['ETag'] in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    else:
+        if_modified_since = parse_date(request.get_header('If-Modified-Since', ''))
+        not_modified = if_modified_since is not None and int(last_modified) <= if_modified_since
+
+    if not_modified:
+        raise HTTPResponse(status=304, headers=headers)
+
+    for name, value in headers.items():
+        response.set_header(name, value)
+
+# number of table rows rendered per chunk of a streamed historic table
+historic_chunk_size = 500
+
+def historic_window():
+    """
+    Parses the optional 'from' and 'to' (YYYY-MM-DD) and 'limit' (most recent
+    number of quotes) query parameters of historic requests.
+    """
+    window = {}
+    try:
+        if request.query.get('from'):
+            window['start_date'] = datetime.strptime(request.query.get('from'), '%Y-%m-%d').date()
+        if request.query.get('to'):
+            window['end_date'] = datetime.strptime(request.query.get('to'), '%Y-%m-%d').date()
+        if request.query.get('limit'):
+            window['limit'] = int(request.query.get('limit'))
+    except ValueError as e:
+        abort(400, 'Invalid query parameter: {}'.format(e))
+    if window.get('limit', 0) < 0:
+        abort(400, 'limit must not be negative.')
+    return window
+
+def render_historic_table(hist, **kwargs):
+    """
+    Renders the historic table chunk by chunk, so bottle can stream it.
+    """
+    rows = iter(hist.items())
+    # time spent rendering, not waiting for the client
+    rendering = 0.0
+
+    def render(**parts):
+        nonlocal rendering
+        started = perf_counter()
+        with span('render', template='historic'):
+            part = portfolio_performance_historical_template.render(**parts, **kwargs)
+        rendering += perf_counter() - started
+        return part
+
+    try:
+        yield render(head=True, foot=False, rows=())
+        while True:
+            chunk = list(islice(rows, historic_chunk_size))
+            if not chunk:
+                break
+            yield render(head=False, foot=False, rows=chunk)
+        yield render(head=False, foot=True, rows=())
+    finally:
+        render_seconds.labels('historic').observe(rendering)
+
 # allow omission of the currency...
 @route('/<mode>/<symbol>/<clean_or_dirty>')
 def redirect_to_default_currency(mode, symbol, clean_or_dirty):
@@ -108,59 +507,403 @@ def redirect_to_default_currency(mode, symbol, clean_or_dirty):
 def redirect_to_default_mode(mode, symbol):
     return serve_quote_table(mode, symbol, 'clean', args.default_currency)
 
+# number of securities a batch request fetches concurrently
+batch_workers = args.batch_workers
+# maximum number of symbols per batch request
+batch_max_symbols = 1000
+
+def batch_symbols(query):
+    """
+    Returns the symbols of a batch request, given comma-separated in one or
+    more 'symbols' query parameters, without duplicates.
+    """
+    symbols = []
+    for param in query.getall('symbols'):
+        symbols += [symbol.strip() for symbol in param.split(',') if symbol.strip()]
+    symbols = list(dict.fromkeys(symbols))
+
+    if not symbols:
+        abort(400, 'Please specify symbols, e.g. ?symbols=A0B1C2,DE0001102374.')
+    if len(symbols) > batch_max_symbols:
+        abort(400, 'At most {} symbols can be requested at once.'.format(batch_max_symbols))
+    return symbols
+
+def fetch_batch(symbols):
+    """
+    Fetches the securities for symbols through the quote cache, at most
+    batch_workers at a time. Returns a dict of symbol -> security, or the
+    exception raised while fetching it.
+    """
+    def fetch(symbol):
+        try:
+            return quote_cache.get(symbol, lambda: price_source(symbol).security())
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=min(batch_workers, len(symbols)), thread_name_prefix='batch') as executor:
+        return dict(zip(symbols, executor.map(carry(fetch), symbols)))
+
+async def fetch_batch_async(symbols):
+    slots = asyncio.Semaphore(batch_workers)
+
+    async def fetch(symbol):
+        async with slots:
+            try:
+                return await quote_cache.get_async(symbol, lambda: price_source(symbol).security_async())
+            except Exception as e:
+                return e
+
+    return dict(zip(symbols, await asyncio.gather(*(fetch(symbol) for symbol in symbols))))
+
+@route('/batch/quote')
+def serve_batch_quotes():
+    """
+    Returns the quotes of several securities as one JSON document, e.g. for
+    /batch/quote?symbols=A0B1C2,DE0001102374&currency=USD&clean_or_dirty=dirty.
+    Securities that are not cached are fetched concurrently, so the request
+    takes about as long as the slowest of them. Symbols that fail are listed
+    under 'errors' instead of failing the whole request.
+    """
+    symbols = batch_symbols(request.query)
+    currency = request.query.get('currency') or args.default_currency
+    clean_or_dirty = request.query.get('clean_or_dirty') or 'clean'
+    if clean_or_dirty not in ('clean', 'dirty'):
+        abort(400, "clean_or_dirty must be 'clean' or 'dirty'.")
+
+    # in async mode, prepare_request has already fetched the securities
+    fetched = request.environ.get('ppserve.batch')
+    if fetched is None:
+        fetched = fetch_batch(symbols)
+
+    quotes = {}
+    errors = {}
+    for symbol in symbols:
+        refresh_scheduler.note_request(symbol)
+        try:
+            sec = fetched[symbol]
+            if isinstance(sec, Exception):
+                raise sec
+            last = last_price(sec, clean_or_dirty, currency)
+            if access_log is not None:
+                access_log.record(symbol, 'quote', currency)
+            quotes[symbol] = {
+                'name': sec.name,
+                'url': getattr(sec.url, 'full_url', sec.url),
+                'date': sec.last_price_update.isoformat() if sec.last_price_update else None,
+                'last': None if last is None else float(last)
+            }
+        except HTTPResponse as e:
+            errors[symbol] = e.body
+        except Exception as e:
+            errors[symbol] = '{}: {}'.format(type(e).__name__, e)
+
+    return {
+        'currency': currency,
+        'clean_or_dirty': clean_or_dirty,
+        'quotes': quotes,
+        'errors': errors
+    }
+
+@route('/stats')
+def serve_stats():
+    return {
+        'process': {'role': process_role, 'pid': os.getpid()},
+        'quote_cache': quote_cache.info(),
+        'response_cache': response_cache.info(),
+        'scrapes': scrapes.info(),
+        'scheduler': refresh_scheduler.info(),
+        'sources': {name: stats.info() for name, stats in CompositePriceSource.source_stats.items()},
+        'upstream': ArivaPriceSource.connection_pool.breaker.info(),
+        'prefetch': None if prefetcher is None else prefetcher.info()
+    }
+
+@route('/traces', skip=['request_tracing'])
+def serve_traces():
+    """
+    Returns the most recent traces, newest first.
+    """
+    return {'traces': [trace.to_dict() for trace in reversed(list(tracing.recent))]}
+
+@route('/metrics')
+def serve_metrics():
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return default_registry.expose()
+
+@default_registry.collector
+def collect_metrics():
+    """
+    Exports the state of the caches, the updater and the loaded securities.
+    """
+    # per symbol only for the configured securities, see ppserve.metrics.labelled_symbols
+    history_sizes = [
+        ({'symbol': sec.symbol}, len(sec._price_history)) for sec in list(my_bonds.values())
+        if sec.history_loaded and sec.symbol in labelled_symbols
+    ]
+    yield 'ppserve_history_quotes', 'gauge', 'Number of quotes in the price history of each loaded configured security.', history_sizes
+
+    cache = quote_cache.info()
+    yield 'ppserve_quote_cache_lookups_total', 'counter', 'Quote cache lookups by result.', [
+        ({'result': result}, cache[result]) for result in ('hits', 'stale_hits', 'misses')
+    ]
+    yield 'ppserve_quote_cache_refresh_errors_total', 'counter', 'Failed background refreshes of stale quotes.', [({}, cache['refresh_errors'])]
+    yield 'ppserve_quote_cache_fallbacks_total', 'counter', 'Last known quotes served because the price source was unavailable.', [({}, cache['fallbacks'])]
+    yield 'ppserve_quote_cache_size', 'gauge', 'Number of fetched quotes.', [({}, cache['size'])]
+
+    responses = response_cache.info()
+    yield 'ppserve_response_cache_lookups_total', 'counter', 'Rendered response cache lookups by result.', [
+        ({'result': result}, responses[result]) for result in ('hits', 'misses')
+    ]
+    yield 'ppserve_response_cache_invalidations_total', 'counter', 'Cached responses dropped because their data changed.', [({}, responses['invalidations'])]
+    yield 'ppserve_response_cache_evictions_total', 'counter', 'Cached responses evicted to stay within the memory limit.', [({}, responses['evictions'])]
+    yield 'ppserve_response_cache_bytes', 'gauge', 'Size of the cached responses.', [({}, responses['bytes'])]
+    yield 'ppserve_response_cache_entries', 'gauge', 'Number of cached responses.', [({}, responses['entries'])]
+
+    breaker = ArivaPriceSource.connection_pool.breaker.info()
+    yield 'ppserve_upstream_circuit_open', 'gauge', 'Whether requests to a price source host are cut off (1) or not (0).', [
+        ({'host': host}, int(circuit['state'] != 'closed')) for host, circuit in breaker['hosts'].items()
+    ]
+    yield 'ppserve_upstream_circuit_trips_total', 'counter', 'Times a price source host was cut off after failing repeatedly.', [({}, breaker['trips'])]
+    yield 'ppserve_upstream_rejected_total', 'counter', 'Requests to price source hosts not made because they were cut off.', [({}, breaker['rejected'])]
+
+    flight = scrapes.info()
+    yield 'ppserve_scrapes_total', 'counter', 'Scrapes run; requests that joined one already in flight are counted by ppserve_scrapes_shared_total instead.', [({}, flight['calls'])]
+    yield 'ppserve_scrapes_shared_total', 'counter', 'Scrapes that joined one already in flight.', [({}, flight['shared'])]
+
+    updater = refresh_scheduler.info()
+    yield 'ppserve_updater_runs_total', 'counter', 'Background price history updates run.', [({}, updater['runs'])]
+    yield 'ppserve_updater_errors_total', 'counter', 'Background price history updates that failed.', [({}, updater['errors'])]
+    yield 'ppserve_updater_running', 'gauge', 'Background price history updates currently running.', [({}, len(updater['running']))]
+    yield 'ppserve_updater_queued', 'gauge', 'Securities waiting for their next background update.', [({}, updater['queued'])]
+    yield 'ppserve_updater_last_duration_seconds', 'gauge', 'Duration of the last background update of each configured security.', [
+        ({'symbol': symbol}, duration) for symbol, duration in updater['durations'].items() if symbol in labelled_symbols
+    ]
+
+    if prefetcher is not None:
+        prefetch = prefetcher.info()
+        yield 'ppserve_prefetch_hot_securities', 'gauge', 'Securities requested often enough to be fetched ahead of requests.', [({}, prefetch['hot'])]
+        yield 'ppserve_prefetch_warmed_total', 'counter', 'Securities warmed ahead of an expected request.', [({}, prefetch['warmed'])]
+        yield 'ppserve_prefetch_errors_total', 'counter', 'Securities that could not be warmed.', [({}, prefetch['errors'])]
+
+async def prepare_request(environ):
+    """
+    Used by the async server: fetches the security a request is about on the
+    event loop before the request is routed, so serve_quote_table won't block.
+    """
+    environ['ppserve.started'] = perf_counter()
+    trace = environ['ppserve.trace'] = start_trace(environ)
+    with deadline(args.request_timeout), tracing.activate(trace):
+        await _prepare_request(environ)
+
+async def _prepare_request(environ):
+    try:
+        matched, url_args = default_app().router.match(environ)
+    except HTTPResponse:
+        return
+
+    if matched.callback is serve_batch_quotes:
+        try:
+            symbols = batch_symbols(BaseRequest(environ).query)
+        except HTTPResponse:
+            # the route answers with the error
+            return
+        fetched = environ['ppserve.batch'] = await fetch_batch_async(symbols)
+        currency = BaseRequest(environ).query.get('currency') or args.default_currency
+        await preload([sec for sec in fetched.values() if not isinstance(sec, Exception)], 'quote', currency)
+        return
+
+    symbol = url_args.get('symbol')
+    if symbol is None:
+        return
+
+    try:
+        sec = environ['ppserve.security'] = await quote_cache.get_async(symbol, lambda: price_source(symbol).security_async())
+    except Exception as e:
+        environ['ppserve.error'] = e
+        return
+    await preload([sec], url_args.get('mode'), url_args.get('currency') or args.default_currency)
+
+async def preload(secs, mode, currency):
+    """
+    Reads what the route would otherwise read from disk or download on the
+    event loop, blocking all other requests: the exchange rates and the
+    price histories.
+    """
+    loop = asyncio.get_running_loop()
+    if not currency_rates.loaded and any(sec.currency != currency for sec in secs):
+        await loop.run_in_executor(None, carry(currency_rates.load))
+    if mode in ['historic', 'historical']:
+        for sec in secs:
+            if not sec.history_loaded:
+                await loop.run_in_executor(None, carry(sec.load_history))
+
 def update_sec_prices(sec):
-    start_date = None
+    # several updater runs for the same security share one fetch
+    scrapes.do(('historic', sec.symbol), lambda: _update_sec_prices(sec))
 
-    if not sec._price_history:
-        start_date = date(2015,12,10)
-    else:
-        last_quote_date = max(sec._price_history.keys())
-        if (date.today() - last_quote_date).days > 0:
-            start_date = last_quote_date + timedelta(days=1)
+def _update_sec_prices(sec):
+    try:
+        # only months that weren't completely fetched before, and the current one
+        sec.update_historic_missing(history_start, date.today())
+    finally:
+        response_cache.invalidate(sec.symbol)
+        if shared_store is not None:
+            shared_store.publish(sec, history=True)
 
-    if start_date:
-        sec.update_historic(start_date, date.today())
-        sec.write_quotes()
+# keeps the price histories of the configured securities up to date
+refresh_scheduler = RefreshScheduler(
+    update_sec_prices,
+    workers=args.updater_workers,
+    interval=args.update_interval*3600,
+    rate=args.update_rate
+)
 
-def main():
-    global my_bonds
+# Served by the updater process to the worker processes in prefork mode:
+# fetches the quote of a security and publishes it in the shared store.
+control_app = Bottle()
 
-    import logging
-    import coloredlogs
-    # logging.basicConfig(format='%(levelname)s: %(name)s: %(message)s', level=getattr(logging, args.log_level))
-    logger = logging.getLogger('Main')
-    coloredlogs.install(level=getattr(logging, args.log_level))
+@control_app.route('/fetch/<symbol>')
+def serve_updater_fetch(symbol):
+    refresh_scheduler.note_request(symbol)
+    try:
+        with deadline(float(request.query.get('timeout') or args.request_timeout)):
+            quote_cache.get(symbol, lambda: price_source(symbol).security())
+    except CircuitOpenError as e:
+        response.status = 503
+        return {'error': str(e), 'host': e.host, 'retry_after': e.retry_after}
+    except TimeoutError as e:
+        response.status = 504
+        return {'error': str(e)}
+    except Exception as e:
+        response.status = 500
+        return {'error': '{}: {}'.format(type(e).__name__, e)}
+    return {}
 
+def publish_quote(sec):
+    shared_store.publish(sec, fetched=True)
+
+def load_configured_securities(logger):
     logger.info('Loading manually configured securities.')
     from .my_bonds import load_my_bonds
     yaml_file = Path.home()/'.ppserve'/'my_bonds.yaml'
 
     try:
-        my_bonds = load_my_bonds(yaml_file)
+        my_bonds.update(load_my_bonds(yaml_file))
+        labelled_symbols.update(my_bonds)
         logger.info('Found configuration in {}'.format(str(yaml_file)))
     except FileNotFoundError:
         logger.info('No my_bonds.yaml found.')
 
-    try:
-        Thread(
-            target=run, name="price server",
-            kwargs={'server': 'paste', 'host': args.hostname, 'port': args.port}
-        ).start()
+def prefetch(symbol, keys, ahead):
+    """
+    Prepares for requests for symbol with the (mode, currency) pairs in
+    keys, expected in ahead seconds: fetches its quote (resolving the symbol
+    if it is new), keeps its price history up to date in the background and
+    loads the exchange rates.
+    """
+    sec = quote_cache.prefetch(symbol, lambda: price_source(symbol).security(), ahead)
+    if any(mode == 'historic' for mode, _ in keys):
+        # like the configured securities, from now on
+        refresh_scheduler.add(sec)
+        refresh_scheduler.note_request(symbol)
+    if any(currency != sec.currency for _, currency in keys):
+        currency_rates.load()
 
-        updater_threads = []
+def start_updates():
+    global prefetcher
+    # exchange rates are loaded on first use; keep them up to date from then on
+    currency_rates.start_refresher()
 
-        while True:
-            # Update bond price history if needed
-            for sec in my_bonds.values():
-                t = Thread(
-                    target=update_sec_prices,
-                    name="historical price updater for {}".format(sec.symbol),
-                    kwargs={'sec': sec}
-                )
-                updater_threads.append(t)
-                t.start()
-
-            sleep(3*3600) # wait for 3 hours
+    # Update bond price history if needed
+    for sec in my_bonds.values():
+        refresh_scheduler.add(sec)
+    refresh_scheduler.start()
+
+    # warm the securities Portfolio Performance requests regularly
+    if access_log is not None:
+        prefetcher = Prefetcher(access_log, prefetch, days=args.prefetch_days, lead=args.prefetch_lead)
+        prefetcher.start()
+
+def server_options(listener=None):
+    """
+    Returns the arguments for bottle's run(), for serving on listener if one
+    is given.
+    """
+    options = {'server': 'paste', 'host': args.hostname, 'port': args.port}
+    if args.server == 'async':
+        from .async_server import AsyncServer
+        options.update(server=AsyncServer, prepare=prepare_request)
+        if listener is not None:
+            options['sock'] = listener
+    elif listener is not None:
+        options.update(server=ListeningPasteServer, listener=listener)
+    return options
+
+def serve_prefork(logger):
+    """
+    Serves from --processes worker processes, leaving the scraping to one
+    updater process (see ppserve.prefork).
+    """
+    global shared_store
+    shared_store = SharedStore(Path.home()/'.ppserve'/'shared.sqlite')
+
+    # before forking, so no process has to download them on its own
+    currency_rates.load()
+
+    listener = listen(args.hostname, args.port)
+    control = listen('127.0.0.1', 0)
+    control_url = 'http://127.0.0.1:{}'.format(control.getsockname()[1])
+
+    def updater():
+        global process_role
+        process_role = 'updater'
+        listener.close()
+
+        load_configured_securities(logger)
+        quote_cache.on_fetch = publish_quote
+        start_updates()
+        run(app=control_app, server=ListeningPasteServer, listener=control, quiet=True)
+
+    def worker():
+        global process_role, quote_cache
+        process_role = 'worker'
+        control.close()
+
+        # the updater downloads new exchange rates, the workers pick them up from its cache
+        currency_rates.offline = True
+        currency_rates.start_refresher()
+        quote_cache = SharedQuoteCache(
+            my_bonds, shared_store, UpdaterClient(control_url, timeout=args.request_timeout).fetch,
+            ttl=args.quote_ttl, flight=scrapes, on_reload=lambda sec: response_cache.invalidate(sec.symbol)
+        )
+        run(quiet=True, **server_options(listener))
+
+    Prefork(updater, worker, args.processes).run()
+
+def main():
+    import logging
+    import coloredlogs
+    # logging.basicConfig(format='%(levelname)s: %(name)s: %(message)s', level=getattr(logging, args.log_level))
+    logger = logging.getLogger('Main')
+    coloredlogs.install(level=getattr(logging, args.log_level))
+
+    if args.clear_resolution_cache:
+        logger.info('Clearing cached symbol resolutions.')
+        ArivaPriceSource.resolution_cache.invalidate()
+
+    if args.processes > 0:
+        serve_prefork(logger)
+        return
+
+    load_configured_securities(logger)
+    start_updates()
+
+    try:
+        server_thread = Thread(
+            target=run, name="price server",
+            kwargs=server_options()
+        )
+        server_thread.start()
+        server_thread.join()
 
     except KeyboardInterrupt:
         sys.exit()
@@ -0,0 +1,319 @@
+import bisect
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from statistics import median
+from threading import Lock, Thread
+from time import sleep, time
+
+class AccessLog:
+    """
+    Compact log of the requested (symbol, mode, currency) tuples, kept in
+    path as lines "<unix time> <symbol> <mode> <currency>". A tuple is logged
+    at most once every resolution seconds. Lines are appended with single
+    O_APPEND writes, so several processes can log to the same file.
+    """
+
+    def __init__(self, path, resolution=60):
+        self.path = path
+        self.resolution = resolution
+
+        # (symbol, mode, currency) -> when it was last logged
+        self._logged = {}
+        self._lock = Lock()
+
+        self.logger = logging.getLogger('AccessLog')
+
+    def record(self, symbol, mode, currency):
+        key = (symbol, mode, currency)
+        if any(not field or field.split() != [field] for field in key):
+            # can't be told apart in the log
+            return
+
+        now = time()
+        with self._lock:
+            last = self._logged.get(key)
+            if last is not None and now - last < self.resolution:
+                return
+            self._logged[key] = now
+
+        line = '{:.0f} {} {} {}\n'.format(now, *key).encode()
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def parse(lines):
+        """
+        Yields the (time, symbol, mode, currency) entries in lines, skipping
+        malformed ones (e.g. a line cut off by a crash).
+        """
+        for line in lines:
+            fields = line.split()
+            if len(fields) != 4:
+                continue
+            try:
+                yield (float(fields[0]), *fields[1:])
+            except ValueError:
+                continue
+
+    def read(self, offset=0):
+        """
+        Returns the entries after byte offset and the offset of the end of the
+        last complete line.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return [], 0
+        # a line that is still being written is read next time
+        end = data.rfind(b'\n') + 1
+        return list(self.parse(data[:end].decode(errors='replace').splitlines())), offset + end
+
+    def compact(self, since):
+        """
+        Drops the entries older than since and returns the remaining ones and
+        the size of the compacted log. Entries logged by other processes
+        while the log is rewritten may get lost.
+        """
+        entries, _ = self.read()
+        entries = sorted(entry for entry in entries if entry[0] >= since)
+
+        tmp_path = '{}.tmp'.format(self.path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            for entry in entries:
+                f.write('{:.0f} {} {} {}\n'.format(*entry))
+        os.replace(tmp_path, self.path)
+        return entries, os.path.getsize(self.path)
+
+class Prefetcher:
+    """
+    Warms the securities that are requested regularly (the hot set, read
+    from an AccessLog) shortly before they are expected to be requested
+    again, and all of them on start.
+
+    Requests are expected
+    - at the usual interval within a session of polls (polls at most
+      session_gap seconds apart), as long as the session goes on, and
+    - at the times of day sessions started on at least two of the last days.
+
+    warm(symbol, keys, ahead) is called lead seconds before an expected
+    request, with the (mode, currency) pairs the symbol was requested with
+    and the seconds until the request (0 on start).
+    """
+
+    def __init__(self, log, warm, days=14, lead=120, max_symbols=100, min_requests=2,
+                 session_gap=2*3600, check_interval=15, workers=4):
+        self.log = log
+        self.warm = warm
+        self.days = days
+        self.lead = lead
+        self.max_symbols = max_symbols
+        self.min_requests = min_requests
+        self.session_gap = session_gap
+        self.check_interval = check_interval
+
+        # symbol -> request times, at least log.resolution apart
+        self._polls = {}
+        # symbol -> {(mode, currency): last requested}
+        self._keys = {}
+        # symbol -> (interval within sessions or None, session start times of day)
+        self._models = {}
+        # symbol -> when it was last warmed
+        self._warmed = {}
+        self._warming = set()
+        self._offset = 0
+        self._compacted = None
+        self._lock = Lock()
+
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+
+        self.stats = {
+            'warmed': 0,
+            'errors': 0
+        }
+
+        self.logger = logging.getLogger('Prefetcher')
+
+    def _add(self, entries):
+        for t, symbol, mode, currency in entries:
+            polls = self._polls.setdefault(symbol, [])
+            # processes may log out of order
+            i = bisect.bisect(polls, t)
+            if (i == 0 or t - polls[i - 1] >= self.log.resolution) and (i == len(polls) or polls[i] - t >= self.log.resolution):
+                polls.insert(i, t)
+            keys = self._keys.setdefault(symbol, {})
+            keys[(mode, currency)] = max(t, keys.get((mode, currency), t))
+            self._models.pop(symbol, None)
+
+    def _compact(self):
+        since = time() - self.days*24*3600
+        entries, size = self.log.compact(since)
+        with self._lock:
+            self._polls.clear()
+            self._keys.clear()
+            self._models.clear()
+            self._add(entries)
+            self._offset = size
+        self._compacted = datetime.now().date()
+
+    def _read(self):
+        try:
+            size = os.path.getsize(self.log.path)
+        except FileNotFoundError:
+            size = 0
+        if size < self._offset:
+            # replaced by someone else, start over
+            self._offset = 0
+            with self._lock:
+                self._polls.clear()
+                self._keys.clear()
+                self._models.clear()
+        entries, self._offset = self.log.read(self._offset)
+        with self._lock:
+            self._add(entries)
+
+    def hot(self):
+        """
+        Returns the symbols requested at least min_requests times, the most
+        requested ones first.
+        """
+        with self._lock:
+            counts = {symbol: len(polls) for symbol, polls in self._polls.items() if len(polls) >= self.min_requests}
+        return sorted(counts, key=counts.get, reverse=True)[:self.max_symbols]
+
+    def _model(self, polls):
+        recent = polls[-11:]
+        gaps = [b - a for a, b in zip(recent, recent[1:]) if b - a < self.session_gap]
+        interval = median(gaps) if len(gaps) >= 2 else None
+
+        # the times of day sessions start at on different days, clustered by half hours
+        starts = [polls[0]] + [b for a, b in zip(polls, polls[1:]) if b - a >= self.session_gap]
+        clusters = []
+        for t in sorted(starts, key=self._time_of_day):
+            if clusters and self._time_of_day(t) - self._time_of_day(clusters[-1][-1]) < 1800:
+                clusters[-1].append(t)
+            else:
+                clusters.append([t])
+        times_of_day = [
+            median(self._time_of_day(t) for t in cluster) for cluster in clusters
+            if len({datetime.fromtimestamp(t).date() for t in cluster}) >= 2
+        ]
+        return interval, times_of_day
+
+    @staticmethod
+    def _time_of_day(t):
+        d = datetime.fromtimestamp(t)
+        return d.hour*3600 + d.minute*60 + d.second
+
+    def predict(self, symbol, now=None):
+        """
+        Returns when symbol is expected to be requested next, or None.
+        """
+        now = time() if now is None else now
+        with self._lock:
+            polls = self._polls.get(symbol)
+            if not polls:
+                return None
+            if symbol not in self._models:
+                self._models[symbol] = self._model(polls)
+            interval, times_of_day = self._models[symbol]
+            last = polls[-1]
+
+        expected = []
+        if interval is not None and now - last < self.session_gap:
+            # the next poll of the running session, even if some were missed
+            expected.append(last + interval*max(1, -(-(now - last)//interval)))
+        midnight = datetime.combine(datetime.fromtimestamp(now).date(), datetime.min.time())
+        for seconds in times_of_day:
+            t = (midnight + timedelta(seconds=seconds)).timestamp()
+            if t <= now:
+                t = (midnight + timedelta(days=1, seconds=seconds)).timestamp()
+            expected.append(t)
+        return min(expected) if expected else None
+
+    def _submit(self, symbol, ahead):
+        with self._lock:
+            if symbol in self._warming:
+                return
+            self._warming.add(symbol)
+            self._warmed[symbol] = time()
+            keys = list(self._keys[symbol])
+        self._pool.submit(self._warm, symbol, keys, ahead)
+
+    def _warm(self, symbol, keys, ahead):
+        self.logger.debug('Warming {} ({})'.format(symbol, ', '.join('{} {}'.format(*key) for key in keys)))
+        try:
+            self.warm(symbol, keys, ahead)
+            with self._lock:
+                self.stats['warmed'] += 1
+        except Exception as e:
+            self.logger.warning('Could not warm {}: {}'.format(symbol, e))
+            with self._lock:
+                self.stats['errors'] += 1
+        finally:
+            with self._lock:
+                self._warming.discard(symbol)
+
+    def check(self, now=None):
+        """
+        Warms the hot securities that are expected to be requested within
+        lead seconds and weren't warmed for that yet.
+        """
+        now = time() if now is None else now
+        for symbol in self.hot():
+            expected = self.predict(symbol, now)
+            if expected is None or expected - self.lead > now:
+                continue
+            with self._lock:
+                warmed = self._warmed.get(symbol, 0)
+            if warmed < expected - self.lead:
+                self._submit(symbol, max(0, expected - now))
+
+    def _run(self):
+        try:
+            self._compact()
+        except OSError as e:
+            self.logger.warning('Could not compact {}: {}'.format(self.log.path, e))
+        hot = self.hot()
+        self.logger.info('Warming {} frequently requested securities.'.format(len(hot)))
+        for symbol in hot:
+            self._submit(symbol, 0)
+
+        while True:
+            sleep(self.check_interval)
+            try:
+                # also forgets requests older than days, once a day
+                if self._compacted != datetime.now().date():
+                    self._compact()
+                else:
+                    self._read()
+                self.check()
+            except Exception:
+                self.logger.exception('Prefetching failed')
+
+    def start(self):
+        Thread(target=self._run, name="prefetcher", daemon=True).start()
+
+    def info(self):
+        now = time()
+        hot = self.hot()
+        expected = {symbol: self.predict(symbol, now) for symbol in hot}
+        with self._lock:
+            return {
+                'hot': len(hot),
+                'next_expected': {symbol: round(t - now, 1) for symbol, t in expected.items() if t is not None},
+                'warming': len(self._warming),
+                'warmed': self.stats['warmed'],
+                'errors': self.stats['errors']
+            }
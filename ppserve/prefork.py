@@ -0,0 +1,187 @@
+import http.client
+import json
+import logging
+import os
+import signal
+import socket
+import urllib.parse
+from threading import Thread
+from time import sleep
+from bottle import ServerAdapter
+
+from .deadline import remaining
+from .price_sources.breaker import CircuitOpenError
+
+def listen(host, port, backlog=128):
+    """
+    Returns a socket listening on host and port, to be inherited by forked
+    processes.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return socket.create_server((host, port), family=family, backlog=backlog)
+
+class Prefork:
+    """
+    Runs the server as several processes forked from the calling one: a
+    single updater process, which does all scraping, and a number of worker
+    processes answering requests on a shared listening socket. The calling
+    process only supervises them; children that exit are restarted after
+    restart_delay seconds, and all of them are stopped on SIGINT or SIGTERM.
+
+    updater() and worker() are run in the respective child processes and are
+    not supposed to return. Nothing may start threads before run(), as they
+    would not survive the fork.
+    """
+
+    def __init__(self, updater, worker, workers, restart_delay=1):
+        self.updater = updater
+        self.worker = worker
+        self.workers = workers
+        self.restart_delay = restart_delay
+
+        # pid -> (role, target)
+        self._children = {}
+        self._pid = os.getpid()
+
+        self.logger = logging.getLogger('Prefork')
+
+    def _spawn(self, role, target):
+        pid = os.fork()
+        if pid != 0:
+            self._children[pid] = (role, target)
+            return
+
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            Thread(target=self._watch_parent, name="parent watcher", daemon=True).start()
+            target()
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            self.logger.exception('{} process {} failed'.format(role.capitalize(), os.getpid()))
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def _watch_parent(self):
+        # don't keep serving if the supervisor was killed
+        while os.getppid() == self._pid:
+            sleep(1)
+        os._exit(0)
+
+    def _stop(self, signum, frame):
+        raise SystemExit()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+
+        self._spawn('updater', self.updater)
+        for _ in range(self.workers):
+            self._spawn('worker', self.worker)
+        self.logger.info('Started an updater and {} worker processes.'.format(self.workers))
+
+        try:
+            while True:
+                pid, status = os.wait()
+                role, target = self._children.pop(pid)
+                self.logger.warning('{} process {} exited with status {}, restarting it.'.format(
+                    role.capitalize(), pid, os.waitstatus_to_exitcode(status)
+                ))
+                sleep(self.restart_delay)
+                self._spawn(role, target)
+        except (KeyboardInterrupt, SystemExit):
+            self.logger.info('Stopping all processes.')
+        finally:
+            for pid in self._children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in self._children:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+
+class ListeningPasteServer(ServerAdapter):
+    """
+    Bottle server adapter for paste's threaded server, accepting connections
+    on an already listening socket (the 'listener' option) instead of binding
+    its own. Several processes can share one listener that way.
+    """
+
+    def run(self, handler):
+        from paste import httpserver
+        from paste.translogger import TransLogger
+
+        listener = self.options.pop('listener')
+        # processes compete for connections; those that lose must not block in accept()
+        listener.setblocking(False)
+
+        class Server(httpserver.WSGIThreadPoolServer):
+
+            def server_bind(self):
+                self.socket.close()
+                self.socket = listener
+                self.server_address = listener.getsockname()
+                self.server_name = self.server_address[0]
+                self.server_port = self.server_address[1]
+
+            def server_activate(self):
+                pass
+
+        handler = TransLogger(handler, setup_console_handler=(not self.quiet))
+        server = Server(handler, listener.getsockname(), httpserver.WSGIHandler, **self.options)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+class UpdaterError(Exception):
+    """
+    Raised if the updater process failed to fetch a security for a worker.
+    """
+
+class UpdaterClient:
+    """
+    Used by the worker processes to have the updater process fetch the quote
+    of a security and store it (see SharedQuoteCache). Errors are raised as
+    they were in the updater, as far as the workers distinguish them:
+    CircuitOpenError, TimeoutError or else UpdaterError.
+    """
+
+    def __init__(self, url, timeout=60):
+        self.url = url
+        self.timeout = timeout
+
+    def fetch(self, symbol):
+        # the updater gets the rest of the request's deadline, and a little longer to answer
+        timeout = remaining(self.timeout)
+        parts = urllib.parse.urlsplit(self.url)
+        conn = http.client.HTTPConnection(parts.netloc, timeout=timeout + 1)
+        try:
+            conn.request('GET', '/fetch/{}?{}'.format(
+                urllib.parse.quote(symbol, safe=''), urllib.parse.urlencode({'timeout': timeout})
+            ))
+            response = conn.getresponse()
+            body = response.read()
+        except TimeoutError:
+            raise TimeoutError('The updater did not answer within {:.1f}s'.format(timeout + 1)) from None
+        except OSError as e:
+            raise UpdaterError('Could not reach the updater: {}'.format(e)) from e
+        finally:
+            conn.close()
+
+        if response.status == 200:
+            return
+        try:
+            error = json.loads(body)
+        except ValueError:
+            raise UpdaterError('The updater answered {} {}'.format(response.status, response.reason)) from None
+        if 'retry_after' in error:
+            raise CircuitOpenError(error['host'], error['retry_after'])
+        if response.status == 504:
+            raise TimeoutError(error['error'])
+        raise UpdaterError(error['error'])
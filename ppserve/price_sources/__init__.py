@@ -1,7 +1,14 @@
 from .pricesource import PriceSource
 from .ariva import ArivaPriceSource
+from .composite import CompositePriceSource
+from .registry import register_source, price_source, sources, configured_sources
+
+register_source('ariva', ArivaPriceSource)
 
 __all__ = [
     'PriceSource',
-    'ArivaPriceSource'
+    'ArivaPriceSource',
+    'CompositePriceSource',
+    'register_source',
+    'price_source'
 ]
@@ -1,88 +1,180 @@
-import locale
+import asyncio
 import re
 import calendar
 from math import floor
 import urllib.request
-from bs4 import BeautifulSoup as BS
+import lxml.html
 import logging
-from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 from dateutil.relativedelta import relativedelta
 
 from .pricesource import PriceSource
+from ..deadline import carry
+from ..metrics import instrumented, parse_seconds
+from ..tracing import span
+from .util import parse_german_float, parse_german_date, has_class, element_string
 from ..securities import *
 
 class ArivaPriceSource(PriceSource):
-    def __init__(self, symbol):
-        self.name = 'Ariva'
-        PriceSource.__init__(self, symbol)
 
-    def make_url(self):
-        # User agent to use for the request. Not sure if it is necessary to pretend to be someone else.
-        headers={'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.67 Safari/537.36'}
+    name = 'Ariva'
+
+    # User agent to use for the request. Not sure if it is necessary to pretend to be someone else.
+    headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.67 Safari/537.36'}
+
+    # where symbols are looked up, e.g. a local stand-in server for benchmarks
+    base_url = 'http://www.ariva.de'
+
+    # number of month pages fetched concurrently by fetch_historic_quotes; 1 fetches them serially
+    historic_workers = 4
+
+    sec_types = {
+        'Aktie': Stock,
+        'ETF': ETF,
+        'Fonds': ETF, # TODO: this is mostly a hack to accomodate A12GVR
+        'Zertifikat': Derivative,
+        'Anleihe': Bond
+    }
+
+    exchange_ids = {
+        Stock: 1, # Frankfurt
+        ETF: 1,
+        Bond: 1,
+        Derivative: 39 # Frankfurt Zertifikate
+    }
+
+    def _cached_request(self):
+        cached = self.resolution_cache.get(self._resolution_key)
+        if cached is None:
+            return None
+
+        self.logger.debug('Using cached resolution of {}'.format(self.symbol))
+        self.sec_type = {t.__name__: t for t in self.exchange_ids.keys()}.get(cached['sec_type'])
+        self._resolved_from_cache = True
+        return urllib.request.Request(cached['url'] + '?boerse_id={}'.format(cached['exchange_id']), headers=self.headers)
+
+    def _resolve(self, url, html):
+        # Try to find out the security type.
+        with parse_seconds.labels(self.name, 'resolve').time(), span('parse', page='resolve'):
+            doc = lxml.html.fromstring(html)
+            snapshot_info = next((div for div in doc.iter('div') if div.get('class') == 'verlauf snapshotInfo'), None)
+            security_type = next(text for text in snapshot_info.itertext() if 'Typ:' in text).split(':')[1].strip()
+
+        if security_type in self.sec_types.keys():
+            self.sec_type = self.sec_types[security_type]
+        if not self.sec_type:
+            self.logger.warning('Could not determine security type.')
+
+        # The url contains the exchange to use.
+        # We make it depend on the security type.
+        exchange_id = self.exchange_ids[self.sec_type]
 
+        self.resolution_cache.put(
+            self._resolution_key,
+            url=url,
+            sec_type=self.sec_type.__name__,
+            exchange_id=exchange_id
+        )
+
+        return urllib.request.Request(url + '?boerse_id={}'.format(exchange_id), headers=self.headers)
+
+    def make_url(self):
+        cached = self._cached_request()
+        if cached is not None:
+            return cached
+        return self._look_up()
+
+    # only actual lookups are timed, not those answered from the resolution cache
+    @instrumented('make_url')
+    def _look_up(self):
         try:
             # We need to find out where Ariva redirects us to later build other URLs
-            req = urllib.request.Request("http://www.ariva.de/{}".format(self.symbol), headers=headers)
-            response = urllib.request.urlopen(req)
+            url, html = self.connection_pool.fetch('{}/{}'.format(self.base_url, self.symbol), headers=self.headers)
         except urllib.error.HTTPError as e:
             self.logger.error('Could not find symbol {} on Ariva.'.format(self.symbol))
             raise e
 
-        # Try to find out the security type.
-        soup = BS(response.read().decode('utf-8'), 'lxml')
-        security_type = soup.find('div', class_='verlauf snapshotInfo').find(text=re.compile('Typ:')).string.split(':')[1].strip()
-
-        sec_types = {
-            'Aktie': Stock,
-            'ETF': ETF,
-            'Fonds': ETF, # TODO: this is mostly a hack to accomodate A12GVR
-            'Zertifikat': Derivative,
-            'Anleihe': Bond
-        }
-
-        if security_type in sec_types.keys():
-            self.sec_type = sec_types[security_type]
-        if not self.sec_type:
-            self.logger.warning('Could not determine security type.')
+        return self._resolve(url, html.decode('utf-8'))
 
-        exchange_ids = {
-            Stock: 1, # Frankfurt
-            ETF: 1,
-            Bond: 1,
-            Derivative: 39 # Frankfurt Zertifikate
-        }
+    async def make_url_async(self):
+        cached = self._cached_request()
+        if cached is not None:
+            return cached
+        return await self._look_up_async()
 
-        # The url contains the exchange to use.
-        # We make it depend on the security type.
-        return urllib.request.Request(response.url + '?boerse_id={}'.format(exchange_ids[self.sec_type]), headers=headers)
+    @instrumented('make_url')
+    async def _look_up_async(self):
+        try:
+            url, html = await self.connection_pool.fetch_async('{}/{}'.format(self.base_url, self.symbol), headers=self.headers)
+        except urllib.error.HTTPError as e:
+            self.logger.error('Could not find symbol {} on Ariva.'.format(self.symbol))
+            raise e
 
+        return self._resolve(url, html.decode('utf-8'))
+
+    @instrumented('fetch_info')
     def fetch_info(self):
         self.logger.info('Fetching info using {}.'.format(self.name))
-        locale.setlocale(locale.LC_NUMERIC, "de_DE.UTF-8")
+        html = self.fetch_page()
+        with parse_seconds.labels(self.name, 'snapshot').time(), span('parse', page='snapshot'):
+            return self._parse_info(html)
+
+    @instrumented('fetch_info')
+    async def fetch_info_async(self):
+        self.logger.info('Fetching info using {}.'.format(self.name))
+        html = await self.fetch_page_async()
+        with parse_seconds.labels(self.name, 'snapshot').time(), span('parse', page='snapshot'):
+            return self._parse_info(html)
+
+    def _label_cells(self, doc):
+        """
+        Returns (label, value) pairs of all table cells that contain nothing but
+        text, paired with the text of the cell next to them.
+        """
+        cells = []
+        for td in doc.iter('td'):
+            label = element_string(td)
+            if label is None:
+                continue
+            value = td.getnext()
+            while value is not None and value.tag != 'td':
+                value = value.getnext()
+            if value is not None:
+                cells.append((label, value.text if value.text is not None else value.text_content()))
+        return cells
+
+    def _parse_info(self, html):
+        doc = lxml.html.fromstring(html)
 
-        soup = self.fetch_site()
         info = {}
         info['url'] = self.url_or_request
 
+        label_cells = None
         def _find_ariva_td(label):
-            try:
-                # the '\s' selects white space, so we only get entries that exactly match the label name
-                # e.g. 'Kupon' does not match 'Kuponart'
-                return soup.find('td', text=re.compile(label + '\s')).find_next_sibling('td').contents[0].strip()
-            except AttributeError:
-                self.logger.warning("Couldn't find label '{}' on the Ariva site".format(label))
-
-        info['name'] = soup.find('h1').find(itemprop='name').contents[0].strip()
-
-        table = soup.find('table', class_='line')
-        if table.find('span', itemprop='price') is not None:
-            info['_last'] = locale.atof(table.find('span', itemprop='price').contents[0])
-
-        curr_span = table.find('span', itemprop='pricecurrency')
+            nonlocal label_cells
+            if label_cells is None:
+                label_cells = self._label_cells(doc)
+            # the '\s' selects white space, so we only get entries that exactly match the label name
+            # e.g. 'Kupon' does not match 'Kuponart'
+            pattern = re.compile(label + '\s')
+            for text, value in label_cells:
+                if pattern.search(text):
+                    return value.strip()
+            self.logger.warning("Couldn't find label '{}' on the Ariva site".format(label))
+
+        info['name'] = doc.find('.//h1').find('.//*[@itemprop="name"]').text.strip()
+
+        table = next(t for t in doc.iter('table') if has_class(t, 'line'))
+        price_span = table.find('.//span[@itemprop="price"]')
+        if price_span is not None:
+            info['_last'] = parse_german_float(price_span.text)
+
+        curr_span = table.find('.//span[@itemprop="pricecurrency"]')
         if curr_span is None:
             info['currency'] = _find_ariva_td("Währung")
         else:
-            curr = curr_span.contents[0]
+            curr = curr_span.text
             if curr == '$':
                 info['currency'] = 'USD'
             if curr == '€':
@@ -90,20 +182,20 @@ class ArivaPriceSource(PriceSource):
 
         if self.sec_type == Bond:
             if _find_ariva_td("Kupon") is not None:
-                # we don't use locale.atof here, since Ariva uses the decimal point here...
+                # we don't use parse_german_float here, since Ariva uses the decimal point here...
                 info['interest_rate'] = float(_find_ariva_td("Kupon").replace('%','').strip())
 
             if _find_ariva_td("Stückzinsen") is not None:
-                info['_accrued_interest_fetched'] = locale.atof(_find_ariva_td("Stückzinsen").replace('%','').strip())
+                info['_accrued_interest_fetched'] = parse_german_float(_find_ariva_td("Stückzinsen").replace('%','').strip())
 
             if _find_ariva_td("Zinslauf ab") is not None:
-                info['interest_from'] = datetime.strptime(_find_ariva_td("Zinslauf ab"), '%d.%m.%Y').date()
+                info['interest_from'] = parse_german_date(_find_ariva_td("Zinslauf ab"))
 
             if _find_ariva_td("Fälligkeit") is not None:
                 if _find_ariva_td("Fälligkeit") == 'unbefristet':
                     info['maturity'] = None
                 else:
-                    info['maturity'] = datetime.strptime(_find_ariva_td("Fälligkeit"), '%d.%m.%Y').date()
+                    info['maturity'] = parse_german_date(_find_ariva_td("Fälligkeit"))
 
             period = _find_ariva_td("Kuponperiode")
             if period is not None:
@@ -126,35 +218,97 @@ class ArivaPriceSource(PriceSource):
 
         return info
 
-    def fetch_historic_quotes(self, start_date, end_date):
+    def _historic_months(self, start_date, end_date):
+        """
+        Returns the last days of all months between start_date and end_date,
+        most recent first. Ariva serves historic quotes one month per page.
+        """
+        months = []
+        d = date(end_date.year, end_date.month, calendar.monthrange(end_date.year, end_date.month)[1])
+
+        while start_date <= d:
+            months.append(d)
+            # we need to get the *last* day of the previous month
+            d = d + relativedelta(months=-1)
+            d = date(d.year, d.month, calendar.monthrange(d.year, d.month)[1])
+
+        return months
+
+    def _historic_month_url(self, d):
+        url = self.url.split('?')[0] + '/historische_kurse?' + self.url.split('?')[1] + '&month={}'.format(d.strftime('%Y-%m-%d'))
+        self.logger.debug("Fetching quotes for {} of {} from '{}'".format(d.strftime('%B'), d.strftime('%Y'), url))
+        return url
+
+    def _fetch_historic_month(self, d, start_date, end_date):
+        # Get quotes from Ariva
+        html = self.connection_pool.get(self._historic_month_url(d), headers=self.headers).decode('utf-8')
+        with parse_seconds.labels(self.name, 'historic').time(), span('parse', page='historic'):
+            return self._parse_historic_month(html, start_date, end_date)
+
+    async def _fetch_historic_month_async(self, d, start_date, end_date):
+        html = (await self.connection_pool.get_async(self._historic_month_url(d), headers=self.headers)).decode('utf-8')
+        with parse_seconds.labels(self.name, 'historic').time(), span('parse', page='historic'):
+            return self._parse_historic_month(html, start_date, end_date)
+
+    def _parse_historic_month(self, html, start_date, end_date):
+        # Only parse the page from the quotes table on, the header and
+        # navigation before it make up most of the page.
+        start = html.find('id="pageHistoricQuotes"')
+        if start >= 0:
+            html = html[html.rfind('<div', 0, start):]
+        div = lxml.html.fromstring(html).get_element_by_id('pageHistoricQuotes')
+
+        quotes = {}
+        for tr in div.iter('tr'):
+            if not has_class(tr, 'arrow0'):
+                continue
+            cells = list(tr.iter('td'))
+            quote_date = parse_german_date(cells[0].text)
+            if quote_date <= end_date and quote_date >= start_date:
+                quotes[quote_date] = parse_german_float(cells[4].text)
+
+        return quotes
+
+    @instrumented('fetch_historic_quotes')
+    def fetch_historic_quotes(self, start_date, end_date, workers=None):
         self.logger.info('Fetching historic quotes using {}.'.format(self.name))
 
+        if workers is None:
+            workers = self.historic_workers
+
+        # resolve the URL before fanning out, so the workers don't all race to do it
+        self.url
+
+        months = self._historic_months(start_date, end_date)
+        # the workers keep to the caller's deadline
+        fetch_month = carry(lambda d: self._fetch_historic_month(d, start_date, end_date))
+
+        if workers > 1 and len(months) > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(months)), thread_name_prefix='ariva {}'.format(self.symbol)) as executor:
+                pages = list(executor.map(fetch_month, months))
+        else:
+            pages = [fetch_month(d) for d in months]
+
+        # merge in the same order as walking the months serially, so the result does not depend on the workers
         quotes = {}
+        for page in pages:
+            quotes.update(page)
+
+        return quotes
 
-        locale.setlocale(locale.LC_NUMERIC, "de_DE.UTF-8")
+    @instrumented('fetch_historic_quotes')
+    async def fetch_historic_quotes_async(self, start_date, end_date):
+        self.logger.info('Fetching historic quotes using {}.'.format(self.name))
 
-        d = date(end_date.year, end_date.month, calendar.monthrange(end_date.year, end_date.month)[1])
+        await self.url_or_request_async()
 
-        while start_date <= d:
-            # Get quotes from Ariva
-            self.logger.debug("Fetching quotes for {} of {}".format(d.strftime('%B'), d.strftime('%Y')))
-            url = self.url.split('?')[0] + '/historische_kurse?' + self.url.split('?')[1] + '&month={}'.format(d.strftime('%Y-%m-%d'))
-            req = urllib.request.urlopen(url)
-            html = req.read().decode('utf-8')
-            soup = BS(html,'lxml')
-
-            self.logger.debug("URL is '{}'".format(url))
-
-            for tr in soup.find('div', id='pageHistoricQuotes').findAll('tr', class_='arrow0'):
-                cells = tr.findAll('td')
-                quote_date = datetime.strptime(cells[0].contents[0], '%d.%m.%y').date()
-                if quote_date <= end_date and quote_date >= start_date:
-                    # close = float('.'.join(cells[4].contents[0].split(',')))
-                    close = locale.atof(cells[4].contents[0])
-                    quotes[quote_date] = close
+        # all months are requested at once; the connection pool caps the concurrency per host
+        pages = await asyncio.gather(*(
+            self._fetch_historic_month_async(d, start_date, end_date) for d in self._historic_months(start_date, end_date)
+        ))
 
-            # we need to get the *last* day of the previous month
-            d = d + relativedelta(months=-1)
-            d = date(d.year, d.month, calendar.monthrange(d.year, d.month)[1])
+        quotes = {}
+        for page in pages:
+            quotes.update(page)
 
         return quotes
@@ -0,0 +1,117 @@
+import logging
+from threading import Lock
+from time import monotonic
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised instead of contacting a host that is known to be unhealthy.
+    """
+
+    def __init__(self, host, retry_after):
+        ConnectionError.__init__(self, '{} is unavailable, retrying in {:.0f}s'.format(host, retry_after))
+        self.host = host
+        self.retry_after = retry_after
+
+class _Circuit:
+
+    def __init__(self):
+        self.failures = 0
+        # number of times the circuit opened in a row, determines the backoff
+        self.trips = 0
+        self.open_until = None
+        self.probing = False
+
+class CircuitBreaker:
+    """
+    Tracks the health of each upstream host. After threshold consecutive
+    failures the host's circuit opens: requests to it fail immediately with
+    CircuitOpenError instead of tying up a thread until they time out. Once
+    the backoff has passed a single request is let through as a probe; if it
+    fails, the circuit opens again for twice as long (up to max_backoff).
+    """
+
+    def __init__(self, threshold=5, backoff=5, max_backoff=300):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._circuits = {}
+        self._lock = Lock()
+
+        self.stats = {
+            'trips': 0,
+            'rejected': 0
+        }
+
+        self.logger = logging.getLogger('CircuitBreaker')
+
+    def _circuit(self, host):
+        # must hold self._lock
+        if host not in self._circuits:
+            self._circuits[host] = _Circuit()
+        return self._circuits[host]
+
+    def before(self, host):
+        """
+        Called before each request to host. Raises CircuitOpenError if the
+        host is not to be contacted right now.
+        """
+        if not self.threshold:
+            return
+        with self._lock:
+            circuit = self._circuit(host)
+            if circuit.open_until is None:
+                return
+            wait = circuit.open_until - monotonic()
+            if wait <= 0 and not circuit.probing:
+                self.logger.info('Probing {}'.format(host))
+                circuit.probing = True
+                return
+            self.stats['rejected'] += 1
+        raise CircuitOpenError(host, max(wait, 0))
+
+    def succeeded(self, host):
+        with self._lock:
+            circuit = self._circuit(host)
+            if circuit.open_until is not None:
+                self.logger.info('{} is available again'.format(host))
+            circuit.failures = 0
+            circuit.trips = 0
+            circuit.open_until = None
+            circuit.probing = False
+
+    def abandoned(self, host):
+        """
+        Called if a request was given up for reasons unrelated to the host
+        (e.g. the caller's deadline), so it tells nothing about its health.
+        """
+        with self._lock:
+            self._circuit(host).probing = False
+
+    def failed(self, host):
+        if not self.threshold:
+            return
+        with self._lock:
+            circuit = self._circuit(host)
+            circuit.failures += 1
+            if circuit.probing or (circuit.open_until is None and circuit.failures >= self.threshold):
+                backoff = min(self.max_backoff, self.backoff*2**circuit.trips)
+                circuit.trips += 1
+                circuit.open_until = monotonic() + backoff
+                circuit.probing = False
+                self.stats['trips'] += 1
+                self.logger.warning('{} failed {} times in a row, not contacting it for {}s'.format(host, circuit.failures, backoff))
+
+    def info(self):
+        with self._lock:
+            info = dict(self.stats)
+            now = monotonic()
+            info['hosts'] = {
+                host: {
+                    'state': 'closed' if c.open_until is None else ('half-open' if c.probing or c.open_until <= now else 'open'),
+                    'failures': c.failures,
+                    'retry_after': None if c.open_until is None else round(max(c.open_until - now, 0), 1)
+                }
+                for host, c in self._circuits.items()
+            }
+        return info
@@ -0,0 +1,260 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+from time import perf_counter
+
+from .pricesource import PriceSource
+from ..deadline import carry
+
+class SourceStats:
+    """
+    Recent latencies and failures of one price source.
+    """
+
+    def __init__(self, window=50):
+        self.latencies = deque(maxlen=window)
+        # consecutive failures; a source that just failed is tried last
+        self.failures = 0
+
+        self.stats = {
+            'calls': 0,
+            'errors': 0,
+            'hedges': 0,
+            'wins': 0
+        }
+        self._lock = Lock()
+
+    def record(self, latency, ok):
+        """
+        Records a call; latency is None for calls that shouldn't count
+        towards the latency statistics.
+        """
+        with self._lock:
+            self.stats['calls'] += 1
+            if ok:
+                if latency is not None:
+                    self.latencies.append(latency)
+                self.failures = 0
+            else:
+                self.stats['errors'] += 1
+                self.failures += 1
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def quantile(self, q):
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q*len(latencies)))]
+
+    def rank(self):
+        """
+        Sort key of the source: working sources first, faster ones first.
+        Sources without any measurements keep their configured order behind
+        those with.
+        """
+        median = self.quantile(0.5)
+        return (self.failures > 0, float('inf') if median is None else median)
+
+    def info(self):
+        with self._lock:
+            info = dict(self.stats)
+            info['failures'] = self.failures
+        for name, q in [('median', 0.5), ('p90', 0.9)]:
+            latency = self.quantile(q)
+            info[name] = None if latency is None else round(latency, 3)
+        return info
+
+class CompositePriceSource(PriceSource):
+    """
+    Fetches quotes of a symbol from several price sources. The source that
+    has recently been fastest is asked first. If it hasn't answered after
+    hedge_after seconds, the next one is asked as well and the first good
+    answer wins; if it fails, the next one is asked right away. Historic
+    quotes take many requests, so they are only failed over, not hedged.
+    """
+
+    # source name -> SourceStats, shared by all symbols
+    source_stats = {}
+    _stats_lock = Lock()
+
+    # seconds after which the next source is asked; None uses the 90th
+    # percentile of the first source's recent latencies
+    hedge_after = None
+    default_hedge_after = 1.0
+
+    def __init__(self, symbol, sources):
+        self.sources = sources
+        self.name = '+'.join(source.name for source in sources)
+        PriceSource.__init__(self, symbol)
+
+    @property
+    def host(self):
+        return '+'.join(source.host for source in self.sources)
+
+    @classmethod
+    def stats_of(cls, source):
+        with cls._stats_lock:
+            if source.name not in cls.source_stats:
+                cls.source_stats[source.name] = SourceStats()
+            return cls.source_stats[source.name]
+
+    def _ordered(self):
+        return sorted(self.sources, key=lambda source: self.stats_of(source).rank())
+
+    def _hedge_delay(self, source):
+        if self.hedge_after is not None:
+            return self.hedge_after
+        p90 = self.stats_of(source).quantile(0.9)
+        return self.default_hedge_after if p90 is None else p90
+
+    def _use(self, source):
+        # the source that answered determines the URL and type of the security
+        self._url_or_request = source._url_or_request
+        self.sec_type = source.sec_type
+
+    def make_url(self):
+        return self._ordered()[0].url_or_request
+
+    async def make_url_async(self):
+        return await self._ordered()[0].url_or_request_async()
+
+    # Only the latencies of fetch_info are recorded: they decide when to
+    # hedge, and historic fetches take much longer.
+
+    def _timed(self, source, method, *args, measure=True):
+        started = perf_counter()
+        try:
+            result = getattr(source, method)(*args)
+        except Exception:
+            self.stats_of(source).record(None, False)
+            raise
+        self.stats_of(source).record(perf_counter() - started if measure else None, True)
+        return result
+
+    async def _timed_async(self, source, method, *args, measure=True):
+        started = perf_counter()
+        try:
+            result = await getattr(source, method)(*args)
+        except Exception:
+            self.stats_of(source).record(None, False)
+            raise
+        self.stats_of(source).record(perf_counter() - started if measure else None, True)
+        return result
+
+    def _failed(self, source, e):
+        self.logger.warning('{} failed for {}: {}'.format(source.name, self.symbol, e))
+
+    def fetch_info(self):
+        sources = self._ordered()
+        remaining = iter(sources)
+        pending = {}
+        error = None
+
+        executor = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix='hedge {}'.format(self.symbol))
+
+        def ask_next():
+            source = next(remaining, None)
+            if source is not None:
+                pending[executor.submit(carry(self._timed), source, 'fetch_info')] = source
+            return source
+
+        try:
+            ask_next()
+            while pending:
+                done, _ = wait(pending, timeout=self._hedge_delay(sources[0]), return_when=FIRST_COMPLETED)
+                if not done:
+                    source = ask_next()
+                    if source is not None:
+                        self.logger.debug('Asking {} as well'.format(source.name))
+                        self.stats_of(source).count('hedges')
+                    continue
+
+                for future in done:
+                    source = pending.pop(future)
+                    try:
+                        info = future.result()
+                    except Exception as e:
+                        self._failed(source, e)
+                        error = e
+                        ask_next()
+                        continue
+                    self.stats_of(source).count('wins')
+                    self._use(source)
+                    return info
+        finally:
+            # slower sources finish in the background, their answers are ignored
+            executor.shutdown(wait=False)
+
+        raise error
+
+    async def fetch_info_async(self):
+        sources = self._ordered()
+        remaining = iter(sources)
+        pending = {}
+        error = None
+
+        def ask_next():
+            source = next(remaining, None)
+            if source is not None:
+                pending[asyncio.ensure_future(self._timed_async(source, 'fetch_info_async'))] = source
+            return source
+
+        try:
+            ask_next()
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=self._hedge_delay(sources[0]), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    source = ask_next()
+                    if source is not None:
+                        self.logger.debug('Asking {} as well'.format(source.name))
+                        self.stats_of(source).count('hedges')
+                    continue
+
+                for task in done:
+                    source = pending.pop(task)
+                    try:
+                        info = task.result()
+                    except Exception as e:
+                        self._failed(source, e)
+                        error = e
+                        ask_next()
+                        continue
+                    self.stats_of(source).count('wins')
+                    self._use(source)
+                    return info
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise error
+
+    def fetch_historic_quotes(self, start_date, end_date):
+        error = None
+        for source in self._ordered():
+            try:
+                quotes = self._timed(source, 'fetch_historic_quotes', start_date, end_date, measure=False)
+            except Exception as e:
+                self._failed(source, e)
+                error = e
+                continue
+            self._use(source)
+            return quotes
+        raise error
+
+    async def fetch_historic_quotes_async(self, start_date, end_date):
+        error = None
+        for source in self._ordered():
+            try:
+                quotes = await self._timed_async(source, 'fetch_historic_quotes_async', start_date, end_date, measure=False)
+            except Exception as e:
+                self._failed(source, e)
+                error = e
+                continue
+            self._use(source)
+            return quotes
+        raise error
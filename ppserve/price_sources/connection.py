@@ -0,0 +1,287 @@
+import asyncio
+import http.client
+import io
+import logging
+import threading
+import urllib.error
+import urllib.parse
+from collections import defaultdict
+
+from .breaker import CircuitBreaker
+from ..deadline import DeadlineExceeded, remaining
+from ..tracing import span
+
+class ConnectionPool:
+    """
+    Keeps persistent (keep-alive) HTTP connections per host, so that
+    consecutive requests to the same host do not pay for a new TCP/TLS
+    handshake each time. At most max_per_host requests to a single host are
+    in flight at any time; further callers block until a slot is free.
+
+    Every request (and the wait for a slot) is limited to timeout seconds, or
+    less if the caller's deadline (see ppserve.deadline) expires earlier.
+    Hosts that keep failing are cut off for a while by a CircuitBreaker.
+    """
+
+    def __init__(self, max_per_host=4, max_redirects=5, timeout=10, breaker=None):
+        self.max_per_host = max_per_host
+        self.max_redirects = max_redirects
+        self.timeout = timeout
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)
+        self._slots = {}
+        self._async_slots = {}
+
+        self.logger = logging.getLogger('ConnectionPool')
+
+    def _slot(self, key):
+        # semaphores are created lazily, so max_per_host can still be changed
+        # after the pool was created (e.g. from the command line)
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_per_host)
+            return self._slots[key]
+
+    def _connect(self, key):
+        scheme, netloc = key
+        self.logger.debug('Opening new connection to {}://{}'.format(scheme, netloc))
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc)
+        return http.client.HTTPConnection(netloc)
+
+    def _acquire(self, key):
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop(), True
+        return self._connect(key), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            self._idle[key].append(conn)
+
+    def _request(self, conn, path, headers, timeout):
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def _timeout(self):
+        # raises DeadlineExceeded if the caller has no time left
+        return remaining(self.timeout)
+
+    def _cut_short(self, timeout):
+        # whether the caller's deadline left less than the full timeout
+        return timeout is not None and (self.timeout is None or timeout < self.timeout)
+
+    def _timed_out(self, host, timeout, what, blame=True):
+        """
+        Returns the exception for something that took longer than timeout.
+        Only if the host had the full timeout to answer does this count
+        against it; otherwise the caller's deadline was just too short.
+        """
+        if self._cut_short(timeout):
+            self.breaker.abandoned(host)
+            return DeadlineExceeded('Deadline exceeded while {} {}'.format(what, host))
+        if blame:
+            self.breaker.failed(host)
+        else:
+            self.breaker.abandoned(host)
+        return TimeoutError('Timed out after {:.1f}s while {} {}'.format(timeout, what, host))
+
+    def _get(self, key, path, headers):
+        host = key[1]
+        timeout = self._timeout()
+        self.breaker.before(host)
+
+        slot = self._slot(key)
+        if not slot.acquire(timeout=-1 if timeout is None else timeout):
+            # the host is busy with other (possibly hanging) requests
+            raise self._timed_out(host, timeout, 'waiting for a connection to', blame=False)
+
+        try:
+            conn, reused = self._acquire(key)
+            try:
+                try:
+                    response, body = self._request(conn, path, headers, timeout)
+                except TimeoutError:
+                    raise
+                except (http.client.HTTPException, OSError):
+                    conn.close()
+                    if not reused:
+                        raise
+                    # the server may have closed an idle keep-alive connection; retry once on a fresh one
+                    timeout = self._timeout()
+                    conn = self._connect(key)
+                    response, body = self._request(conn, path, headers, timeout)
+            except DeadlineExceeded:
+                self.breaker.abandoned(host)
+                raise
+            except TimeoutError as e:
+                conn.close()
+                raise self._timed_out(host, timeout, 'fetching from') from e
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                self.breaker.failed(host)
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+        finally:
+            slot.release()
+
+        if response.status >= 500:
+            self.breaker.failed(host)
+        else:
+            self.breaker.succeeded(host)
+        return response, body
+
+    def fetch(self, url, headers=None):
+        """
+        Fetches url and returns the URL after following redirects together
+        with the response body as bytes. HTTP errors are raised as
+        urllib.error.HTTPError, just like urllib.request.urlopen() does.
+        """
+        headers = dict(headers or {})
+
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+            with span('download', host=parts.netloc):
+                response, body = self._get(key, path, headers)
+
+            if response.status in (301, 302, 303, 307, 308):
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return url, body
+
+        raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers, None)
+
+    def get(self, url, headers=None):
+        """
+        Like fetch(), but only returns the response body.
+        """
+        url, body = self.fetch(url, headers)
+        return body
+
+    # Asynchronous variants, for use from an asyncio event loop. These don't
+    # reuse connections, but they share the per-host cap among coroutines.
+
+    def _async_slot(self, key):
+        if key not in self._async_slots:
+            self._async_slots[key] = asyncio.Semaphore(self.max_per_host)
+        return self._async_slots[key]
+
+    async def _request_async(self, scheme, netloc, path, headers):
+        host, _, port = netloc.partition(':')
+        port = int(port) if port else (443 if scheme == 'https' else 80)
+
+        reader, writer = await asyncio.open_connection(host, port, ssl=True if scheme == 'https' else None)
+        try:
+            lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}'.format(netloc), 'Connection: close', 'Accept-Encoding: identity']
+            lines += ['{}: {}'.format(name, value) for name, value in headers.items()]
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            await writer.drain()
+
+            status_line = (await reader.readline()).decode('latin-1').rstrip('\r\n').split(' ', 2)
+            status, reason = int(status_line[1]), status_line[2] if len(status_line) > 2 else ''
+
+            raw_headers = b''
+            while True:
+                line = await reader.readline()
+                raw_headers += line
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            response_headers = http.client.parse_headers(io.BytesIO(raw_headers))
+
+            if response_headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                body = b''
+                while True:
+                    size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                    if size == 0:
+                        break
+                    body += await reader.readexactly(size)
+                    await reader.readline()
+            elif response_headers.get('Content-Length') is not None:
+                body = await reader.readexactly(int(response_headers['Content-Length']))
+            else:
+                body = await reader.read()
+        finally:
+            writer.close()
+
+        return status, reason, response_headers, body
+
+    async def _get_async(self, key, path, headers):
+        host = key[1]
+        timeout = self._timeout()
+        self.breaker.before(host)
+
+        slot = self._async_slot(key)
+        try:
+            await asyncio.wait_for(slot.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise self._timed_out(host, timeout, 'waiting for a connection to', blame=False) from None
+        except asyncio.CancelledError:
+            self.breaker.abandoned(host)
+            raise
+
+        try:
+            # waiting for the slot took some of the deadline
+            timeout = self._timeout()
+            result = await asyncio.wait_for(self._request_async(key[0], key[1], path, headers), timeout)
+        except DeadlineExceeded:
+            self.breaker.abandoned(host)
+            raise
+        except asyncio.TimeoutError:
+            raise self._timed_out(host, timeout, 'fetching from') from None
+        except asyncio.CancelledError:
+            # e.g. a hedged request that lost
+            self.breaker.abandoned(host)
+            raise
+        except (http.client.HTTPException, OSError, ValueError, asyncio.IncompleteReadError):
+            self.breaker.failed(host)
+            raise
+        finally:
+            slot.release()
+
+        if result[0] >= 500:
+            self.breaker.failed(host)
+        else:
+            self.breaker.succeeded(host)
+        return result
+
+    async def fetch_async(self, url, headers=None):
+        """
+        Like fetch(), but a coroutine.
+        """
+        headers = dict(headers or {})
+
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+            with span('download', host=parts.netloc):
+                status, reason, response_headers, body = await self._get_async(key, path, headers)
+
+            if status in (301, 302, 303, 307, 308):
+                url = urllib.parse.urljoin(url, response_headers.get('Location'))
+                continue
+            if status >= 400:
+                raise urllib.error.HTTPError(url, status, reason, response_headers, None)
+            return url, body
+
+        raise urllib.error.HTTPError(url, status, 'Too many redirects', response_headers, None)
+
+    async def get_async(self, url, headers=None):
+        url, body = await self.fetch_async(url, headers)
+        return body
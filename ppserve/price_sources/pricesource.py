@@ -1,17 +1,35 @@
 import logging
-import urllib.request
-from bs4 import BeautifulSoup as BS
+import urllib.error
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from .connection import ConnectionPool
+from .resolution_cache import ResolutionCache
+from ..securities import Security
 
 class PriceSource:
 
+    # shared by all price sources, so the per-host connection cap holds globally
+    connection_pool = ConnectionPool()
+
+    # symbol resolutions (see make_url) survive restarts
+    resolution_cache = ResolutionCache(Path.home()/'.ppserve'/'resolution_cache.json')
+
+    # where the source's pages are fetched from
+    base_url = None
+
     def make_url(self): # TODO: provide interface for historical quote URL also
         return None
 
+    async def make_url_async(self):
+        return self.make_url()
+
     def __init__(self, symbol):
         # if not hasattr(self, 'name'): self.name = None
         self.symbol = symbol
         self.sec_type = None
         self._url_or_request = None
+        self._resolved_from_cache = False
 
         self.logger = logging.getLogger('{}.{}'.format(self.name, self.symbol))
 
@@ -23,6 +41,12 @@ class PriceSource:
             self.logger.debug('URL is {}'.format(self._url_or_request))
         return self._url_or_request
 
+    async def url_or_request_async(self):
+        if not self._url_or_request:
+            self._url_or_request = await self.make_url_async()
+            self.logger.debug('URL is {}'.format(self._url_or_request))
+        return self._url_or_request
+
     @property
     def url(self):
         if isinstance(self.url_or_request, str):
@@ -30,19 +54,89 @@ class PriceSource:
         else:
             return self.url_or_request.full_url
 
-    def fetch_site(self):
-        html = urllib.request.urlopen(self.url_or_request).read().decode('utf-8')
-        return BS(html,"lxml")
+    @property
+    def _resolution_key(self):
+        return '{}:{}'.format(self.name, self.symbol)
+
+    def invalidate_resolution(self):
+        self.resolution_cache.invalidate(self._resolution_key)
+        self._url_or_request = None
+        self._resolved_from_cache = False
+
+    def _fetch_url_or_request(self):
+        # through the connection pool, so timeouts, deadlines and the circuit breaker apply
+        url_or_request = self.url_or_request
+        if isinstance(url_or_request, str):
+            return self.connection_pool.get(url_or_request)
+        return self.connection_pool.get(url_or_request.full_url, headers=url_or_request.headers)
+
+    def fetch_page(self):
+        """
+        Returns the HTML of the security's page as a string.
+        """
+        try:
+            html = self._fetch_url_or_request().decode('utf-8')
+        except urllib.error.HTTPError:
+            if not self._resolved_from_cache:
+                raise
+            # the cached resolution may be outdated; resolve once more and retry
+            self.logger.info('Cached URL for {} failed, resolving it again.'.format(self.symbol))
+            self.invalidate_resolution()
+            html = self._fetch_url_or_request().decode('utf-8')
+        return html
+
+    async def _fetch_url_or_request_async(self):
+        url_or_request = await self.url_or_request_async()
+        if isinstance(url_or_request, str):
+            return await self.connection_pool.get_async(url_or_request)
+        return await self.connection_pool.get_async(url_or_request.full_url, headers=url_or_request.headers)
+
+    async def fetch_page_async(self):
+        try:
+            html = (await self._fetch_url_or_request_async()).decode('utf-8')
+        except urllib.error.HTTPError:
+            if not self._resolved_from_cache:
+                raise
+            self.logger.info('Cached URL for {} failed, resolving it again.'.format(self.symbol))
+            self.invalidate_resolution()
+            html = (await self._fetch_url_or_request_async()).decode('utf-8')
+        return html
 
     def fetch_info(self):
         raise NotImplementedError()
 
+    async def fetch_info_async(self):
+        raise NotImplementedError()
+
     def fetch_historic_quotes(self):
         raise NotImplementedError()
 
+    async def fetch_historic_quotes_async(self):
+        raise NotImplementedError()
+
     def security(self, class_=None):
-        info = self.fetch_info()
+        return self._make_security(self.fetch_info(), class_)
+
+    async def security_async(self, class_=None):
+        return self._make_security(await self.fetch_info_async(), class_)
 
+    @property
+    def host(self):
+        """
+        The host the source sends its requests to (its name if it has no
+        base_url), e.g. to rate limit them.
+        """
+        return urlsplit(self.base_url).netloc if self.base_url else self.name
+
+    def hook_into(self, sec):
+        """
+        Makes sec fetch its updates from this price source.
+        """
+        sec.update_hook = self.fetch_info
+        sec.update_hook_async = self.fetch_info_async
+        sec.update_hook_historic = self.fetch_historic_quotes
+
+    def _make_security(self, info, class_):
         if class_ is None and self.sec_type is not None:
             self.logger.debug('Security is of type {}'.format(self.sec_type))
             class_ = self.sec_type
@@ -52,6 +146,5 @@ class PriceSource:
         sec = class_(self.symbol)
 
         sec.update_from_dict(info)
-        sec.update_hook = self.fetch_info
-        sec.update_hook_historic = self.fetch_historic_quotes
+        self.hook_into(sec)
         return sec
@@ -0,0 +1,22 @@
+from .composite import CompositePriceSource
+
+# name -> factory taking a symbol and returning a PriceSource for it
+sources = {}
+
+# names of the sources used for each symbol, most preferred first
+configured_sources = []
+
+def register_source(name, factory):
+    sources[name] = factory
+    if not configured_sources:
+        configured_sources.append(name)
+
+def price_source(symbol, names=None):
+    """
+    Returns a price source for symbol: the configured source, or a
+    CompositePriceSource hedging and failing over between several.
+    """
+    names = configured_sources if names is None else names
+    if len(names) == 1:
+        return sources[names[0]](symbol)
+    return CompositePriceSource(symbol, [sources[name](symbol) for name in names])
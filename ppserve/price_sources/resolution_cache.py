@@ -0,0 +1,77 @@
+import json
+import logging
+import os
+from pathlib import Path
+from threading import Lock
+from time import time
+
+class ResolutionCache:
+    """
+    Persists how price sources resolved symbols (the URL the source redirected
+    to, the security type and the exchange id), so that the resolution does not
+    have to be repeated for every new price source or after a restart. Entries
+    expire after max_age seconds.
+    """
+
+    def __init__(self, path, max_age=30*24*3600):
+        self.path = Path(path)
+        self.max_age = max_age
+
+        self._entries = None
+        self._lock = Lock()
+
+        self.logger = logging.getLogger('ResolutionCache')
+
+    def _load(self):
+        # the file is read lazily, on first use
+        if self._entries is not None:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            self._entries = {}
+        except ValueError:
+            self.logger.warning('Ignoring corrupt resolution cache {}'.format(self.path))
+            self._entries = {}
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key):
+        """
+        Returns the cached entry for key, or None if there is none or it expired.
+        """
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+        if time() - entry['resolved'] > self.max_age:
+            self.logger.debug('Resolution of {} expired'.format(key))
+            return None
+        return entry
+
+    def put(self, key, **fields):
+        fields['resolved'] = time()
+        with self._lock:
+            self._load()
+            self._entries[key] = fields
+            self._save()
+
+    def invalidate(self, key=None):
+        """
+        Drops the entry for key, or all entries if key is None.
+        """
+        with self._lock:
+            self._load()
+            if key is None:
+                self._entries = {}
+            else:
+                self._entries.pop(key, None)
+            self._save()
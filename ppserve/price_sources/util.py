@@ -0,0 +1,37 @@
+from datetime import date
+
+# Number and date formats of German sites. These parse without the de_DE
+# locale, which is process-global (so not thread-safe to switch) and not
+# installed everywhere.
+
+def parse_german_float(s):
+    """
+    Parses numbers formatted like '1.234,56'.
+    """
+    return float(s.strip().replace('.', '').replace(',', '.'))
+
+def parse_german_date(s):
+    """
+    Parses dates formatted like '31.12.2019' or '31.12.19'. Two-digit years
+    are interpreted like strptime's %y: 69-99 are 19xx, 00-68 are 20xx.
+    """
+    day, month, year = s.strip().split('.')
+    if len(year) <= 2:
+        year = int(year)
+        year += 1900 if year >= 69 else 2000
+    return date(int(year), int(month), int(day))
+
+def has_class(el, class_):
+    return class_ in (el.get('class') or '').split()
+
+def element_string(el):
+    """
+    Returns the text of an lxml element if it is its only content, descending
+    into a single child element (like BeautifulSoup's Tag.string), or None.
+    """
+    children = list(el)
+    if not children:
+        return el.text
+    if len(children) == 1 and el.text is None and children[0].tail is None:
+        return element_string(children[0])
+    return None
@@ -0,0 +1,358 @@
+import asyncio
+import logging
+from threading import Lock, Thread
+from time import monotonic, time
+
+from . import securities
+from .deadline import carry
+from .singleflight import SingleFlight
+
+class QuoteCache:
+    """
+    Remembers when the live quote of each security was last fetched. Fresh
+    securities are served as they are; stale ones are served immediately
+    while a background thread refreshes them (stale-while-revalidate). Only
+    securities that were never fetched block the caller.
+
+    If the price source can't be reached, a security that has a quote from
+    before is served with that quote rather than failing the request.
+    """
+
+    # failures to reach the price source, including an open circuit breaker
+    unavailable = (ConnectionError, TimeoutError)
+
+    def __init__(self, securities, ttl=300, flight=None, on_fetch=None):
+        # securities is the symbol -> Security dict the cache serves from (and adds new securities to)
+        self.securities = securities
+        self.ttl = ttl
+        # concurrent fetches of the same symbol are coalesced into one scrape
+        self.flight = SingleFlight() if flight is None else flight
+        # called with every security whose quote was fetched
+        self.on_fetch = on_fetch
+
+        self._fetched = {}
+        self._refreshing = set()
+        self._lock = Lock()
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stale_hits': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'fallbacks': 0,
+            'prefetches': 0
+        }
+
+        self.logger = logging.getLogger('QuoteCache')
+
+    def _count(self, key):
+        self.stats[key] += 1
+
+    def get(self, symbol, create):
+        """
+        Returns the security for symbol, fetching it if necessary. create() is
+        called to scrape securities that are not known yet.
+        """
+        with self._lock:
+            sec = self.securities.get(symbol)
+            fetched = self._fetched.get(symbol)
+
+            if sec is not None and fetched is not None:
+                if monotonic() - fetched < self.ttl:
+                    self._count('hits')
+                else:
+                    self._count('stale_hits')
+                    if symbol not in self._refreshing:
+                        self._refreshing.add(symbol)
+                        Thread(
+                            target=self._refresh, name="quote refresh for {}".format(symbol),
+                            args=(symbol,), daemon=True
+                        ).start()
+                return sec
+
+            self._count('misses')
+
+        return self.flight.do(('info', symbol), lambda: self._fetch(symbol, create))
+
+    def _fetch(self, symbol, create, fallback=True):
+        with self._lock:
+            sec = self.securities.get(symbol)
+
+        if sec is None:
+            sec = create()
+        else:
+            try:
+                sec.update()
+            except self.unavailable as e:
+                if not fallback:
+                    raise
+                return self._last_known(sec, e)
+
+        with self._lock:
+            self.securities[symbol] = sec
+            self._fetched[symbol] = monotonic()
+
+        if self.on_fetch is not None:
+            self.on_fetch(sec)
+        return sec
+
+    def _last_known(self, sec, e):
+        # serve the quote we have (without marking it fresh), if there is one
+        if sec.last_price_update is None:
+            raise e
+        self.logger.warning('Serving last known quote of {}: {}'.format(sec.symbol, e))
+        with self._lock:
+            self._count('fallbacks')
+        return sec
+
+    def _refresh(self, symbol):
+        self.logger.debug('Refreshing stale quote for {}'.format(symbol))
+        try:
+            self.flight.do(('info', symbol), lambda: self._fetch(symbol, None, fallback=False))
+            with self._lock:
+                self._count('refreshes')
+        except Exception:
+            self.logger.exception('Could not refresh quote for {}'.format(symbol))
+            with self._lock:
+                self._count('refresh_errors')
+        finally:
+            with self._lock:
+                self._refreshing.discard(symbol)
+
+    def prefetch(self, symbol, create, ahead=0):
+        """
+        Fetches the quote of symbol ahead of a request expected in ahead
+        seconds, unless it will still be fresh by then, and returns the
+        security.
+        """
+        with self._lock:
+            sec = self.securities.get(symbol)
+            fetched = self._fetched.get(symbol)
+            if sec is not None and fetched is not None and monotonic() + ahead - fetched < self.ttl:
+                return sec
+            self._count('prefetches')
+
+        return self.flight.do(('info', symbol), lambda: self._fetch(symbol, create, fallback=False))
+
+    def info(self):
+        with self._lock:
+            info = dict(self.stats)
+            info['ttl'] = self.ttl
+            info['size'] = len(self._fetched)
+            info['refreshing'] = len(self._refreshing)
+        return info
+
+    # Asynchronous variant of get(), for the asyncio server. Fetches and
+    # refreshes run as coroutines on the event loop instead of in threads.
+
+    async def get_async(self, symbol, create):
+        """
+        Like get(), but create() returns an awaitable and securities are
+        updated with update_async().
+        """
+        with self._lock:
+            sec = self.securities.get(symbol)
+            fetched = self._fetched.get(symbol)
+
+            if sec is not None and fetched is not None:
+                if monotonic() - fetched < self.ttl:
+                    self._count('hits')
+                else:
+                    self._count('stale_hits')
+                    if symbol not in self._refreshing:
+                        self._refreshing.add(symbol)
+                        asyncio.ensure_future(self._refresh_async(symbol))
+                return sec
+
+            self._count('misses')
+
+        return await self._fetch_async(symbol, create)
+
+    async def _fetch_async(self, symbol, create, fallback=True):
+        # in the same flight as get(), so a coroutine and e.g. a prefetching thread share one scrape
+        return await self.flight.do_async(('info', symbol), lambda: self._update_async(symbol, create, fallback))
+
+    async def _update_async(self, symbol, create, fallback):
+        with self._lock:
+            sec = self.securities.get(symbol)
+
+        try:
+            if sec is None:
+                sec = await create()
+            elif sec.update_hook_async is None:
+                await asyncio.get_running_loop().run_in_executor(None, carry(sec.update))
+            else:
+                await sec.update_async()
+        except self.unavailable as e:
+            if sec is None or not fallback:
+                raise
+            return self._last_known(sec, e)
+
+        with self._lock:
+            self.securities[symbol] = sec
+            self._fetched[symbol] = monotonic()
+
+        if self.on_fetch is not None:
+            self.on_fetch(sec)
+        return sec
+
+    async def _refresh_async(self, symbol):
+        self.logger.debug('Refreshing stale quote for {}'.format(symbol))
+        try:
+            await self._fetch_async(symbol, None, fallback=False)
+            with self._lock:
+                self._count('refreshes')
+        except Exception:
+            self.logger.exception('Could not refresh quote for {}'.format(symbol))
+            with self._lock:
+                self._count('refresh_errors')
+        finally:
+            with self._lock:
+                self._refreshing.discard(symbol)
+
+class SharedQuoteCache:
+    """
+    The quote cache of a worker process in prefork mode (see ppserve.prefork).
+    Workers never scrape: they serve the securities the updater process
+    published to the shared store, reloading one whenever its stamp changed.
+
+    Securities whose quote was never fetched are requested from the updater
+    with fetch(symbol), which returns once they are stored. Stale ones are
+    served as they are while the updater is asked in the background to
+    refresh them, at most every refresh_interval seconds.
+    """
+
+    def __init__(self, securities, store, fetch, ttl=300, flight=None, refresh_interval=5, on_reload=None):
+        self.securities = securities
+        self.store = store
+        self.fetch = fetch
+        self.ttl = ttl
+        # concurrent requests for the same symbol ask the updater only once
+        self.flight = SingleFlight() if flight is None else flight
+        self.refresh_interval = refresh_interval
+        # called with every security that was reloaded from the store
+        self.on_reload = on_reload
+
+        # symbol -> (stamp, history_stamp) of the loaded securities
+        self._stamps = {}
+        # symbol -> when the updater was last asked to refresh it
+        self._refreshed = {}
+        self._lock = Lock()
+        self._reload_lock = Lock()
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stale_hits': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'fallbacks': 0,
+            'reloads': 0
+        }
+
+        self.logger = logging.getLogger('SharedQuoteCache')
+
+    def _count(self, key):
+        self.stats[key] += 1
+
+    def get(self, symbol, create=None):
+        """
+        Returns the security for symbol. create is ignored, the updater
+        creates new securities.
+        """
+        sec = self._lookup(symbol)
+        if sec is None:
+            sec = self.flight.do(('info', symbol), lambda: self._fetch(symbol))
+        return sec
+
+    async def get_async(self, symbol, create=None):
+        sec = self._lookup(symbol)
+        if sec is None:
+            sec = await asyncio.get_running_loop().run_in_executor(
+                None, carry(self.flight.do), ('info', symbol), lambda: self._fetch(symbol)
+            )
+        return sec
+
+    def _lookup(self, symbol):
+        # the stored security, or None if the updater hasn't fetched its quote yet
+        row = self.store.stamps(symbol)
+        if row is None or row[2] is None:
+            with self._lock:
+                self._count('misses')
+            return None
+
+        stamp, history_stamp, fetched = row
+        sec = self._load(symbol, stamp, history_stamp)
+
+        with self._lock:
+            if time() - fetched < self.ttl:
+                self._count('hits')
+            else:
+                self._count('stale_hits')
+                if monotonic() - self._refreshed.get(symbol, float('-inf')) >= self.refresh_interval:
+                    self._refreshed[symbol] = monotonic()
+                    Thread(
+                        target=self._refresh, name="quote refresh for {}".format(symbol),
+                        args=(symbol,), daemon=True
+                    ).start()
+        return sec
+
+    def _fetch(self, symbol):
+        self.fetch(symbol)
+        row = self.store.stamps(symbol)
+        if row is None:
+            raise LookupError('The updater did not store {}'.format(symbol))
+        return self._load(symbol, row[0], row[1])
+
+    def _load(self, symbol, stamp, history_stamp):
+        with self._lock:
+            sec = self.securities.get(symbol)
+            if sec is not None and self._stamps.get(symbol) == (stamp, history_stamp):
+                return sec
+
+        with self._reload_lock:
+            with self._lock:
+                sec = self.securities.get(symbol)
+                loaded = self._stamps.get(symbol)
+            row = self.store.load(symbol)
+            if loaded == (row['stamp'], row['history_stamp']):
+                # another thread was faster
+                return sec
+
+            self.logger.debug('Loading {} (stamp {})'.format(symbol, row['stamp']))
+            if sec is None or type(sec).__name__ != row['class']:
+                sec = getattr(securities, row['class'])(symbol)
+            elif (loaded is None or loaded[1] != row['history_stamp']) and sec.history_loaded:
+                sec.read_quotes()
+            sec.update_from_dict(row['data'])
+            # the same in every worker, so ETag and Last-Modified don't depend on which one answers
+            sec.version = row['stamp']
+            sec.last_modified = row['modified']
+
+            with self._lock:
+                self.securities[symbol] = sec
+                self._stamps[symbol] = (row['stamp'], row['history_stamp'])
+                self._count('reloads')
+
+        if self.on_reload is not None:
+            self.on_reload(sec)
+        return sec
+
+    def _refresh(self, symbol):
+        self.logger.debug('Asking the updater to refresh {}'.format(symbol))
+        try:
+            self.fetch(symbol)
+            with self._lock:
+                self._count('refreshes')
+        except Exception as e:
+            self.logger.warning('Could not refresh quote for {}: {}'.format(symbol, e))
+            with self._lock:
+                self._count('refresh_errors')
+
+    def info(self):
+        with self._lock:
+            info = dict(self.stats)
+            info['ttl'] = self.ttl
+            info['size'] = len(self._stamps)
+        return info
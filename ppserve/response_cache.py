@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from threading import Lock
+
+class ResponseCache:
+    """
+    Least recently used cache of rendered response bodies, holding at most
+    max_bytes of them (UTF-8 encoded, as they are stored and served) in total.
+
+    Entries are stored under the parameters of a request, starting with the
+    symbol, together with a stamp of the data they were rendered from (e.g.
+    the security's version and the exchange rates' version). A lookup with a
+    different stamp drops the entry, so a body is never served after its data
+    changed. To free their memory before that, invalidate(symbol) drops the
+    entries of a security that changed and clear() all of them.
+    """
+
+    def __init__(self, max_bytes=32*1024*1024, max_entry_bytes=None):
+        self.max_bytes = max_bytes
+        # a single huge table should not evict everything else
+        self.max_entry_bytes = max_bytes//4 if max_entry_bytes is None else max_entry_bytes
+
+        self._entries = OrderedDict()  # key -> (stamp, body)
+        self._size = 0
+        self._lock = Lock()
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'evictions': 0
+        }
+
+    def _drop(self, key):
+        # must hold self._lock
+        _, body = self._entries.pop(key)
+        self._size -= len(body)
+
+    def get(self, key, stamp):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != stamp:
+                self._drop(key)
+                self.stats['invalidations'] += 1
+                entry = None
+
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, stamp, body):
+        if isinstance(body, str):
+            body = body.encode()
+        if len(body) > self.max_entry_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (stamp, body)
+            self._size += len(body)
+
+            while self._size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+
+    def tee(self, key, stamp, chunks):
+        """
+        Yields the chunks of a streamed body and stores their concatenation
+        once the stream is complete. Streams that are aborted, or that grow
+        beyond max_entry_bytes, are not stored.
+        """
+        parts = []
+        size = 0
+        try:
+            for chunk in chunks:
+                if parts is not None:
+                    encoded = chunk.encode() if isinstance(chunk, str) else chunk
+                    size += len(encoded)
+                    if size <= self.max_entry_bytes:
+                        parts.append(encoded)
+                    else:
+                        parts = None
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+        if parts is not None:
+            self.put(key, stamp, b''.join(parts))
+
+    def invalidate(self, symbol):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == symbol]:
+                self._drop(key)
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def info(self):
+        with self._lock:
+            info = dict(self.stats)
+            info['entries'] = len(self._entries)
+            info['bytes'] = self._size
+            info['max_bytes'] = self.max_bytes
+        lookups = info['hits'] + info['misses']
+        info['hit_ratio'] = round(info['hits']/lookups, 3) if lookups else None
+        return info
@@ -0,0 +1,207 @@
+import heapq
+import logging
+import random
+from datetime import date, timedelta
+from itertools import count
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep, time
+from urllib.parse import urlsplit
+
+class TokenBucket:
+    """
+    Rate limiter allowing rate acquisitions per second on average, in bursts
+    of up to burst at once.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+
+        self._tokens = burst
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated)*self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Takes a token, waiting for one to become available if necessary.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens)/self.rate
+            sleep(wait)
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+def missing_recent_days(sec):
+    """
+    Returns True if the price history of sec lacks the last business day.
+    """
+    dates = sec.history_dates(limit=1)
+    if not dates:
+        return True
+    expected = date.today() - timedelta(days=1)
+    while expected.weekday() >= 5:
+        expected -= timedelta(days=1)
+    return dates[-1] < expected
+
+def source_host(sec):
+    # by the price source if possible, as securities from my_bonds.yaml have
+    # no URL before their first update
+    source = getattr(sec.update_hook_historic, '__self__', None)
+    if source is not None:
+        return source.host
+    url = getattr(sec.url, 'full_url', sec.url)
+    return urlsplit(url).netloc if url else ''
+
+class RefreshScheduler:
+    """
+    Periodically runs job(sec) (e.g. a historic price update) for every
+    security added, on a fixed number of worker threads.
+
+    Each symbol has at most one job queued or running. Jobs run when they are
+    due; due times are jittered so that securities don't all update at once.
+    Symbols that were requested recently, or whose history lacks the last
+    business day, are rescheduled sooner and win ties. Before a job runs it
+    takes a token from the rate limiter of its upstream host.
+    """
+
+    def __init__(self, job, workers=2, interval=3*3600, jitter=0.1, rate=0.5, burst=4):
+        self.job = job
+        self.workers = workers
+        self.interval = interval
+        self.jitter = jitter
+        self.rate = rate
+        self.burst = burst
+
+        self._queue = []
+        self._seq = count()
+        self._due = {}  # symbol -> (due, priority, seq), the job that is currently queued
+        self._securities = {}
+        self._running = {}  # symbol -> start time
+        self._requested = {}  # symbol -> last time it was requested
+        self._buckets = {}
+        self._threads = []
+        self._cond = Condition()
+
+        self.durations = {}  # symbol -> duration of the last job
+        self.stats = {
+            'runs': 0,
+            'errors': 0
+        }
+
+        self.logger = logging.getLogger('RefreshScheduler')
+
+    def _jittered(self, delay):
+        return delay*random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _hot(self, sec):
+        requested = self._requested.get(sec.symbol)
+        recently_requested = requested is not None and monotonic() - requested < self.interval
+        return recently_requested or missing_recent_days(sec)
+
+    def _push(self, sec, delay, priority=1):
+        # must hold self._cond
+        entry = (monotonic() + delay, priority, next(self._seq))
+        self._due[sec.symbol] = entry
+        self._securities[sec.symbol] = sec
+        heapq.heappush(self._queue, entry + (sec.symbol,))
+        self._cond.notify()
+
+    def add(self, sec, delay=None):
+        """
+        Schedules sec, unless it is already queued or running.
+        """
+        with self._cond:
+            if sec.symbol in self._due or sec.symbol in self._running:
+                return
+            self._push(sec, random.uniform(0, 10) if delay is None else delay)
+
+    def note_request(self, symbol):
+        """
+        Records that symbol was requested. If its history is incomplete, its
+        queued job is moved to the front. Only scheduled securities are
+        recorded, so requests for arbitrary symbols don't pile up.
+        """
+        with self._cond:
+            sec = self._securities.get(symbol)
+            if sec is None:
+                return
+            self._requested[symbol] = monotonic()
+            if symbol not in self._due or not sec.history_loaded:
+                return
+            if missing_recent_days(sec) and self._due[symbol][0] > monotonic():
+                self._push(sec, 0, priority=0)
+
+    def _next(self):
+        with self._cond:
+            while True:
+                # skip entries that were superseded by a later _push
+                while self._queue and self._due.get(self._queue[0][3]) != self._queue[0][:3]:
+                    heapq.heappop(self._queue)
+                if self._queue and self._queue[0][0] <= monotonic():
+                    symbol = heapq.heappop(self._queue)[3]
+                    del self._due[symbol]
+                    self._running[symbol] = time()
+                    return self._securities[symbol]
+                self._cond.wait(self._queue[0][0] - monotonic() if self._queue else None)
+
+    def _bucket(self, host):
+        with self._cond:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+            return self._buckets[host]
+
+    def _work(self):
+        while True:
+            sec = self._next()
+            self._bucket(source_host(sec)).acquire()
+
+            started = monotonic()
+            try:
+                self.job(sec)
+            except Exception:
+                self.logger.exception('Updating {} failed'.format(sec.symbol))
+                with self._cond:
+                    self.stats['errors'] += 1
+
+            with self._cond:
+                self.durations[sec.symbol] = monotonic() - started
+                self.stats['runs'] += 1
+                del self._running[sec.symbol]
+
+                if self._hot(sec):
+                    self._push(sec, self._jittered(self.interval/4), priority=0)
+                else:
+                    self._push(sec, self._jittered(self.interval))
+
+    def start(self):
+        for i in range(self.workers):
+            t = Thread(target=self._work, name="price updater {}".format(i), daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def info(self):
+        with self._cond:
+            now = monotonic()
+            return {
+                'queued': len(self._due),
+                'running': {symbol: round(time() - started, 3) for symbol, started in self._running.items()},
+                'next_due': {symbol: round(entry[0] - now, 1) for symbol, entry in self._due.items()},
+                'durations': {symbol: round(d, 3) for symbol, d in self.durations.items()},
+                'tokens': {host: round(bucket.tokens, 2) for host, bucket in self._buckets.items()},
+                'runs': self.stats['runs'],
+                'errors': self.stats['errors']
+            }
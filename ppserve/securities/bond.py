@@ -1,15 +1,35 @@
+import calendar
 from datetime import date
 from dateutil.relativedelta import relativedelta
 from math import floor
 
+import numpy as np
+
 from .security import Security
 from .util import currency_aware
+from ..tracing import span
+
+def coupon_date(year, month, day):
+    # coupons due on e.g. Feb 29 or the 31st are paid on the last day of shorter months
+    return date(year, month, min(day, calendar.monthrange(year, month)[1]))
 
 class Bond(Security):
 
+    __slots__ = (
+        '_schedule', '_interest_from', '_maturity', '_interest_dates', 'interest_rate',
+        '_accrued_interest_fetched'
+    )
+
+    data_fields = Security.data_fields + (
+        'interest_from', 'maturity', 'interest_dates', 'interest_rate', '_accrued_interest_fetched'
+    )
+
     def __init__(self, symbol, read_quotes=True):
         Security.__init__(self, symbol, read_quotes)
 
+        # coupon dates and period lengths, see _coupon_schedule
+        self._schedule = None
+
         self.interest_from = None
         self.maturity = None
         self.interest_dates = None
@@ -20,6 +40,91 @@ class Bond(Security):
     def __repr__(self):
         return '<Bond: symbol {}>'.format(self.symbol)
 
+    # changing any of these invalidates the coupon schedule
+
+    @property
+    def interest_dates(self): return self._interest_dates
+
+    @interest_dates.setter
+    def interest_dates(self, value):
+        self._interest_dates = value
+        self._schedule = None
+
+    @property
+    def interest_from(self): return self._interest_from
+
+    @interest_from.setter
+    def interest_from(self, value):
+        self._interest_from = value
+        self._schedule = None
+
+    @property
+    def maturity(self): return self._maturity
+
+    @maturity.setter
+    def maturity(self, value):
+        self._maturity = value
+        self._schedule = None
+
+    def _coupon_schedule(self, first_year, last_year):
+        """
+        Returns the ordinals of all coupon dates from first_year through
+        last_year + 1 in ascending order, together with the length in days of
+        the interest period ending at each of them.
+        """
+        if self._schedule is not None and self._schedule[0] <= first_year and last_year <= self._schedule[1]:
+            return self._schedule[2:]
+
+        # build the schedule for the whole life of the bond at once
+        if self.interest_from is not None:
+            first_year = min(first_year, self.interest_from.year)
+        last_year = max(last_year, (self.maturity or date.today()).year)
+        if self._schedule is not None:
+            first_year = min(first_year, self._schedule[0])
+            last_year = max(last_year, self._schedule[1])
+
+        period = relativedelta(months=-floor(12/len(self.interest_dates)))
+        coupons = sorted(coupon_date(year, m, d) for year in range(first_year, last_year + 2) for d, m in self.interest_dates)
+
+        self._schedule = (
+            first_year,
+            last_year,
+            np.array([c.toordinal() for c in coupons], dtype=np.int64),
+            np.array([(c - (c + period)).days for c in coupons], dtype=np.int64)
+        )
+        return self._schedule[2:]
+
+    def accrued_interest_series(self, dates):
+        """
+        Returns an array with the bond's accrued interest at each of the given
+        dates (or date ordinals), computed in one pass over the coupon schedule.
+        """
+        if isinstance(dates, np.ndarray):
+            ordinals = dates.astype(np.int64)
+        else:
+            dates = list(dates)
+            ordinals = np.fromiter((d.toordinal() for d in dates), dtype=np.int64, count=len(dates))
+        if not len(ordinals):
+            return np.zeros(0)
+
+        matured = np.zeros(len(ordinals), dtype=bool)
+        if self.maturity is not None:
+            matured = ordinals > self.maturity.toordinal()
+
+        if (self.interest_dates is None) or (self.interest_rate is None):
+            if matured.all():
+                return np.zeros(len(ordinals))
+            raise ValueError('Not enough information to compute accrued interest for {} at date {}.'.format(self.symbol, date.fromordinal(int(ordinals[np.argmin(matured)]))))
+
+        coupons, periods = self._coupon_schedule(date.fromordinal(int(ordinals.min())).year, date.fromordinal(int(ordinals.max())).year)
+
+        # the next interest payment is the first coupon date on or after each date
+        next_ = np.searchsorted(coupons, ordinals, side='left')
+        accrued = (periods[next_] - (coupons[next_] - ordinals)) * self.interest_rate/365
+        accrued[matured] = 0
+
+        return accrued
+
     def accrued_interest(self, target_date=None):
         """
         Returns the bond's accrued interest at target_date if there is enough information
@@ -31,31 +136,8 @@ class Bond(Security):
         if target_date == date.today and self._accrued_interest_fetched is not None:
             return self._accrued_interest_fetched
 
-        if (self.maturity is not None) and (self.maturity < target_date):
-            return 0
-
-        if (self.interest_dates is not None) and (self.interest_rate is not None):
-            # find the date of the next interest payment
-            next_date = None
-
-            # look for dates in the same year as target_date
-            for date_ in sorted((date(target_date.year, m, d) for d,m in self.interest_dates)):
-                if target_date <= date_:
-                    next_date = date_
-                    break
-
-            # look for the earliest interest date in the next year
-            if next_date is None:
-                next_date = min([date(target_date.year + 1, month, day) for day, month in self.interest_dates])
-
-            computed_interest = (
-                (next_date - (next_date + relativedelta(months=-floor(12/len(self.interest_dates))))).days
-                - (next_date - target_date).days
-            ) * self.interest_rate/365
-
-            return computed_interest
-
-        raise ValueError('Not enough information to compute accrued interest for {} at date {}.'.format(self.symbol, target_date))
+        with span('accrued_interest', dates=1):
+            return self.accrued_interest_series([target_date])[0].item()
 
     @currency_aware
     def dirty_high(self):
@@ -73,10 +155,10 @@ class Bond(Security):
         return (self.last() + self.accrued_interest())
 
     @currency_aware
-    def dirty_price_history(self, target_currency=None):
-        return {
-            d: (quote + self.accrued_interest(target_date=d)) for d, quote in self._price_history.items()
-        }
+    def dirty_price_history(self, start_date=None, end_date=None, limit=None):
+        history = self._price_history.slice(start_date, end_date, limit)
+        with span('accrued_interest', dates=len(history)):
+            return history.with_closes(history.closes + self.accrued_interest_series(history.ordinals))
 
     @property
     def current_yield(self):
@@ -0,0 +1,79 @@
+import calendar
+import json
+import os
+from datetime import date
+
+def month_index(d):
+    return d.year*12 + d.month - 1
+
+def month_start(index):
+    return date(index//12, index%12 + 1, 1)
+
+def month_end(index):
+    year, month = index//12, index%12 + 1
+    return date(year, month, calendar.monthrange(year, month)[1])
+
+class Coverage:
+    """
+    The months for which the complete historic quotes of a security have been
+    fetched, persisted as a JSON list of 'YYYY-MM' strings next to its quote
+    store. A month only counts as covered once it is over, so the current
+    month is fetched on every update.
+
+    Histories stored before the index existed are bootstrapped from their
+    quotes: months with at least one quote count as covered, so only empty
+    months (e.g. from a failed fetch) are fetched again. The month of the
+    newest quote is fetched again as well, as it may have been stored before
+    the month was over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.months = set()
+
+    def read(self):
+        with open(self.path, 'r') as f:
+            self.months = {month_index(date(int(m[:4]), int(m[5:7]), 1)) for m in json.load(f)}
+
+    def write(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(['{:04d}-{:02d}'.format(m//12, m%12 + 1) for m in sorted(self.months)], f)
+        os.replace(tmp_path, self.path)
+
+    def bootstrap(self, dates, today=None):
+        """
+        Marks the months of dates as covered, except the month of the newest
+        date, which may only be partially stored, and those that aren't over
+        yet.
+        """
+        months = {month_index(d) for d in dates}
+        newest = max(months, default=None)
+        current = month_index(today or date.today())
+        self.months = {m for m in months if m != newest and m < current}
+
+    def add(self, start_date, end_date, today=None):
+        """
+        Marks the months from start_date through end_date as covered, except
+        for those that aren't over yet.
+        """
+        current = month_index(today or date.today())
+        self.months.update(range(month_index(start_date), min(month_index(end_date) + 1, current)))
+
+    def missing(self, start_date, end_date, max_months=12):
+        """
+        Returns the months between start_date and end_date that are not
+        covered, as (first day, last day) ranges of consecutive months, most
+        recent first. Ranges are at most max_months long, so an interrupted
+        backfill keeps the months fetched before.
+        """
+        months = [m for m in range(month_index(end_date), month_index(start_date) - 1, -1) if m not in self.months]
+
+        ranges = []
+        for m in months:
+            if ranges and ranges[-1][0] == m + 1 and ranges[-1][1] - m < max_months:
+                ranges[-1][0] = m
+            else:
+                ranges.append([m, m])
+        return [(month_start(first), min(month_end(last), end_date)) for first, last in ranges]
@@ -2,6 +2,8 @@ from .security import Security
 
 class ETF(Security):
 
+    __slots__ = ()
+
     def __init__(self, symbol, read_quotes=True):
         Security.__init__(self, symbol, read_quotes)
 
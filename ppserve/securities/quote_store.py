@@ -0,0 +1,168 @@
+import mmap
+import os
+import struct
+from datetime import date
+
+import numpy as np
+
+from .series import PriceSeries
+
+class QuoteStore:
+    """
+    Binary store for the price history of a security.
+
+    The file starts with a 16 byte header (magic, format version and the
+    number of committed records), followed by fixed-width records of a date
+    ordinal (int32) and a closing price (float64), sorted by date.
+
+    Quotes newer than the last stored one are appended: the records are
+    written and synced first, then committed by updating the record count in
+    the header, so an interrupted append leaves the previous state intact.
+    Any other change rewrites the file and atomically replaces the old one.
+    Reads memory-map the file instead of parsing it.
+    """
+
+    magic = b'PPQS'
+    version = 1
+    header = struct.Struct('<4sHxxQ')
+    record = np.dtype([('date', '<i4'), ('close', '<f8')])
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _check_header(self, buf):
+        if len(buf) < self.header.size:
+            raise ValueError('{} is truncated'.format(self.path))
+        magic, version, count = self.header.unpack_from(buf)
+        if magic != self.magic or version != self.version:
+            raise ValueError('{} is not a quote store (version {})'.format(self.path, self.version))
+        return count
+
+    def records(self):
+        """
+        Returns the committed records as a read-only structured array backed by
+        a memory map of the file. Raises FileNotFoundError if there is no store.
+        """
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError('{} is empty'.format(self.path))
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        count = self._check_header(buf)
+        # another process may have committed an append after the file was mapped
+        count = min(count, (len(buf) - self.header.size)//self.record.itemsize)
+        return np.frombuffer(buf, dtype=self.record, count=count, offset=self.header.size)
+
+    def read(self, start_date=None, end_date=None):
+        """
+        Returns the stored quotes between start_date and end_date (both
+        inclusive, both optional) as a PriceSeries.
+        """
+        recs = self.records()
+        lo, hi = 0, len(recs)
+        if start_date is not None:
+            lo = np.searchsorted(recs['date'], start_date.toordinal(), side='left')
+        if end_date is not None:
+            hi = np.searchsorted(recs['date'], end_date.toordinal(), side='right')
+        recs = recs[lo:hi]
+        # copied, so the series can change and the file be replaced
+        return PriceSeries(np.array(recs['date'], dtype=np.int32), np.array(recs['close'], dtype=np.float64))
+
+    def last_date(self):
+        try:
+            recs = self.records()
+        except FileNotFoundError:
+            return None
+        if len(recs) == 0:
+            return None
+        return date.fromordinal(int(recs['date'][-1]))
+
+    @classmethod
+    def _to_records(cls, items):
+        if isinstance(items, PriceSeries):
+            # already sorted; sliced for dates and closes of the same moment
+            items = items.slice()
+            recs = np.empty(len(items), dtype=cls.record)
+            recs['date'] = items.ordinals
+            recs['close'] = items.closes
+            return recs
+
+        items = sorted(items)
+        recs = np.empty(len(items), dtype=cls.record)
+        recs['date'] = [d.toordinal() for d, _ in items]
+        recs['close'] = [quote for _, quote in items]
+        return recs
+
+    def _fsync_dir(self):
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def write(self, items):
+        """
+        Replaces the store with the (date, close) pairs in items, or with a
+        PriceSeries.
+        """
+        recs = self._to_records(items)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.version, len(recs)))
+            f.write(recs.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._fsync_dir()
+
+    def append(self, items):
+        """
+        Appends the (date, close) pairs in items, which must all be newer than
+        the last stored quote.
+        """
+        recs = self._to_records(items)
+        if len(recs) == 0:
+            return
+
+        with open(self.path, 'r+b') as f:
+            count = self._check_header(f.read(self.header.size))
+            end = self.header.size + count*self.record.itemsize
+
+            if count > 0:
+                f.seek(end - self.record.itemsize)
+                last = np.frombuffer(f.read(self.record.itemsize), dtype=self.record)[0]
+                if recs['date'][0] <= last['date']:
+                    raise ValueError('Can only append quotes newer than {}'.format(date.fromordinal(int(last['date']))))
+
+            # drop whatever an interrupted append may have left behind
+            f.truncate(end)
+            f.seek(end)
+            f.write(recs.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+            # commit
+            f.seek(0)
+            f.write(self.header.pack(self.magic, self.version, count + len(recs)))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def save(self, history, changed):
+        """
+        Brings the store up to date with history (a PriceSeries, or a dict of
+        dates and closing prices), given the dates in changed that were added or modified since
+        the store was last read or saved. Appends if possible, rewrites otherwise.
+        """
+        if self.exists():
+            if not changed:
+                return
+            last_date = self.last_date()
+            if last_date is None or min(changed) > last_date:
+                self.append((d, history[d]) for d in changed)
+                return
+
+        self.write(history if isinstance(history, PriceSeries) else history.items())
@@ -0,0 +1,262 @@
+import io
+import logging
+import os
+import urllib.request
+import zipfile
+from datetime import date
+from pathlib import Path
+from threading import Lock, Thread
+from time import sleep, time
+
+import numpy as np
+
+from ..singleflight import SingleFlight
+
+class RateTable:
+    """
+    ECB reference exchange rates (units of each currency per euro), kept as
+    one dense array of daily rates per currency.
+
+    The table is loaded lazily, on the first cross-currency conversion: from
+    the pre-parsed copy at cache_path if there is one, otherwise by
+    downloading the ECB's zipped CSV file from url (giving up after timeout
+    seconds without an answer). If that fails (or in offline mode) the last
+    cached table is used, or the file bundled with CurrencyConverter if
+    nothing was cached yet. A refresher thread can replace the table by a
+    newer download in the background. Downloads don't hold the lock, so
+    conversions go on with the current table meanwhile.
+    """
+
+    ref_currency = 'EUR'
+
+    def __init__(self, url, cache_path, max_age=24*3600, offline=False, timeout=30):
+        self.url = url
+        self.cache_path = Path(cache_path)
+        self.max_age = max_age
+        self.offline = offline
+        self.timeout = timeout
+
+        # currency -> (ordinal of the first date, array of daily rates)
+        self._rates = None
+        # when the table was downloaded (0 for the table bundled with CurrencyConverter)
+        self.updated = None
+        # bumped whenever a new table is loaded
+        self.version = 0
+        # called after a new table was loaded
+        self.on_change = None
+
+        self._lock = Lock()
+        # concurrent first conversions wait for the same load
+        self._flight = SingleFlight()
+        self._refresher = None
+
+        self.logger = logging.getLogger('RateTable')
+
+    @staticmethod
+    def _parse(zip_data):
+        """
+        Parses the ECB's zipped CSV file (a row of rates per currency per day,
+        newest first). Missing days (weekends, holidays) within the range of
+        every currency are interpolated linearly.
+        """
+        with zipfile.ZipFile(io.BytesIO(zip_data)) as z:
+            lines = z.read(z.namelist()[0]).decode('utf-8').splitlines()
+
+        currencies = [c.strip() for c in lines[0].split(',')[1:]]
+        by_currency = {c: ([], []) for c in currencies if c}
+        for line in lines[1:]:
+            fields = [f.strip() for f in line.split(',')]
+            if not fields[0]:
+                continue
+            ordinal = date(int(fields[0][:4]), int(fields[0][5:7]), int(fields[0][8:10])).toordinal()
+            for currency, rate in zip(currencies, fields[1:]):
+                if currency and rate not in ('', 'N/A'):
+                    by_currency[currency][0].append(ordinal)
+                    by_currency[currency][1].append(float(rate))
+
+        rates = {}
+        for currency, (ordinals, values) in by_currency.items():
+            if not ordinals:
+                continue
+            ordinals = np.array(ordinals)
+            order = np.argsort(ordinals)
+            ordinals, values = ordinals[order], np.array(values, dtype=float)[order]
+            rates[currency] = (int(ordinals[0]), np.interp(np.arange(ordinals[0], ordinals[-1] + 1), ordinals, values))
+        return rates
+
+    def _bundled(self):
+        from currency_converter import CURRENCY_FILE
+        with open(CURRENCY_FILE, 'rb') as f:
+            return self._parse(f.read())
+
+    def _read_cache(self):
+        with np.load(self.cache_path) as f:
+            rates = {}
+            offsets = np.concatenate(([0], np.cumsum(f['lengths'])))
+            values = f['rates']
+            for i, currency in enumerate(f['currencies'].tolist()):
+                rates[currency] = (int(f['first'][i]), values[offsets[i]:offsets[i+1]])
+            return rates, float(f['updated'])
+
+    def _write_cache(self, rates, updated):
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        currencies = sorted(rates.keys())
+        tmp_path = self.cache_path.with_name(self.cache_path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                currencies=np.array(currencies),
+                first=np.array([rates[c][0] for c in currencies], dtype=np.int64),
+                lengths=np.array([len(rates[c][1]) for c in currencies], dtype=np.int64),
+                rates=np.concatenate([rates[c][1] for c in currencies]),
+                updated=np.array(updated)
+            )
+        os.replace(tmp_path, self.cache_path)
+
+    def _set(self, rates, updated):
+        self._rates = rates
+        self.updated = updated
+        self.version += 1
+        if self.on_change is not None:
+            self.on_change()
+
+    def _download(self):
+        self.logger.info('Downloading exchange rates from {}'.format(self.url))
+        with urllib.request.urlopen(self.url, timeout=self.timeout) as response:
+            rates = self._parse(response.read())
+        updated = time()
+        self._write_cache(rates, updated)
+        return rates, updated
+
+    def load(self):
+        if self._rates is None:
+            self._flight.do('load', self._load)
+
+    def _load(self):
+        if self._rates is not None:
+            return
+
+        try:
+            rates, updated = self._read_cache()
+            self.logger.debug('Loaded exchange rates from {}'.format(self.cache_path))
+        except FileNotFoundError:
+            rates = None
+        except (OSError, ValueError, KeyError):
+            self.logger.warning('Ignoring corrupt exchange rate cache {}'.format(self.cache_path))
+            rates = None
+
+        if rates is None and not self.offline:
+            try:
+                rates, updated = self._download()
+            except Exception as e:
+                self.logger.warning('Could not download exchange rates: {}'.format(e))
+
+        if rates is None:
+            self.logger.warning('Using the exchange rates bundled with CurrencyConverter; they may be outdated.')
+            rates, updated = self._bundled(), 0
+            # cache them anyway, so this only happens once
+            self._write_cache(rates, updated)
+
+        with self._lock:
+            # unless a refresh was faster
+            if self._rates is None:
+                self._set(rates, updated)
+
+    def refresh(self):
+        """
+        Downloads the current table and replaces the loaded one. Keeps the
+        loaded table if the download fails. In offline mode, only a newer
+        table cached by another process (e.g. the updater, see
+        ppserve.prefork) replaces the loaded one.
+        """
+        if self.offline:
+            self._reload()
+            return
+        try:
+            rates, updated = self._download()
+        except Exception as e:
+            self.logger.warning('Could not refresh exchange rates, keeping the current ones: {}'.format(e))
+            return
+        with self._lock:
+            self._set(rates, updated)
+
+    def _reload(self):
+        try:
+            rates, updated = self._read_cache()
+        except (OSError, ValueError, KeyError):
+            return
+        with self._lock:
+            if updated > (self.updated or 0):
+                self.logger.info('Loaded newer exchange rates from {}'.format(self.cache_path))
+                self._set(rates, updated)
+
+    def is_stale(self):
+        return time() - (self.updated or 0) > self.max_age
+
+    def start_refresher(self, interval=3600):
+        """
+        Starts a background thread that checks every interval seconds whether
+        the table is older than max_age and refreshes it if so.
+        """
+        def refresher():
+            while True:
+                if self._rates is not None and self.is_stale():
+                    self.refresh()
+                sleep(interval)
+
+        if self._refresher is None:
+            self._refresher = Thread(target=refresher, name="exchange rate refresher", daemon=True)
+            self._refresher.start()
+
+    @property
+    def loaded(self):
+        return self._rates is not None
+
+    @property
+    def rates(self):
+        if self._rates is None:
+            self.load()
+        return self._rates
+
+    @property
+    def currencies(self):
+        return set(self.rates.keys()) | {self.ref_currency}
+
+    def _check(self, currency):
+        if currency != self.ref_currency and currency not in self.rates:
+            raise ValueError('{} is not a supported currency'.format(currency))
+
+    def last_date(self, currency):
+        if currency == self.ref_currency:
+            return date.fromordinal(max(first + len(r) - 1 for first, r in self.rates.values()))
+        first, r = self.rates[currency]
+        return date.fromordinal(first + len(r) - 1)
+
+    def rates_at(self, currency, ordinals):
+        """
+        Returns the rates of currency at the given date ordinals. Dates outside
+        of the available range fall back to the first or last rate.
+        """
+        self._check(currency)
+        if currency == self.ref_currency:
+            return np.ones(len(ordinals))
+        first, r = self.rates[currency]
+        return r[np.clip(ordinals - first, 0, len(r) - 1)]
+
+    def rate(self, currency, date_):
+        self._check(currency)
+        if currency == self.ref_currency:
+            return 1.0
+        first, r = self.rates[currency]
+        return r[min(max(date_.toordinal() - first, 0), len(r) - 1)].item()
+
+    def convert(self, amount, currency, new_currency='EUR', date_=None):
+        """
+        Converts amount like CurrencyConverter.convert does; without a date,
+        the most recent rate of currency is used.
+        """
+        self._check(new_currency)
+        if date_ is None:
+            self._check(currency)
+            date_ = self.last_date(currency)
+        return float(amount) / self.rate(currency, date_) * self.rate(new_currency, date_)
@@ -1,12 +1,16 @@
 from datetime import timedelta, datetime, date
 from dateutil.relativedelta import relativedelta
 import csv
-import collections
-# import os
+import os
 import logging
 from pathlib import Path
+from threading import RLock
+from time import time
 
 from .util import currex, currency_aware
+from .quote_store import QuoteStore
+from .series import PriceSeries
+from .coverage import Coverage
 
 class Security:
     """
@@ -14,31 +18,89 @@ class Security:
     currency conversion and for reading and writing quotes to disk.
     """
 
+    __slots__ = (
+        'symbol', 'url', 'update_hook', 'update_hook_async', 'update_hook_historic',
+        'name', 'currency', '_last', '_high', '_low', 'last_price_update',
+        '_history', '_history_lock', '_unsaved_quotes', '_coverage', 'version', 'last_modified', 'logger'
+    )
+
+    # the data to_dict() returns
+    data_fields = ('url', 'name', 'currency', '_last', '_high', '_low', 'last_price_update')
+
     def __init__(self, symbol, read_quotes=True):
         self.symbol = symbol
 
         self.url = None
         self.update_hook = None
+        self.update_hook_async = None
         self.update_hook_historic = None
         self.name = None
         self.currency = None
         self._last = None
         self._high = None
         self._low = None
-        self._price_history = {}
         self.last_price_update = None
 
-        if read_quotes:
-            self.read_quotes()
+        # the price history is read from disk on first access (see _price_history)
+        self._history = None if read_quotes else PriceSeries()
+        # guards reading, changing and saving the price history, which
+        # request threads and the updater do concurrently
+        self._history_lock = RLock()
+
+        # dates whose quotes changed since the quote store was last read or written
+        self._unsaved_quotes = set()
+        # months whose quotes were completely fetched, read on first access (see coverage)
+        self._coverage = None
+
+        # bumped whenever the quote or price history change, see touch()
+        self.version = 0
+        self.last_modified = time()
 
         self.logger = logging.getLogger(self.symbol)
 
+    @property
+    def _price_history(self):
+        if self._history is None:
+            self.load_history()
+        return self._history
+
+    @_price_history.setter
+    def _price_history(self, value):
+        self._history = value if isinstance(value, PriceSeries) else PriceSeries.from_items(value.items())
+
+    @property
+    def history_loaded(self):
+        return self._history is not None
+
+    def load_history(self):
+        """
+        Reads the price history from disk now, unless it was already (it is
+        read on first access otherwise).
+        """
+        if self._history is None:
+            with self._history_lock:
+                if self._history is None:
+                    self.read_quotes()
+
+    def touch(self):
+        """
+        Marks the security's data as changed.
+        """
+        self.version += 1
+        self.last_modified = time()
+
     def update(self):
         if self.update_hook is None:
             raise Exception('update_hook was not given')
         else:
             self.update_from_dict(self.update_hook())
 
+    async def update_async(self):
+        if self.update_hook_async is None:
+            raise Exception('update_hook_async was not given')
+        else:
+            self.update_from_dict(await self.update_hook_async())
+
     def update_from_dict(self, data, overwrite=True):
         nothing_new = True
 
@@ -60,6 +122,17 @@ class Security:
 
         if nothing_new:
             self.logger.debug('Nothing to update')
+        else:
+            self.touch()
+
+    def to_dict(self):
+        """
+        Returns the data of the security (not its price history) in the form
+        update_from_dict() takes, with the URL as a string.
+        """
+        data = {key: getattr(self, key) for key in self.data_fields}
+        data['url'] = getattr(self.url, 'full_url', self.url)
+        return data
 
     def update_historic(self, start_date, end_date):
         if self.update_hook_historic is None:
@@ -67,15 +140,51 @@ class Security:
         else:
             self.update_historic_from_dict(self.update_hook_historic(start_date, end_date))
 
+    def update_historic_missing(self, start_date, end_date):
+        """
+        Fetches the quotes of the months between start_date and end_date that
+        were not completely fetched before (see coverage), including holes in
+        the middle of the history. Quotes and coverage are written after each
+        range of months, so a failed range doesn't lose the others; the first
+        error is raised once all ranges were tried.
+        """
+        error = None
+        for range_start, range_end in self.coverage.missing(start_date, end_date):
+            try:
+                self.update_historic(range_start, range_end)
+            except Exception as e:
+                self.logger.warning('Could not fetch quotes from {} to {}: {}'.format(range_start, range_end, e))
+                error = error or e
+                continue
+            # quotes first, so the coverage never claims quotes that weren't saved
+            self.write_quotes()
+            self.coverage.add(range_start, range_end)
+            self.coverage.write()
+
+        if error is not None:
+            raise error
+
     def update_historic_from_dict(self, data, overwrite=True):
-        for d, quote in data.items():
-            if d in self._price_history.keys():
-                if overwrite and self._price_history[d] != quote:
-                    self.logger.debug("Overwriting existing quote for {}: {} (was {})".format(d.strftime('%Y-%m-%d'), quote, self._price_history[d]))
-                    self._price_history[d] = quote
-            else:
-                self.logger.debug("Found historical quote: {}: {}".format(d.strftime('%Y-%m-%d'), quote))
-                self._price_history[d] = quote
+        changed = False
+
+        with self._history_lock:
+            history = self._price_history
+            # in date order, so that new quotes are appended to the price history
+            for d, quote in sorted(data.items()):
+                if d in history:
+                    if overwrite and history[d] != quote:
+                        self.logger.debug("Overwriting existing quote for {}: {} (was {})".format(d.strftime('%Y-%m-%d'), quote, history[d]))
+                        history[d] = quote
+                        self._unsaved_quotes.add(d)
+                        changed = True
+                else:
+                    self.logger.debug("Found historical quote: {}: {}".format(d.strftime('%Y-%m-%d'), quote))
+                    history[d] = quote
+                    self._unsaved_quotes.add(d)
+                    changed = True
+
+        if changed:
+            self.touch()
 
     @currency_aware
     def last(self): return self._last
@@ -86,35 +195,96 @@ class Security:
     @currency_aware
     def low(self): return self._low
 
+    def history_dates(self, start_date=None, end_date=None, limit=None):
+        """
+        Returns the dates of the price history in ascending order, optionally
+        restricted to start_date through end_date (both inclusive) and to the
+        most recent limit dates.
+        """
+        return self._price_history.slice(start_date, end_date, limit).keys()
+
     @currency_aware
-    def price_history(self): return self._price_history
+    def price_history(self, start_date=None, end_date=None, limit=None):
+        return self._price_history.slice(start_date, end_date, limit)
 
     @property
     def _quotes_path(self):
+        return Path.home()/'.ppserve'/'quotes'/(self.symbol + '.qbin')
+
+    @property
+    def _csv_quotes_path(self):
+        # quotes used to be stored as CSV; these files are migrated on first read
         return Path.home()/'.ppserve'/'quotes'/(self.symbol + '.quotes')
 
+    @property
+    def _coverage_path(self):
+        return Path.home()/'.ppserve'/'quotes'/(self.symbol + '.coverage')
+
+    @property
+    def coverage(self):
+        if self._coverage is None:
+            self._coverage = Coverage(self._coverage_path)
+            try:
+                self._coverage.read()
+            except FileNotFoundError:
+                self._coverage.bootstrap(self.history_dates())
+            except ValueError:
+                self.logger.warning('Ignoring corrupt coverage index {}'.format(self._coverage_path))
+                self._coverage.bootstrap(self.history_dates())
+        return self._coverage
+
     def write_quotes(self, path=None):
         if path is None:
             path = self._quotes_path
 
-        with open(path, 'w') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames = ["date","last"])
-            writer.writeheader()
-
-            for d,quote in collections.OrderedDict(sorted(self._price_history.items())).items():
-                writer.writerow({"date": d, "last": quote})
+        with self._history_lock:
+            QuoteStore(path).save(self._price_history, self._unsaved_quotes)
+            self._unsaved_quotes = set()
 
     def read_quotes(self, path=None):
         if path is None:
             path = self._quotes_path
+            if not path.exists() and self._csv_quotes_path.exists():
+                self.migrate_csv_quotes(self._csv_quotes_path, path)
+
+        with self._history_lock:
+            try:
+                history = QuoteStore(path).read()
+            except FileNotFoundError:
+                history = PriceSeries()
+            except ValueError as e:
+                # moved aside, so its months are fetched again instead of failing every time
+                corrupt_path = '{}.corrupt'.format(path)
+                self.logger.warning('Moving corrupt quote store to {}: {}'.format(corrupt_path, e))
+                os.replace(path, corrupt_path)
+                history = PriceSeries()
+                if Path(path) == self._quotes_path:
+                    # claims months that are not stored anymore
+                    try:
+                        os.remove(self._coverage_path)
+                    except FileNotFoundError:
+                        pass
+                    self._coverage = None
+            # quotes fetched but not saved yet are kept, and still saved by
+            # the next write_quotes()
+            for d in sorted(self._unsaved_quotes):
+                history[d] = self._history[d]
+            self._history = history
+
+    def migrate_csv_quotes(self, csv_path, path):
+        """
+        Converts a CSV quote file as written by earlier versions to the binary
+        quote store. The CSV file is left in place.
+        """
+        self.logger.info('Migrating quotes from {} to {}'.format(csv_path, path))
+
+        quotes = {}
+        with open(csv_path, 'r') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                quotes[datetime.strptime(row["date"], '%Y-%m-%d').date()] = float(row["last"])
 
-        try:
-            with open(path, 'r') as csvfile:
-                reader = csv.DictReader(csvfile)
-                for row in reader:
-                    self._price_history[datetime.strptime(row["date"], '%Y-%m-%d').date()] = float(row["last"])
-        except FileNotFoundError:
-            self._price_history = {}
+        QuoteStore(path).write(quotes.items())
 
     def pretty_print(self, target_currency=None):
         from termcolor import colored
@@ -0,0 +1,154 @@
+from datetime import date
+
+import numpy as np
+
+class PriceSeries:
+    """
+    Closing prices sorted by date, stored as an array of date ordinals (int32)
+    and one of prices (float64): 12 bytes per quote, instead of well over 100
+    for a dict entry with its date and float objects.
+
+    Reading works like a dict of dates and prices (len, in, [], get, keys,
+    values, items, all in date order). Ranges are found by binary search and
+    returned as series sharing the arrays, without copying or sorting.
+
+    Quotes newer than the last one are appended in place, with the arrays
+    growing geometrically. Older quotes are inserted into new arrays, so
+    series returned by slice() never see rows shift under them.
+
+    The arrays and the number of quotes in use are replaced together, as one
+    tuple, so threads reading the series while another one adds quotes always
+    see them consistent with each other.
+    """
+
+    __slots__ = ('_data',)
+
+    def __init__(self, ordinals=None, closes=None):
+        # ordinals must be sorted and unique
+        ordinals = np.zeros(0, dtype=np.int32) if ordinals is None else np.asarray(ordinals, dtype=np.int32)
+        closes = np.zeros(0, dtype=np.float64) if closes is None else np.asarray(closes, dtype=np.float64)
+        # (ordinals, closes, number of quotes used)
+        self._data = (ordinals, closes, len(ordinals))
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        Returns the series of (date, close) pairs in any order.
+        """
+        items = sorted(items)
+        return cls(
+            np.fromiter((d.toordinal() for d, _ in items), dtype=np.int32, count=len(items)),
+            np.fromiter((close for _, close in items), dtype=np.float64, count=len(items))
+        )
+
+    @property
+    def ordinals(self):
+        ordinals, _, size = self._data
+        return ordinals[:size]
+
+    @property
+    def closes(self):
+        _, closes, size = self._data
+        return closes[:size]
+
+    def __len__(self):
+        return self._data[2]
+
+    def _find(self, d):
+        ordinals, _, size = data = self._data
+        i = int(np.searchsorted(ordinals[:size], d.toordinal(), side='left'))
+        if i < size and ordinals[i] == d.toordinal():
+            return data, i
+        return data, None
+
+    def __contains__(self, d):
+        return self._find(d)[1] is not None
+
+    def __getitem__(self, d):
+        (_, closes, _), i = self._find(d)
+        if i is None:
+            raise KeyError(d)
+        return closes[i].item()
+
+    def get(self, d, default=None):
+        (_, closes, _), i = self._find(d)
+        return default if i is None else closes[i].item()
+
+    def __setitem__(self, d, close):
+        ordinal = d.toordinal()
+        ordinals, closes, n = self._data
+
+        if n and ordinal <= ordinals[n - 1]:
+            i = int(np.searchsorted(ordinals[:n], ordinal, side='left'))
+            if ordinals[i] == ordinal:
+                closes[i] = close
+            else:
+                self._data = (np.insert(ordinals[:n], i, ordinal), np.insert(closes[:n], i, close), n + 1)
+            return
+
+        if n == len(ordinals):
+            capacity = max(16, 2*n)
+            ordinals = np.resize(ordinals, capacity)
+            closes = np.resize(closes, capacity)
+        # beyond the size readers use, until the new tuple is published
+        ordinals[n] = ordinal
+        closes[n] = close
+        self._data = (ordinals, closes, n + 1)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return list(map(date.fromordinal, self.ordinals.tolist()))
+
+    def values(self):
+        return self.closes.tolist()
+
+    def items(self):
+        ordinals, closes, size = self._data
+        return zip(map(date.fromordinal, ordinals[:size].tolist()), closes[:size].tolist())
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def first_date(self):
+        ordinals, _, size = self._data
+        return date.fromordinal(int(ordinals[0])) if size else None
+
+    def last_date(self):
+        ordinals, _, size = self._data
+        return date.fromordinal(int(ordinals[size - 1])) if size else None
+
+    def slice(self, start_date=None, end_date=None, limit=None):
+        """
+        Returns the quotes from start_date through end_date (both inclusive,
+        both optional), restricted to the most recent limit of them.
+        """
+        ordinals, closes, size = self._data
+        ordinals = ordinals[:size]
+        lo, hi = 0, size
+        if start_date is not None:
+            lo = int(np.searchsorted(ordinals, start_date.toordinal(), side='left'))
+        if end_date is not None:
+            hi = int(np.searchsorted(ordinals, end_date.toordinal(), side='right'))
+        if limit is not None:
+            lo = max(lo, hi - limit)
+        lo = min(lo, hi)
+        return PriceSeries(ordinals[lo:hi], closes[lo:hi])
+
+    def with_closes(self, closes):
+        """
+        Returns a series of the same dates with the given prices.
+        """
+        return PriceSeries(self.ordinals, closes)
+
+    def __eq__(self, other):
+        if isinstance(other, PriceSeries):
+            this, other = self.slice(), other.slice()
+            return np.array_equal(this.ordinals, other.ordinals) and np.array_equal(this.closes, other.closes)
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return '<PriceSeries: {} quotes from {} to {}>'.format(len(self), self.first_date(), self.last_date())
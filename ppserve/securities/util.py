@@ -1,12 +1,17 @@
 from datetime import date
+from pathlib import Path
 
-# from forex_python.converter import CurrencyRates # too slow
-from currency_converter import CurrencyConverter
+import numpy as np
 
-currency_rates = CurrencyConverter(
-    'http://www.ecb.int/stats/eurofxref/eurofxref-hist.zip',
-    fallback_on_missing_rate=True,
-    fallback_on_wrong_date=True
+from .rates import RateTable
+from .series import PriceSeries
+from ..metrics import conversion_seconds
+from ..tracing import span
+
+# loaded lazily, on the first conversion between different currencies
+currency_rates = RateTable(
+    'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip',
+    Path.home()/'.ppserve'/'ecb_rates.npz'
 )
 
 # computes exchange rate between currencies
@@ -14,18 +19,35 @@ def currex(currency, target_currency=None, date_=None):
     if currency == target_currency or target_currency is None:
         return 1
     else:
-        return currency_rates.convert(1, currency, target_currency, date=date_)
+        return currency_rates.convert(1, currency, target_currency, date_=date_)
+
+# computes exchange rates between currencies for a whole series of dates (or an
+# array of date ordinals) at once; gives the same results as calling currex for every date
+def currex_series(currency, target_currency, dates):
+    if currency == target_currency or target_currency is None:
+        return np.ones(len(dates))
+    if isinstance(dates, np.ndarray):
+        ordinals = dates.astype(np.int64)
+    else:
+        ordinals = np.fromiter((d.toordinal() for d in dates), dtype=np.int64, count=len(dates))
+    return 1.0 / currency_rates.rates_at(currency, ordinals) * currency_rates.rates_at(target_currency, ordinals)
 
 # decorator to handle currency conversion
 def currency_aware(f):
-    def f_currency(sec, target_currency=None):
-        val = f(sec)
+    def f_currency(sec, target_currency=None, **kwargs):
+        val = f(sec, **kwargs)
         if val is None:
             return None
-        if type(val) == dict:
+        if isinstance(val, PriceSeries):
+            with conversion_seconds.labels('history').time(), span('convert', kind='history'):
+                new_val = val.with_closes(val.closes * currex_series(sec.currency, target_currency, val.ordinals))
+        elif type(val) == dict:
             # if the type is dict, the keys need to be the target date for the currency conversion
-            new_val = {d: v * currex(sec.currency, target_currency, date_=d) for (d,v) in val.items()}
+            with conversion_seconds.labels('history').time(), span('convert', kind='history'):
+                rates = currex_series(sec.currency, target_currency, val.keys())
+                new_val = dict(zip(val.keys(), (np.fromiter(val.values(), dtype=float, count=len(val)) * rates).tolist()))
         else:
-            new_val = val * currex(sec.currency, target_currency, date_=date.today())
+            with conversion_seconds.labels('quote').time(), span('convert', kind='quote'):
+                new_val = val * currex(sec.currency, target_currency, date_=date.today())
         return new_val
     return f_currency
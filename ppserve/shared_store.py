@@ -0,0 +1,112 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import date, datetime
+from time import time
+
+class SharedStore:
+    """
+    SQLite database through which the updater process hands securities to the
+    worker processes (see ppserve.prefork). It is kept in WAL mode, so the
+    workers can read while the updater writes, without blocking each other.
+
+    Each row holds the class of a security, its data (see Security.to_dict),
+    when its quote was last fetched and two stamps: stamp changes whenever the
+    data or the price history changed, history_stamp only with the latter.
+    The price histories themselves stay in the quote stores, which the
+    workers read directly.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS securities (
+            symbol TEXT PRIMARY KEY,
+            class TEXT NOT NULL,
+            data TEXT NOT NULL,
+            fetched REAL,
+            modified REAL NOT NULL,
+            stamp INTEGER NOT NULL,
+            history_stamp INTEGER NOT NULL
+        )
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        # sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(self.schema)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, datetime):
+            return {'datetime': value.isoformat()}
+        if isinstance(value, date):
+            return {'date': value.isoformat()}
+        raise TypeError('{} is not serializable'.format(repr(value)))
+
+    @staticmethod
+    def _decode(obj):
+        if len(obj) == 1 and 'datetime' in obj:
+            return datetime.fromisoformat(obj['datetime'])
+        if len(obj) == 1 and 'date' in obj:
+            return date.fromisoformat(obj['date'])
+        return obj
+
+    def publish(self, sec, fetched=False, history=False):
+        """
+        Stores sec. fetched tells that its quote was just fetched, history
+        that its price history was written to its quote store.
+        """
+        data = json.dumps(sec.to_dict(), default=self._encode, sort_keys=True)
+        self._connection().execute('''
+            INSERT INTO securities (symbol, class, data, fetched, modified, stamp, history_stamp)
+            VALUES (:symbol, :class, :data, :fetched, :modified, 1, 1)
+            ON CONFLICT (symbol) DO UPDATE SET
+                stamp = stamp + (class != excluded.class OR data != excluded.data OR :history),
+                history_stamp = history_stamp + :history,
+                modified = CASE WHEN class != excluded.class OR data != excluded.data OR :history THEN excluded.modified ELSE modified END,
+                fetched = coalesce(excluded.fetched, fetched),
+                class = excluded.class,
+                data = excluded.data
+        ''', {
+            'symbol': sec.symbol,
+            'class': type(sec).__name__,
+            'data': data,
+            'fetched': time() if fetched else None,
+            'modified': sec.last_modified,
+            'history': int(history)
+        })
+
+    def stamps(self, symbol):
+        """
+        Returns (stamp, history_stamp, fetched) of symbol, or None if it is
+        not stored.
+        """
+        return self._connection().execute(
+            'SELECT stamp, history_stamp, fetched FROM securities WHERE symbol = ?', (symbol,)
+        ).fetchone()
+
+    def load(self, symbol):
+        """
+        Returns the row of symbol as a dict with the data decoded, or None if
+        it is not stored.
+        """
+        cursor = self._connection().execute(
+            'SELECT class, data, fetched, modified, stamp, history_stamp FROM securities WHERE symbol = ?', (symbol,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        row = dict(zip([column[0] for column in cursor.description], row))
+        row['data'] = json.loads(row['data'], object_hook=self._decode)
+        return row
@@ -0,0 +1,112 @@
+import asyncio
+from threading import Event, Lock
+
+from .deadline import DeadlineExceeded, remaining
+
+class _Call:
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+        # (event loop, future) of the coroutines waiting for the call
+        self.waiters = []
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls. While a call for a key is in flight, further
+    callers for the same key do not start their own call but wait for the
+    running one and share its result (or its exception). Threads (do) and
+    coroutines (do_async) share calls with each other.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+        self.stats = {
+            'calls': 0,
+            'shared': 0
+        }
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats['calls'] += 1
+            else:
+                self.stats['shared'] += 1
+
+        if not leader:
+            # the call keeps running for the others, but this caller can't wait past its deadline
+            if not call.done.wait(remaining()):
+                raise DeadlineExceeded('Deadline exceeded while waiting for {}'.format(key))
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
+
+        return call.result
+
+    async def do_async(self, key, fn):
+        """
+        Like do(), but fn() returns an awaitable, and waiting for a call in
+        flight doesn't block the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats['calls'] += 1
+            else:
+                self.stats['shared'] += 1
+                waiter = loop.create_future()
+                call.waiters.append((loop, waiter))
+
+        if not leader:
+            try:
+                await asyncio.wait_for(waiter, remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded('Deadline exceeded while waiting for {}'.format(key)) from None
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = await fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
+
+        return call.result
+
+    def _finish(self, key, call):
+        with self._lock:
+            del self._calls[key]
+            waiters = call.waiters
+        call.done.set()
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def info(self):
+        with self._lock:
+            info = dict(self.stats)
+            info['in_flight'] = len(self._calls)
+        return info
@@ -0,0 +1,197 @@
+import cProfile
+import logging
+import os
+import random
+import re
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from time import perf_counter, time
+
+# the trace of the current request, None if it isn't traced
+_trace = ContextVar('trace', default=None)
+# index of the innermost open span in the current trace
+_parent = ContextVar('span', default=None)
+
+class Trace:
+    """
+    The timed spans recorded while answering one request. Each span remembers
+    the span that was open when it started (in the same thread or coroutine,
+    or in the caller of ppserve.deadline.carry), so they form a tree.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_started = time()
+        self.started = perf_counter()
+        self.duration = None
+        # [name, start, duration, parent, thread, attrs] in the order they started;
+        # the duration is None while the span is open
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def open(self, name, parent, attrs):
+        with self._lock:
+            self.spans.append([name, perf_counter() - self.started, None, parent, threading.current_thread().name, attrs])
+            return len(self.spans) - 1
+
+    def close(self, index, duration):
+        self.spans[index][2] = duration
+
+    def finish(self):
+        self.duration = perf_counter() - self.started
+
+    def server_timing(self):
+        """
+        Returns the total duration of the (finished) spans of each name, as
+        the value of a Server-Timing header.
+        """
+        totals = {}
+        for name, _, duration, _, _, _ in list(self.spans):
+            if duration is not None:
+                totals[name] = totals.get(name, 0) + duration
+        if self.duration is not None:
+            totals['total'] = self.duration
+        return ', '.join('{};dur={:.2f}'.format(name, duration*1000) for name, duration in totals.items())
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'started': datetime.fromtimestamp(self.wall_started).isoformat(),
+            'duration_ms': None if self.duration is None else round(self.duration*1000, 3),
+            'spans': [
+                {
+                    'id': i,
+                    'name': name,
+                    'start_ms': round(start*1000, 3),
+                    'duration_ms': None if duration is None else round(duration*1000, 3),
+                    'parent': parent,
+                    'thread': thread,
+                    'attrs': attrs
+                }
+                for i, (name, start, duration, parent, thread, attrs) in enumerate(list(self.spans))
+            ]
+        }
+
+class _Span:
+
+    __slots__ = ('trace', 'name', 'attrs', 'index', 'started', 'token')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.index = self.trace.open(self.name, _parent.get(), self.attrs)
+        self.token = _parent.set(self.index)
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.close(self.index, perf_counter() - self.started)
+        _parent.reset(self.token)
+
+class _NoSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_no_span = _NoSpan()
+
+def span(name, **attrs):
+    """
+    Returns a context manager timing the code it wraps as a span of the
+    current trace. Without a trace, it does nothing.
+    """
+    trace = _trace.get()
+    if trace is None:
+        return _no_span
+    return _Span(trace, name, attrs)
+
+@contextmanager
+def activate(trace):
+    """
+    Makes trace (which may be None) the current trace.
+    """
+    token = _trace.set(trace)
+    parent = _parent.set(None)
+    try:
+        yield trace
+    finally:
+        _parent.reset(parent)
+        _trace.reset(token)
+
+def stream(body, trace, finish):
+    """
+    Iterates body (e.g. a streamed table) with trace as the current trace,
+    and calls finish() when it is exhausted or closed.
+    """
+    chunks = iter(body)
+    try:
+        while True:
+            with activate(trace):
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        finish()
+
+# the most recent finished traces
+recent = deque(maxlen=50)
+
+def record(trace):
+    trace.finish()
+    recent.append(trace)
+
+class Profiler:
+    """
+    Runs cProfile for a random sample of requests (and for those that ask
+    for it) and dumps the statistics to files in directory, which can be
+    read with pstats or e.g. snakeviz. Only one request is profiled at a
+    time; cProfile only sees the thread the request started in.
+    """
+
+    def __init__(self, directory, sample=0.01):
+        self.directory = directory
+        self.sample = sample
+
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger('Profiler')
+
+    def start(self, force=False):
+        """
+        Returns a running profile if this request is to be profiled, else
+        None.
+        """
+        if not force and random.random() >= self.sample:
+            return None
+        if not self._lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, name):
+        """
+        Stops profile and dumps it to a file named after the time, the
+        process and name (e.g. the request path).
+        """
+        profile.disable()
+        self._lock.release()
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}-{}-{}.prof'.format(
+            datetime.now().strftime('%Y%m%d-%H%M%S-%f'), os.getpid(), re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_')
+        ))
+        profile.dump_stats(path)
+        self.logger.info('Wrote profile of {} to {}'.format(name, path))
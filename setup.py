@@ -14,14 +14,14 @@ setup(name='ppserve',
       scripts=['bin/ppserve'],
       install_requires=[
           'PyYAML',
-          'bs4',
           'lxml',
           'coloredlogs',
           'termcolor',
           'bottle',
           'paste',
           'CurrencyConverter',
-          'python-dateutil'
+          'python-dateutil',
+          'numpy'
       ],
       include_package_data=True
 )
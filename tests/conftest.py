@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# test the ppserve of this checkout, not an installed one
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent.parent/'benchmarks'))
+
+# importing ppserve parses the command line, and securities keep their quotes
+# in ~/.ppserve, so neither may be the real one
+sys.argv = [sys.argv[0], '--offline', '--log-level', 'WARNING']
+os.environ['HOME'] = tempfile.mkdtemp(prefix='ppserve-tests-')
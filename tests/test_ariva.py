@@ -0,0 +1,55 @@
+from datetime import date
+from pathlib import Path
+
+from ppserve.price_sources import ArivaPriceSource
+from ppserve.securities import Bond, Stock
+
+fixtures = Path(__file__).parent.parent/'benchmarks'/'fixtures'/'ariva'
+
+def page(kind, name):
+    return (fixtures/kind/(name + '.html')).read_text(encoding='utf-8')
+
+def source(sec_type):
+    src = ArivaPriceSource('TEST')
+    src.sec_type = sec_type
+    src._url_or_request = 'https://www.ariva.de/test?boerse_id=1'
+    return src
+
+def test_parse_info_stock():
+    info = source(Stock)._parse_info(page('aktie', 'snapshot'))
+
+    assert info['name'] == 'Apple Inc.'
+    assert info['_last'] == 1182.4
+    assert info['currency'] == 'USD'
+    assert info['last_price_update'] == date.today()
+
+def test_parse_info_bond():
+    info = source(Bond)._parse_info(page('anleihe', 'snapshot'))
+
+    assert info['name'] == 'Bundesrep.Deutschland Anl.v.2014 (2030)'
+    assert info['_last'] == 104.512
+    assert info['currency'] == 'EUR'
+    assert info['interest_rate'] == 1.5
+    assert info['_accrued_interest_fetched'] == 0.451
+    assert info['interest_from'] == date(2014, 2, 15)
+    assert info['maturity'] == date(2030, 2, 15)
+    assert info['interest_dates'] == [[15, 2]]
+
+def test_resolve_detects_type():
+    src = ArivaPriceSource('TEST')
+    request = src._resolve('https://www.ariva.de/bund-anleihe', page('anleihe', 'snapshot'))
+
+    assert src.sec_type is Bond
+    assert request.full_url == 'https://www.ariva.de/bund-anleihe?boerse_id=1'
+
+def test_parse_historic_month():
+    quotes = source(Stock)._parse_historic_month(page('aktie', 'historische_kurse'), date(2019, 1, 1), date(2019, 12, 31))
+
+    assert len(quotes) == 21
+    assert sorted(quotes.items())[:3] == [(date(2019, 3, 1), 1181.45), (date(2019, 3, 4), 1181.75), (date(2019, 3, 5), 1184.43)]
+    assert quotes[date(2019, 3, 29)] == 1182.4
+
+def test_parse_historic_month_window():
+    quotes = source(Bond)._parse_historic_month(page('anleihe', 'historische_kurse'), date(2019, 3, 20), date(2019, 3, 22))
+
+    assert quotes == {date(2019, 3, 20): 103.94, date(2019, 3, 21): 104.38, date(2019, 3, 22): 103.79}
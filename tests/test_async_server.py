@@ -0,0 +1,75 @@
+import socket
+from threading import Thread
+from time import monotonic
+
+import bottle
+import pytest
+
+from ppserve.async_server import AsyncServer
+
+@pytest.fixture(scope='module')
+def address():
+    app = bottle.Bottle()
+
+    @app.route('/echo', method=['GET', 'POST'])
+    def echo():
+        return bottle.request.body.read() or b'hello'
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen()
+    host, port = sock.getsockname()
+    server = AsyncServer(
+        host=host, port=port, sock=sock, keep_alive_timeout=0.5, read_timeout=0.5,
+        max_header_bytes=1024, max_header_lines=10, max_body_bytes=100
+    )
+    Thread(target=server.run, args=(app,), daemon=True).start()
+    return host, port
+
+def exchange(address, data):
+    """
+    Sends data and returns everything the server answers until it closes the
+    connection.
+    """
+    with socket.create_connection(address, timeout=5) as conn:
+        conn.sendall(data)
+        response = b''
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                return response
+            response += chunk
+
+def test_answers_requests_on_one_connection(address):
+    response = exchange(address, b'GET /echo HTTP/1.1\r\nHost: x\r\n\r\nPOST /echo HTTP/1.1\r\nContent-Length: 3\r\nConnection: close\r\n\r\nabc')
+
+    assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert response.count(b'HTTP/1.1 200 OK\r\n') == 2
+    assert b'hello' in response
+    assert response.endswith(b'abc')
+
+def test_malformed_request_line(address):
+    assert exchange(address, b'GET /echo\r\n\r\n').startswith(b'HTTP/1.1 400 ')
+    assert exchange(address, b'GET /echo SPDY/3\r\n\r\n').startswith(b'HTTP/1.1 400 ')
+
+def test_too_many_headers(address):
+    headers = b''.join(b'X-Header-%d: 1\r\n' % i for i in range(11))
+    assert exchange(address, b'GET /echo HTTP/1.1\r\n' + headers + b'\r\n').startswith(b'HTTP/1.1 431 ')
+
+def test_too_large_headers(address):
+    assert exchange(address, b'GET /echo HTTP/1.1\r\nCookie: ' + b'x'*2000 + b'\r\n\r\n').startswith(b'HTTP/1.1 431 ')
+
+def test_too_large_body(address):
+    assert exchange(address, b'POST /echo HTTP/1.1\r\nContent-Length: 101\r\n\r\n').startswith(b'HTTP/1.1 413 ')
+    assert exchange(address, b'POST /echo HTTP/1.1\r\nContent-Length: -1\r\n\r\n').startswith(b'HTTP/1.1 400 ')
+
+def test_closes_idle_connections(address):
+    started = monotonic()
+    assert exchange(address, b'') == b''
+    assert monotonic() - started < 3
+
+def test_closes_slow_requests(address):
+    started = monotonic()
+    # the headers never end
+    assert exchange(address, b'GET /echo HTTP/1.1\r\nHost: x\r\n') == b''
+    assert monotonic() - started < 3
@@ -0,0 +1,34 @@
+from datetime import date
+
+import pytest
+
+from ppserve.securities import Bond
+
+def bond(interest_dates, interest_from, maturity, interest_rate=1.5):
+    sec = Bond('TEST', read_quotes=False)
+    sec.interest_dates = interest_dates
+    sec.interest_from = interest_from
+    sec.maturity = maturity
+    sec.interest_rate = interest_rate
+    return sec
+
+def test_accrued_interest():
+    sec = bond([[15, 2]], date(2014, 2, 15), date(2030, 2, 15))
+
+    assert sec.accrued_interest(date(2019, 3, 29)) == pytest.approx(42*1.5/365)
+    assert sec.accrued_interest(date(2019, 2, 15)) == pytest.approx(1.5)
+    assert sec.accrued_interest(date(2031, 1, 1)) == 0
+
+def test_coupon_on_february_29():
+    sec = bond([[29, 2], [29, 8]], date(2016, 2, 29), date(2028, 2, 29))
+
+    # paid on Feb 28 in common years
+    assert sec.accrued_interest(date(2021, 3, 1)) == pytest.approx(1*1.5/365)
+    assert sec.accrued_interest(date(2024, 3, 1)) == pytest.approx(1*1.5/365)
+    assert len(sec.accrued_interest_series([date(2017, 1, 1), date(2023, 6, 30), date(2027, 12, 31)])) == 3
+
+def test_coupon_on_the_31st_of_a_short_month():
+    sec = bond([[31, 5], [31, 11]], date(2015, 5, 31), date(2025, 5, 31))
+
+    # paid on Nov 30
+    assert sec.accrued_interest(date(2020, 12, 1)) == pytest.approx(1*1.5/365)
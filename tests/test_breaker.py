@@ -0,0 +1,64 @@
+import pytest
+
+from ppserve.price_sources import breaker
+from ppserve.price_sources.breaker import CircuitBreaker, CircuitOpenError
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(breaker, 'monotonic', lambda: now[0])
+    return now
+
+def test_opens_after_threshold_failures(clock):
+    cb = CircuitBreaker(threshold=3, backoff=5)
+    for _ in range(2):
+        cb.before('host')
+        cb.failed('host')
+    cb.before('host')
+    cb.failed('host')
+
+    with pytest.raises(CircuitOpenError) as e:
+        cb.before('host')
+    assert e.value.retry_after == 5
+    # other hosts are not affected
+    cb.before('other')
+
+def test_success_resets_failures(clock):
+    cb = CircuitBreaker(threshold=2)
+    cb.failed('host')
+    cb.succeeded('host')
+    cb.failed('host')
+    cb.before('host')
+
+def test_backoff_doubles_while_probes_fail(clock):
+    cb = CircuitBreaker(threshold=1, backoff=5, max_backoff=15)
+    cb.failed('host')
+
+    backoff = 5
+    for next_backoff in (10, 15, 15):
+        clock[0] += backoff
+        # one probe is let through, the others are rejected meanwhile
+        cb.before('host')
+        with pytest.raises(CircuitOpenError):
+            cb.before('host')
+        cb.failed('host')
+        assert cb.info()['hosts']['host']['retry_after'] == next_backoff
+        backoff = next_backoff
+
+def test_successful_probe_closes(clock):
+    cb = CircuitBreaker(threshold=1, backoff=5)
+    cb.failed('host')
+    clock[0] += 6
+    cb.before('host')
+    cb.succeeded('host')
+
+    cb.before('host')
+    assert cb.info()['hosts']['host']['state'] == 'closed'
+
+def test_abandoned_probe_lets_the_next_one_through(clock):
+    cb = CircuitBreaker(threshold=1, backoff=5)
+    cb.failed('host')
+    clock[0] += 6
+    cb.before('host')
+    cb.abandoned('host')
+    cb.before('host')
@@ -0,0 +1,105 @@
+import asyncio
+from datetime import date
+from time import perf_counter
+
+import pytest
+
+from ppserve.price_sources import ArivaPriceSource, CompositePriceSource, price_source, register_source
+from standin import StandInServer
+
+@pytest.fixture
+def standins(tmp_path):
+    servers = []
+
+    def start(latency=0.0, failing=False):
+        # a stand-in without fixtures answers every lookup with 404
+        server = StandInServer(latency, path=tmp_path) if failing else StandInServer(latency)
+        servers.append(server.start())
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def register(name, server):
+    # Ariva at the stand-in, with its own statistics
+    register_source(name, type(name, (ArivaPriceSource,), {'name': name, 'base_url': server.url}))
+    return name
+
+def test_slow_source_is_hedged(standins, monkeypatch, request):
+    monkeypatch.setattr(CompositePriceSource, 'hedge_after', 0.1)
+    slow = register(request.node.name + '-slow', standins(latency=0.5))
+    fast_server = standins()
+    fast = register(request.node.name + '-fast', fast_server)
+
+    src = price_source('AKTIE-1', [slow, fast])
+    started = perf_counter()
+    info = src.fetch_info()
+
+    # the slow source needs three round trips of 0.5s to resolve and fetch the symbol
+    assert perf_counter() - started < 1
+    assert info['name'] == 'Apple Inc.'
+    assert src.url.startswith(fast_server.url)
+    assert CompositePriceSource.source_stats[fast].stats['hedges'] == 1
+    assert CompositePriceSource.source_stats[fast].stats['wins'] == 1
+    assert CompositePriceSource.source_stats[slow].stats['wins'] == 0
+
+def test_slow_source_is_hedged_async(standins, monkeypatch, request):
+    monkeypatch.setattr(CompositePriceSource, 'hedge_after', 0.1)
+    slow = register(request.node.name + '-slow', standins(latency=0.5))
+    fast = register(request.node.name + '-fast', standins())
+
+    src = price_source('AKTIE-1', [slow, fast])
+    started = perf_counter()
+    info = asyncio.run(src.fetch_info_async())
+
+    assert perf_counter() - started < 1
+    assert info['_last'] == 1182.4
+    assert CompositePriceSource.source_stats[fast].stats['wins'] == 1
+
+def test_failing_source_fails_over(standins, monkeypatch, request):
+    # no hedging, so only the failure makes the next source be asked
+    monkeypatch.setattr(CompositePriceSource, 'hedge_after', 10)
+    failing = register(request.node.name + '-failing', standins(failing=True))
+    working_server = standins()
+    working = register(request.node.name + '-working', working_server)
+
+    src = price_source('ANLEIHE-1', [failing, working])
+    started = perf_counter()
+    info = src.fetch_info()
+
+    assert perf_counter() - started < 5
+    assert info['interest_rate'] == 1.5
+    assert src.url.startswith(working_server.url)
+    assert CompositePriceSource.source_stats[failing].stats['errors'] == 1
+    assert CompositePriceSource.source_stats[working].stats['wins'] == 1
+
+    # the failed source is tried last from now on
+    assert [source.name for source in price_source('ANLEIHE-1', [failing, working])._ordered()] == [working, failing]
+
+def test_failing_source_fails_over_async(standins, monkeypatch, request):
+    monkeypatch.setattr(CompositePriceSource, 'hedge_after', 10)
+    failing = register(request.node.name + '-failing', standins(failing=True))
+    working = register(request.node.name + '-working', standins())
+
+    info = asyncio.run(price_source('ANLEIHE-1', [failing, working]).fetch_info_async())
+
+    assert info['interest_rate'] == 1.5
+    assert CompositePriceSource.source_stats[failing].stats['errors'] == 1
+
+def test_historic_quotes_fail_over(standins, request):
+    failing = register(request.node.name + '-failing', standins(failing=True))
+    working = register(request.node.name + '-working', standins())
+
+    quotes = price_source('AKTIE-1', [failing, working]).fetch_historic_quotes(date(2024, 5, 1), date(2024, 5, 31))
+
+    assert quotes
+    assert all(date(2024, 5, 1) <= d <= date(2024, 5, 31) for d in quotes)
+
+def test_all_sources_failing_raises(standins, request):
+    first = register(request.node.name + '-first', standins(failing=True))
+    second = register(request.node.name + '-second', standins(failing=True))
+
+    with pytest.raises(Exception):
+        price_source('AKTIE-1', [first, second]).fetch_info()
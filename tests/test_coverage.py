@@ -0,0 +1,22 @@
+from datetime import date
+
+from ppserve.securities.coverage import Coverage
+
+def test_bootstrap_refetches_partial_last_month(tmp_path):
+    coverage = Coverage(tmp_path/'X.coverage')
+    # quotes stored until 2026-09-10 by a version without coverage index
+    coverage.bootstrap([date(2026, 7, 1), date(2026, 7, 31), date(2026, 8, 3), date(2026, 9, 10)], today=date(2026, 10, 18))
+
+    assert coverage.missing(date(2026, 7, 1), date(2026, 10, 18)) == [(date(2026, 9, 1), date(2026, 10, 18))]
+
+def test_bootstrap_skips_current_month(tmp_path):
+    coverage = Coverage(tmp_path/'X.coverage')
+    coverage.bootstrap([date(2026, 8, 3), date(2026, 9, 10), date(2026, 10, 2)], today=date(2026, 10, 18))
+
+    assert coverage.missing(date(2026, 8, 1), date(2026, 10, 18)) == [(date(2026, 10, 1), date(2026, 10, 18))]
+
+def test_bootstrap_empty(tmp_path):
+    coverage = Coverage(tmp_path/'X.coverage')
+    coverage.bootstrap([], today=date(2026, 10, 18))
+
+    assert coverage.missing(date(2026, 10, 1), date(2026, 10, 18)) == [(date(2026, 10, 1), date(2026, 10, 18))]
@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from time import perf_counter
+
+import pytest
+
+from ppserve.deadline import DeadlineExceeded, carry, deadline, remaining
+from ppserve.price_sources import ArivaPriceSource
+from standin import StandInServer
+
+def test_nested_deadlines_only_shorten():
+    assert remaining(10) == 10
+    with deadline(1):
+        with deadline(5):
+            assert remaining() <= 1
+        with deadline(0.5):
+            assert remaining(10) <= 0.5
+        assert 0.5 < remaining(10) <= 1
+    assert remaining() is None
+
+def test_expired_deadline_raises():
+    with deadline(0):
+        with pytest.raises(DeadlineExceeded):
+            remaining(10)
+
+def test_carry_takes_the_deadline_into_threads():
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with deadline(1):
+            carried = executor.submit(carry(remaining), 10).result()
+            not_carried = executor.submit(remaining, 10).result()
+    assert carried <= 1
+    assert not_carried == 10
+
+def test_historic_workers_keep_to_the_deadline():
+    server = StandInServer(latency=1.0).start()
+    try:
+        class Source(ArivaPriceSource):
+            base_url = server.url
+        src = Source('AKTIE-1')
+        # resolved without a deadline, so only the month pages are fetched under it
+        src.url
+
+        started = perf_counter()
+        with deadline(0.3):
+            with pytest.raises(TimeoutError):
+                src.fetch_historic_quotes(date(2026, 1, 1), date(2026, 3, 31), workers=3)
+        assert perf_counter() - started < 0.9
+    finally:
+        server.shutdown()
+        server.server_close()
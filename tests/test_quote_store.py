@@ -0,0 +1,86 @@
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+from ppserve.securities import Security
+from ppserve.securities.quote_store import QuoteStore
+
+start = date(2026, 1, 1)
+
+def quotes(first, n):
+    return [(start + timedelta(days=i), float(i)) for i in range(first, first + n)]
+
+def test_write_and_append(tmp_path):
+    store = QuoteStore(tmp_path/'X.qbin')
+    store.write(quotes(0, 3))
+    store.append(quotes(3, 2))
+
+    assert store.read().to_dict() == dict(quotes(0, 5))
+    assert store.read(start + timedelta(days=1), start + timedelta(days=3)).to_dict() == dict(quotes(1, 3))
+    assert store.last_date() == start + timedelta(days=4)
+
+    with pytest.raises(ValueError):
+        store.append(quotes(4, 1))
+    assert store.read().to_dict() == dict(quotes(0, 5))
+
+def test_uncommitted_append_is_ignored_and_overwritten(tmp_path):
+    store = QuoteStore(tmp_path/'X.qbin')
+    store.write(quotes(0, 3))
+
+    # a crash after writing the records, before committing them in the header
+    recs = QuoteStore._to_records(quotes(3, 2))
+    with open(store.path, 'ab') as f:
+        f.write(recs.tobytes())
+    assert store.read().to_dict() == dict(quotes(0, 3))
+
+    store.append(quotes(5, 1))
+    assert store.read().to_dict() == dict(quotes(0, 3) + quotes(5, 1))
+    assert store.path.stat().st_size == QuoteStore.header.size + 4*QuoteStore.record.itemsize
+
+def test_save_appends_or_rewrites(tmp_path):
+    store = QuoteStore(tmp_path/'X.qbin')
+    history = dict(quotes(0, 3))
+    store.save(history, set(history))
+
+    history.update(quotes(3, 1))
+    store.save(history, {start + timedelta(days=3)})
+    assert store.read().to_dict() == history
+
+    history[start] = -1.0
+    store.save(history, {start})
+    assert store.read().to_dict() == history
+
+@pytest.mark.parametrize('content', [b'', b'PPQS', b'NOPE' + bytes(12)])
+def test_corrupt_store(tmp_path, content):
+    path = tmp_path/'X.qbin'
+    path.write_bytes(content)
+    with pytest.raises(ValueError):
+        QuoteStore(path).read()
+
+def test_corrupt_store_is_moved_aside():
+    sec = Security('CORRUPT', read_quotes=False)
+    sec._price_history = dict(quotes(0, 40))
+    sec.write_quotes()
+    sec.coverage.add(date(2026, 1, 1), date(2026, 1, 31))
+    sec.coverage.write()
+    sec._quotes_path.write_bytes(b'garbage')
+
+    sec = Security('CORRUPT')
+    assert len(sec.price_history()) == 0
+    assert sec._quotes_path.with_name('CORRUPT.qbin.corrupt').read_bytes() == b'garbage'
+    assert sec.coverage.missing(date(2026, 1, 1), date(2026, 1, 31)) == [(date(2026, 1, 1), date(2026, 1, 31))]
+
+    sec.update_historic_from_dict(dict(quotes(0, 1)))
+    sec.write_quotes()
+    assert QuoteStore(sec._quotes_path).read().to_dict() == dict(quotes(0, 1))
+
+def test_migrate_csv_quotes():
+    sec = Security('MIGRATE', read_quotes=False)
+    sec._csv_quotes_path.parent.mkdir(parents=True, exist_ok=True)
+    sec._csv_quotes_path.write_text('date,last\n2026-01-02,1.5\n2026-01-01,1.25\n')
+
+    sec = Security('MIGRATE')
+    assert sec.price_history() == {date(2026, 1, 1): 1.25, date(2026, 1, 2): 1.5}
+    assert np.array_equal(QuoteStore(sec._quotes_path).records()['close'], [1.25, 1.5])
+    assert sec._csv_quotes_path.exists()
@@ -0,0 +1,95 @@
+import io
+import zipfile
+from datetime import date
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Event, Thread
+from time import monotonic
+
+import pytest
+
+from ppserve.securities.rates import RateTable
+
+csv = '''Date,USD,JPY,XYZ,
+2026-01-05,1.2,150,N/A,
+2026-01-02,1.1,,N/A,
+2026-01-01,1.0,140,N/A,
+'''
+
+def zipped(text):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as z:
+        z.writestr('eurofxref-hist.csv', text)
+    return buf.getvalue()
+
+@pytest.fixture
+def ecb():
+    """
+    Serves csv like the ECB, or never answers once hang is set.
+    """
+    hang = Event()
+    release = Event()
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if hang.is_set():
+                release.wait(10)
+                return
+            body = zipped(csv)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/eurofxref-hist.zip'.format(server.server_port), hang
+    release.set()
+    server.shutdown()
+
+def test_parse_interpolates_missing_days():
+    rates = RateTable._parse(zipped(csv))
+
+    assert set(rates) == {'USD', 'JPY'}
+    first, usd = rates['USD']
+    assert first == date(2026, 1, 1).toordinal()
+    assert usd.tolist() == pytest.approx([1.0, 1.1, 1.13333, 1.16667, 1.2], abs=1e-4)
+    assert rates['JPY'][1].tolist() == pytest.approx([140, 142.5, 145, 147.5, 150])
+
+def test_downloads_and_caches(ecb, tmp_path):
+    url, _ = ecb
+    table = RateTable(url, tmp_path/'rates.npz')
+    assert table.rate('USD', date(2026, 1, 2)) == 1.1
+    assert table.updated > 0
+
+    cached = RateTable('http://127.0.0.1:1/unused', tmp_path/'rates.npz', offline=True)
+    assert cached.rate('USD', date(2026, 1, 2)) == 1.1
+
+def test_hanging_download_falls_back(ecb, tmp_path):
+    url, hang = ecb
+    hang.set()
+    table = RateTable(url, tmp_path/'rates.npz', timeout=0.5)
+
+    started = monotonic()
+    table.load()
+    assert monotonic() - started < 5
+    # bundled with CurrencyConverter
+    assert table.updated == 0
+    assert 'USD' in table.currencies
+
+def test_refresh_doesnt_block_conversions(ecb, tmp_path):
+    url, hang = ecb
+    table = RateTable(url, tmp_path/'rates.npz', timeout=1)
+    table.load()
+
+    hang.set()
+    refresher = Thread(target=table.refresh)
+    refresher.start()
+    started = monotonic()
+    table.load()
+    assert table.convert(1.1, 'USD', 'EUR', date(2026, 1, 2)) == pytest.approx(1.0)
+    assert monotonic() - started < 1
+    refresher.join()
+    # kept
+    assert table.rate('USD', date(2026, 1, 2)) == 1.1
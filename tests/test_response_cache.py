@@ -0,0 +1,33 @@
+from ppserve.response_cache import ResponseCache
+
+def test_sizes_are_encoded_bytes():
+    cache = ResponseCache(max_bytes=100, max_entry_bytes=10)
+    # nine and eleven bytes
+    cache.put(('A',), 1, 'ääääa')
+    cache.put(('B',), 1, 'äääääa')
+
+    assert cache.get(('A',), 1) == 'ääääa'.encode()
+    assert cache.get(('B',), 1) is None
+    assert cache.info()['bytes'] == 9
+
+def test_tee_stores_encoded_stream():
+    cache = ResponseCache(max_bytes=100, max_entry_bytes=10)
+    assert list(cache.tee(('A',), 1, iter(['€', '€']))) == ['€', '€']
+    assert cache.get(('A',), 1) == '€€'.encode()
+
+    assert list(cache.tee(('B',), 1, iter(['€€', '€€']))) == ['€€', '€€']
+    assert cache.get(('B',), 1) is None
+
+def test_invalidate_and_clear():
+    cache = ResponseCache(max_bytes=100)
+    cache.put(('A', 'quote'), 1, 'a')
+    cache.put(('A', 'historic'), 1, 'aa')
+    cache.put(('B', 'quote'), 1, 'b')
+
+    cache.invalidate('A')
+    assert cache.get(('A', 'quote'), 1) is None
+    assert cache.get(('B', 'quote'), 1) == b'b'
+    assert cache.info()['bytes'] == 1
+
+    cache.clear()
+    assert cache.info()['entries'] == 0
@@ -0,0 +1,54 @@
+import io
+from time import monotonic
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+import pytest
+
+from ppserve import ppserve
+from ppserve.securities import Stock
+
+@pytest.fixture
+def stock():
+    sec = Stock('ROUTES', read_quotes=False)
+    sec.update_from_dict({'name': 'Routes AG', 'currency': 'EUR', '_last': 10.0, 'last_price_update': '2026-10-16'})
+    ppserve.quote_cache.securities[sec.symbol] = sec
+    ppserve.quote_cache._fetched[sec.symbol] = monotonic()
+    yield sec
+    ppserve.quote_cache.securities.pop(sec.symbol)
+    ppserve.quote_cache._fetched.pop(sec.symbol)
+
+def get(path, query='', **headers):
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query, 'wsgi.errors': io.StringIO()}
+    environ.update(('HTTP_' + name.upper(), value) for name, value in headers.items())
+    setup_testing_defaults(environ)
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status[:3])
+        response['headers'] = {name.lower(): value for name, value in headers}
+    body = b''.join(bottle.default_app()(environ, start_response))
+    return response['status'], response['headers'], body
+
+def test_conditional_requests(stock):
+    status, headers, body = get('/quote/ROUTES/clean/EUR')
+    assert status == 200
+    assert b'Routes AG' in body
+    assert get('/quote/ROUTES/clean/EUR', If_None_Match=headers['etag'])[0] == 304
+    assert get('/historic/ROUTES/clean/EUR', If_None_Match='*')[0] == 304
+
+@pytest.mark.parametrize('path, query, status', [
+    ('/historic/ROUTES/clean/EUR', 'from=yesterday', 400),
+    ('/historic/ROUTES/clean/EUR', 'limit=-1', 400),
+    ('/historic/ROUTES/dirty/EUR', '', 500),
+    ('/quote/ROUTES/dirty/EUR', '', 500)
+])
+def test_invalid_requests_are_not_answered_with_304(stock, path, query, status):
+    assert get(path, query, If_None_Match='*')[0] == status
+
+def test_cached_responses_are_dropped_when_the_security_changes(stock):
+    first = get('/quote/ROUTES/clean/EUR')[2]
+    assert get('/quote/ROUTES/clean/EUR')[2] == first
+    assert ppserve.response_cache.get(('ROUTES', 'quote', 'clean', 'EUR', ''), ppserve.response_stamp(stock, 'quote', 'clean', 'EUR')[0]) == first
+
+    ppserve.quote_cache.on_fetch(stock)
+    assert ppserve.response_cache.info()['entries'] == 0
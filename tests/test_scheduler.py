@@ -0,0 +1,21 @@
+from ppserve.price_sources import ArivaPriceSource
+from ppserve.scheduler import RefreshScheduler, source_host
+from ppserve.securities import Security
+
+def test_only_scheduled_requests_are_recorded():
+    scheduler = RefreshScheduler(lambda sec: None)
+    scheduler.add(Security('AKTIE-1', read_quotes=False))
+
+    for i in range(1000):
+        scheduler.note_request('UNKNOWN-{}'.format(i))
+    scheduler.note_request('AKTIE-1')
+
+    assert list(scheduler._requested) == ['AKTIE-1']
+
+def test_host_is_the_same_before_and_after_the_first_update():
+    sec = Security('AKTIE-2', read_quotes=False)
+    ArivaPriceSource('AKTIE-2').hook_into(sec)
+    before = source_host(sec)
+    sec.url = 'https://www.ariva.de/aktie-2'
+
+    assert before == source_host(sec) == 'www.ariva.de'
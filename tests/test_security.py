@@ -0,0 +1,58 @@
+from datetime import date, timedelta
+from threading import Event, Thread
+
+from ppserve.securities import Security
+from ppserve.securities.quote_store import QuoteStore
+
+start = date(2026, 1, 1)
+
+def stored(symbol, days):
+    sec = Security(symbol, read_quotes=False)
+    sec._price_history = {start + timedelta(days=i): float(i) for i in range(days)}
+    sec.write_quotes()
+
+def test_lazy_load_doesnt_drop_quotes_being_fetched(monkeypatch):
+    stored('LAZY', 10)
+    sec = Security('LAZY')
+
+    # hold the request's read of the store while the updater gets going
+    reading = Event()
+    go_on = Event()
+    read = QuoteStore.read
+    def slow_read(store, *args):
+        history = read(store, *args)
+        if not reading.is_set():
+            reading.set()
+            go_on.wait(5)
+        return history
+    monkeypatch.setattr(QuoteStore, 'read', slow_read)
+
+    request = Thread(target=lambda: sec.price_history())
+    request.start()
+    reading.wait(5)
+
+    def update():
+        sec.update_historic_from_dict({start + timedelta(days=10): 10.0})
+        sec.write_quotes()
+    updater = Thread(target=update)
+    updater.start()
+    # done already, or waiting for the request's read
+    updater.join(0.5)
+    go_on.set()
+    request.join()
+    updater.join()
+
+    assert len(sec.price_history()) == 11
+    assert len(QuoteStore(sec._quotes_path).read()) == 11
+
+def test_reload_keeps_unsaved_quotes():
+    stored('RELOAD', 10)
+    sec = Security('RELOAD')
+    sec.update_historic_from_dict({start + timedelta(days=10): 10.0, start: -1.0})
+
+    sec.read_quotes()
+    assert sec.price_history()[start + timedelta(days=10)] == 10.0
+    assert sec.price_history()[start] == -1.0
+
+    sec.write_quotes()
+    assert QuoteStore(sec._quotes_path).read().to_dict() == sec.price_history()
@@ -0,0 +1,44 @@
+from datetime import date, timedelta
+from threading import Event, Thread
+
+from ppserve.securities.series import PriceSeries
+
+def test_setitem_appends_and_inserts():
+    series = PriceSeries()
+    series[date(2026, 1, 5)] = 3.0
+    series[date(2026, 1, 7)] = 4.0
+    series[date(2026, 1, 2)] = 1.0
+    series[date(2026, 1, 6)] = 3.5
+    series[date(2026, 1, 5)] = 2.0
+
+    assert series.to_dict() == {date(2026, 1, 2): 1.0, date(2026, 1, 5): 2.0, date(2026, 1, 6): 3.5, date(2026, 1, 7): 4.0}
+    assert series.slice(date(2026, 1, 3), date(2026, 1, 6)).to_dict() == {date(2026, 1, 5): 2.0, date(2026, 1, 6): 3.5}
+    assert series.slice(limit=1).to_dict() == {date(2026, 1, 7): 4.0}
+
+def test_slices_stay_aligned_while_quotes_are_inserted():
+    # each close encodes its date, so misaligned arrays are noticed
+    start = date(2000, 1, 1)
+    series = PriceSeries.from_items((start + timedelta(days=2*i), float(2*i)) for i in range(2000))
+    done = Event()
+    errors = []
+
+    def read():
+        while not done.is_set():
+            try:
+                part = series.slice(start + timedelta(days=100), start + timedelta(days=3000))
+                if (part.ordinals - start.toordinal() != part.closes).any():
+                    errors.append('misaligned')
+            except Exception as e:
+                errors.append(e)
+
+    readers = [Thread(target=read) for _ in range(2)]
+    for reader in readers:
+        reader.start()
+    for i in range(500):
+        series[start + timedelta(days=2*i + 1)] = float(2*i + 1)
+    done.set()
+    for reader in readers:
+        reader.join()
+
+    assert not errors
+    assert len(series) == 2500
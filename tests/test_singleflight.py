@@ -0,0 +1,93 @@
+import asyncio
+from threading import Event, Thread
+
+from ppserve.singleflight import SingleFlight
+
+def test_threads_share_a_call():
+    flight = SingleFlight()
+    started, release = Event(), Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 'quote'
+
+    results = []
+    leader = Thread(target=lambda: results.append(flight.do('AKTIE-1', fetch)))
+    leader.start()
+    started.wait()
+    follower = Thread(target=lambda: results.append(flight.do('AKTIE-1', fetch)))
+    follower.start()
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert results == ['quote', 'quote']
+    assert len(calls) == 1
+
+def test_coroutine_joins_call_of_thread():
+    flight = SingleFlight()
+    started, release = Event(), Event()
+
+    def fetch():
+        started.set()
+        release.wait()
+        return 'from thread'
+
+    leader = Thread(target=flight.do, args=('AKTIE-1', fetch))
+    leader.start()
+    started.wait()
+
+    async def fetch_async():
+        return 'from coroutine'
+
+    async def follow():
+        follower = asyncio.ensure_future(flight.do_async('AKTIE-1', fetch_async))
+        await asyncio.sleep(0.05)
+        # the event loop isn't blocked while waiting
+        assert not follower.done()
+        release.set()
+        return await follower
+
+    assert asyncio.run(follow()) == 'from thread'
+    leader.join()
+    assert flight.info()['shared'] == 1
+
+def test_thread_joins_call_of_coroutine():
+    flight = SingleFlight()
+    results = []
+
+    async def lead():
+        started = asyncio.Event()
+
+        async def fetch_async():
+            started.set()
+            await asyncio.sleep(0.1)
+            return 'from coroutine'
+
+        leader = asyncio.ensure_future(flight.do_async('AKTIE-1', fetch_async))
+        await started.wait()
+        follower = Thread(target=lambda: results.append(flight.do('AKTIE-1', lambda: 'from thread')))
+        follower.start()
+        result = await leader
+        await asyncio.get_running_loop().run_in_executor(None, follower.join)
+        return result
+
+    assert asyncio.run(lead()) == 'from coroutine'
+    assert results == ['from coroutine']
+
+def test_errors_are_shared_with_coroutines():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.05)
+        raise ConnectionError('unreachable')
+
+    async def run():
+        return await asyncio.gather(flight.do_async('X', fail), flight.do_async('X', fail), return_exceptions=True)
+
+    errors = asyncio.run(run())
+    assert [type(e) for e in errors] == [ConnectionError, ConnectionError]
+    assert flight.info() == {'calls': 1, 'shared': 1, 'in_flight': 0}